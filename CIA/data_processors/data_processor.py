@@ -25,34 +25,51 @@ class DataProcessor(nn.Module):
         self.num_channels = len(self.num_tokens_per_channel)
 
         additional_token = num_additional_tokens if add_mask_token else 0
-        self.embeddings = nn.ModuleList(
-            [
-                nn.Embedding(num_embeddings + additional_token, self.embedding_size)
-                for num_embeddings in self.num_tokens_per_channel
-            ]
-        )
+        # the embeddings of all channels are packed in a single table:
+        # token t of channel c is row embedding_offsets[c] + t
+        num_embeddings_per_channel = [
+            num_embeddings + additional_token
+            for num_embeddings in self.num_tokens_per_channel
+        ]
+        self.embedding = nn.Embedding(sum(num_embeddings_per_channel),
+                                      self.embedding_size)
+        self.register_buffer(
+            'embedding_offsets',
+            torch.LongTensor([0] + num_embeddings_per_channel[:-1]).cumsum(0),
+            persistent=False)
+        self._register_load_state_dict_pre_hook(self._pack_embeddings)
+
+    def _pack_embeddings(self, state_dict, prefix, *args):
+        """Checkpoints saved before the embeddings were packed
+        contain one embedding table per channel
+        """
+        keys = [
+            f'{prefix}embeddings.{channel_index}.weight'
+            for channel_index in range(self.num_channels)
+        ]
+        if all(key in state_dict for key in keys):
+            state_dict[f'{prefix}embedding.weight'] = torch.cat(
+                [state_dict.pop(key) for key in keys], dim=0)
 
     def embed(self, x):
         """
+        A single lookup in the packed table for all channels
 
         :param x: (..., num_channels)
         :return: (..., num_channels, embedding_size)
+        (contiguous, so that flatten(start_dim=-2) gives the event representations
+        (..., num_channels * embedding_size) without copy)
         """
-        return torch.cat([
-            embedding(t)
-            for t, embedding in
-            zip(x.split(1, dim=-1), self.embeddings)
-        ], dim=-2
-        )
+        return self.embedding(x + self.embedding_offsets)
 
     def embed_step(self, x, channel_index):
         """
-        embed using only embedding[channel_index]
+        embed using only the embeddings of channel channel_index
         :param x: (batch_size,)
         :param channel_index:
         :return:
         """
-        return self.embeddings[channel_index](x)
+        return self.embedding(x + self.embedding_offsets[channel_index])
 
 
     def embed_dict(self, tensor_dict):
@@ -1,10 +1,9 @@
-from DatasetManager.piano.piano_helper import find_nearest_value
 from DatasetManager.piano.piano_midi_dataset import END_SYMBOL, PAD_SYMBOL, START_SYMBOL
 from .data_processor import DataProcessor
 import torch
 import random
 from torch import nn
-from CIA.utils import cuda_variable
+from CIA.utils import cuda_variable, time_shift_sums
 
 
 class PianoPrefixDataProcessor(DataProcessor):
@@ -46,6 +45,22 @@ class PianoPrefixDataProcessor(DataProcessor):
         ]),
             requires_grad=False)
 
+        # sorted time table and corresponding time_shift tokens,
+        # used by quantize_time_shift
+        # (not persistent so that the checkpoints are unchanged)
+        time_table = sorted(
+            self.dataloader_generator.dataset.time_table_time_shift)
+        self.register_buffer('time_table_time_shift',
+                             torch.tensor(time_table, dtype=torch.float64),
+                             persistent=False)
+        self.register_buffer('time_table_time_shift_tokens',
+                             torch.LongTensor([
+                                 self.dataloader_generator.dataset.
+                                 value2index['time_shift'][value]
+                                 for value in time_table
+                             ]),
+                             persistent=False)
+
     def preprocess(self, x, num_events_inpainted):
         """[summary]
 
@@ -300,14 +315,30 @@ class PianoPrefixDataProcessor(DataProcessor):
         }
         return y, metadata_dict
 
+    def quantize_time_shift(self, values):
+        """Tokens of the nearest values of the time table
+        (same as find_nearest_value followed by value2index['time_shift'],
+        for a whole tensor at once: values exactly between two values
+        of the time table get the lower one, as with argmin)
+
+        Args:
+            values: tensor of time shifts in seconds, any shape
+
+        Returns:
+            LongTensor of time_shift tokens with the same shape, on the device of the time table
+        """
+        time_table = self.time_table_time_shift
+        values = torch.as_tensor(values).to(time_table)
+        upper = torch.bucketize(values, time_table).clamp(max=time_table.size(0) - 1)
+        lower = (upper - 1).clamp(min=0)
+        use_lower = (values - time_table[lower]).abs() <= (
+            time_table[upper] - values).abs()
+        indices = torch.where(use_lower, lower, upper)
+        return self.time_table_time_shift_tokens[indices]
+
     def compute_placeholder(self, placeholder_duration, batch_size):
-        placeholder_duration_token = cuda_variable(
-            torch.Tensor([
-                self.dataloader_generator.dataset.value2index['time_shift']
-                [find_nearest_value(
-                    self.dataloader_generator.dataset.time_table_time_shift,
-                    pd.item())] for pd in placeholder_duration
-            ]))
+        placeholder_duration_token = self.quantize_time_shift(
+            placeholder_duration)
 
         # placeholder is batch_size, 1, 4
         placeholder = self.placeholder_symbols.unsqueeze(0).unsqueeze(
@@ -348,6 +379,39 @@ class PianoPrefixDataProcessor(DataProcessor):
             print('stop')
         return elapsed_time
 
+    def compute_elapsed_time_step(self, metadata_dict, event_index, h=None):
+        """Elapsed time of event event_index only,
+        equal to compute_elapsed_time(metadata_dict)[:, event_index]
+
+        h contains the sums of the time shifts before event_index,
+        decoding_start and event 255 (see time_shift_sums):
+        the float32 operations of compute_elapsed_time are applied to them
+
+        Args:
+            metadata_dict (dict): must contain original_sequence and decoding_start
+            event_index (int): index of the event
+            h (batch_size, 3): h returned for event event_index - 1 if known
+
+        Returns:
+            (batch_size, ) elapsed time of event event_index and its h
+        """
+        x = metadata_dict['original_sequence']
+        decoding_start = metadata_dict['decoding_start']
+        if h is None:
+            h = torch.stack([
+                time_shift_sums(self.dataloader_generator, x[:, :num_events])
+                for num_events in [event_index, decoding_start, 255]
+            ], dim=1)
+        else:
+            time_shift_sum = h[:, 0] + time_shift_sums(
+                self.dataloader_generator, x[:, event_index - 1:event_index])
+            h = torch.cat([time_shift_sum.unsqueeze(1), h[:, 1:]], dim=1)
+        elapsed_time = h[:, 0].float()
+        if event_index >= decoding_start:
+            # offset of the inpainted region
+            elapsed_time = elapsed_time - h[:, 1].float() + h[:, 2].float()
+        return elapsed_time, h
+
     def postprocess(self, x, decoding_end, metadata_dict):
         decoding_start = metadata_dict['decoding_start']
         # put all pieces in order:
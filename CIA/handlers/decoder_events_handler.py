@@ -1,11 +1,12 @@
 from CIA.handlers.handler import Handler
+from CIA.handlers.state_cache import expand_states
 from CIA.dataloaders.dataloader import DataloaderGenerator
-from CIA.utils import all_reduce_scalar, is_main_process, to_numpy, \
-    top_k_top_p_filtering
+from CIA.model.freeze import freeze_for_inference
+from CIA.utils import all_reduce_scalar, is_main_process, \
+    top_k_top_p_sampling
 import torch
 from tqdm import tqdm
 from itertools import islice
-import numpy as np
 from torch.nn.parallel import DistributedDataParallel
 import torch.distributed as dist
 
@@ -17,17 +18,150 @@ class DecoderEventsHandler(Handler):
         super().__init__(model=model,
                          model_dir=model_dir,
                          dataloader_generator=dataloader_generator)
+        # PrefixStateCache used by prefill, disabled if None
+        self.state_cache = None
 
     # --- EventsHandler-specific wrappers
     def event_state_to_weight_step(self, output, target_embedded,
                                    channel_index):
-        return self.model.module.event_state_to_weight_step(
+        return self.module.event_state_to_weight_step(
             output, target_embedded, channel_index)
 
-    def compute_event_state(self, target, metadata_dict):
-        return self.model.module.compute_event_state(target,
-                                                     metadata_dict,
-                                                     h_pe_init=None)
+    def compute_event_state(self, target, metadata_dict, event_index=None):
+        return self.module.compute_event_state(target,
+                                               metadata_dict,
+                                               h_pe_init=None,
+                                               event_index=event_index)
+
+    def infer_hidden_states(self,
+                            target,
+                            metadata_dict,
+                            decoding_start,
+                            states=None,
+                            start_event=0):
+        return self.module.infer_hidden_states(target,
+                                               metadata_dict,
+                                               decoding_start,
+                                               states=states,
+                                               start_event=start_event)
+
+    def recurrent_step(self, target, metadata_dict, states, event_index):
+        return self.module.recurrent_step(target, metadata_dict, states,
+                                          event_index)
+
+    def recurrent_step_group(self, steps):
+        return self.module.recurrent_step_group(steps)
+
+    def freeze_for_inference(self, target, metadata_dict, ff_chunks=1,
+                             atol=1e-4):
+        """Freezes the model for inference (see CIA.model.freeze), in place,
+        and checks that the frozen model predicts the same weights_per_category
+        as the original one on (target, metadata_dict)
+
+        Inference only, must be called after load;
+        the model is no longer wrapped in DistributedDataParallel
+        and can no longer be saved
+        returns the maximum absolute difference of the weights_per_category
+        """
+        def weights_per_category():
+            output, target_embedded, _ = self.compute_event_state(
+                target, metadata_dict)
+            return self.module.event_state_to_weights(
+                output=output, target_embedded=target_embedded)
+
+        self.eval()
+        with torch.no_grad():
+            expected = weights_per_category()
+            self.model = freeze_for_inference(self.module,
+                                              ff_chunks=ff_chunks)
+            self._frozen = True
+            weights = weights_per_category()
+        error = max((weight - expected_weight).abs().max().item()
+                    for weight, expected_weight in zip(weights, expected))
+        assert error <= atol, \
+            f'frozen model differs from the original model ({error} > {atol})'
+        return error
+
+    def prefill(self, target, metadata_dict, decoding_start):
+        """infer_hidden_states using self.state_cache:
+        resumes from the states of the longest cached prefix of the context
+        and only processes the remaining events, by chunks ending at multiples
+        of state_cache.checkpoint_interval which are added to the cache
+
+        The cache is only used when all rows share the same context
+        (e.g. proposals of the same request).
+        """
+        chunks = self.prefill_iterator(target, metadata_dict, decoding_start)
+        while True:
+            try:
+                next(chunks)
+            except StopIteration as stop:
+                return stop.value
+
+    def prefill_iterator(self,
+                         target,
+                         metadata_dict,
+                         decoding_start,
+                         chunk_size=None):
+        """Generator version of prefill, processing the context
+        by chunks of at most chunk_size events (if not None)
+
+        yields the number of events processed after each chunk but the last one,
+        so that the caller can interleave other computations (e.g. decoding steps);
+        returns the outputs of prefill
+        """
+        batch_size = target.size(0)
+        placeholder_duration = metadata_dict['placeholder_duration']
+        use_cache = (self.state_cache is not None
+                     and (target[:, :decoding_start] ==
+                          target[:1, :decoding_start]).all()
+                     and (placeholder_duration == placeholder_duration[:1]).all())
+
+        length, output, states = 0, None, None
+        checkpoints = set()
+        if use_cache:
+            # compute on the first row only
+            target = target[:1]
+            metadata_dict = {
+                k: (v[:1] if torch.is_tensor(v) and v.dim() > 0
+                    and v.size(0) == batch_size else v)
+                for k, v in metadata_dict.items()
+            }
+            context = (decoding_start, placeholder_duration[0].item())
+            tokens = [
+                tuple(event) for event in target[0, :decoding_start].tolist()
+            ]
+            length, value = self.state_cache.match(context, tokens)
+            if value is not None:
+                output, states = value
+            interval = self.state_cache.checkpoint_interval
+            checkpoints = {
+                n
+                for n in range(interval, decoding_start, interval) if n > length
+            }
+
+        # ends of the chunks
+        ends = set(checkpoints)
+        if chunk_size is not None:
+            ends.update(range(length + chunk_size, decoding_start, chunk_size))
+        if length < decoding_start:
+            ends.add(decoding_start)
+        for n in sorted(ends):
+            output, states = self.infer_hidden_states(
+                target=target,
+                metadata_dict=metadata_dict,
+                decoding_start=n,
+                states=states,
+                start_event=0 if states is None else length + 1)
+            if use_cache and (n in checkpoints or n == decoding_start):
+                self.state_cache.insert(context, tokens[:n], (output, states))
+            length = n
+            if n < decoding_start:
+                yield n
+
+        if use_cache:
+            return expand_states((output, states), batch_size)
+        return output, states
 
     # ==== Training methods
 
@@ -87,6 +221,56 @@ class DecoderEventsHandler(Handler):
 
         return means
 
+    def sample_event(self, x, output, event_index, done, temperature, top_p,
+                     top_k):
+        """Samples all channels of event event_index auto-regressively
+        from its event_state output and writes them in x
+
+        done (batch_size,): rows already finished are left untouched
+        temperature, top_p and top_k can be scalars or tensors of shape (batch_size,)
+        returns end_sampled (batch_size,): True for rows which sampled an END symbol
+        """
+        end_sampled = torch.zeros_like(done)
+        # embeddings of the channels of the current event,
+        # filled channel by channel as they are sampled
+        target_embedded = output.new_zeros(x.size(0), self.num_channels_target,
+                                           self.data_processor.embedding_size)
+        for channel_index in range(self.num_channels_target):
+            weights = self.event_state_to_weight_step(output, target_embedded,
+                                                      channel_index)
+            new_tokens = top_k_top_p_sampling(weights,
+                                              temperature=temperature,
+                                              top_k=top_k,
+                                              top_p=top_p)
+
+            # update generated sequence
+            # rows ending during this event stop sampling their next channels
+            active = ~(done | end_sampled)
+            x[:, event_index, channel_index] = torch.where(
+                active, new_tokens, x[:, event_index, channel_index])
+            end_sampled = end_sampled | (
+                active & (new_tokens == self.end_tokens[channel_index]))
+
+            # only embed the newly sampled token
+            if channel_index < self.num_channels_target - 1:
+                target_embedded[:, channel_index] = self.data_processor.embed_step(
+                    x[:, event_index, channel_index], channel_index)
+        return end_sampled
+
+    def generation_outputs(self, x, decoding_start_event, decoding_end, done,
+                           num_events):
+        """Per row outputs of inpaint
+        """
+        decoding_end, done = self.decoding_end_to_list(decoding_end, done,
+                                                       num_events)
+        num_event_generated = [end - decoding_start_event for end in decoding_end]
+        generated_region = [
+            x_row[decoding_start_event:end]
+            for x_row, end in zip(x, decoding_end)
+        ]
+        # TODO return everything on GPU
+        return x.cpu(), generated_region, decoding_end, num_event_generated, done
+
     def inpaint_non_optimized(self,
                               x,
                               metadata_dict,
@@ -95,15 +279,19 @@ class DecoderEventsHandler(Handler):
                               top_k=0,
                               num_max_generated_events=None
                               ):
+        """Generates batch_size proposals in parallel,
+        each row stops at its own END symbol
+
+        generated_region, decoding_end, num_event_generated and done
+        are lists with one entry per row
+        """
         # TODO add arguments to preprocess
         print(f'Placeholder duration: {metadata_dict["placeholder_duration"]}')
         self.eval()
         batch_size, num_events, _ = x.size()
 
-        # TODO only works with batch_size=1 at present
-        assert x.size(0) == 1
-
-        decoding_end = None
+        decoding_end = torch.zeros(batch_size, dtype=torch.long, device=x.device)
+        done = torch.zeros(batch_size, dtype=torch.bool, device=x.device)
         decoding_start_event = metadata_dict['decoding_start']
         x[:, decoding_start_event:] = 0
         
@@ -117,218 +305,103 @@ class DecoderEventsHandler(Handler):
 
                 # output is used to generate auto-regressively all
                 # channels of an event
+                # events after event_index are not needed (causal model)
                 output, target_embedded, h_pe = self.compute_event_state(
                     target=x,
                     metadata_dict=metadata_dict,
+                    event_index=event_index,
                 )
 
                 # extract correct event_step
                 output = output[:, event_index]
 
-                for channel_index in range(self.num_channels_target):
-                    # target_embedded must be recomputed!
-                    # TODO could be optimized
-                    target_embedded = self.data_processor.embed(x)[:,
-                                                                   event_index]
-                    weights = self.event_state_to_weight_step(
-                        output, target_embedded, channel_index)
-                    logits = weights / temperature
-
-                    filtered_logits = []
-                    for logit in logits:
-                        filter_logit = top_k_top_p_filtering(logit,
-                                                             top_k=top_k,
-                                                             top_p=top_p)
-                        filtered_logits.append(filter_logit)
-                    filtered_logits = torch.stack(filtered_logits, dim=0)
-                    # Sample from the filtered distribution
-                    p = to_numpy(torch.softmax(filtered_logits, dim=-1))
-
-                    # update generated sequence
-                    for batch_index in range(batch_size):
-                        if event_index >= decoding_start_event:
-                            new_pitch_index = np.random.choice(
-                                np.arange(self.num_tokens_per_channel_target[
-                                    channel_index]),
-                                p=p[batch_index])
-                            x[batch_index, event_index,
-                              channel_index] = int(new_pitch_index)
-
-                            end_symbol_index = self.dataloader_generator.dataset.value2index[
-                                self.dataloader_generator.
-                                features[channel_index]]['END']
-                            if end_symbol_index == int(new_pitch_index):
-                                decoding_end = event_index
-
-                    if decoding_end is not None:
-                        break
-                if decoding_end is not None:
+                end_sampled = self.sample_event(x, output, event_index, done,
+                                                temperature, top_p, top_k)
+                decoding_end, done = self.update_decoding_end(
+                    decoding_end, done, end_sampled, event_index)
+                if done.all():
                     break
-            if decoding_end is None:
-                done = False
-                decoding_end = num_events
-            else:
-                done = True
-
-        num_event_generated = decoding_end - decoding_start_event
-
-        generated_region = x[:, decoding_start_event:decoding_end]
-        # TODO return everything on GPU
-        return x.cpu(), generated_region, decoding_end, num_event_generated, done
 
-    def inpaint(self, x, metadata_dict, temperature=1., top_p=1., top_k=0):
+        return self.generation_outputs(x, decoding_start_event, decoding_end,
+                                       done, num_events)
+
+    def inpaint(self,
+                x,
+                metadata_dict,
+                temperature=1.,
+                top_p=1.,
+                top_k=0,
+                num_max_generated_events=None):
+        """Same as inpaint_non_optimized, but the transformer pass over the
+        context is done only once (prefill) and the attention
+        states are then updated event by event (recurrent_step)
+        """
+        events = self.inpaint_iterator(
+            x,
+            metadata_dict,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            num_max_generated_events=num_max_generated_events)
+        while True:
+            try:
+                next(events)
+            except StopIteration as stop:
+                return stop.value
+
+    def inpaint_iterator(self,
+                         x,
+                         metadata_dict,
+                         temperature=1.,
+                         top_p=1.,
+                         top_k=0,
+                         num_max_generated_events=None):
+        """Generator version of inpaint, used to stream the generated events
+
+        yields (event_index, generated) as soon as event event_index is sampled,
+        generated (batch_size,) is True for the rows where x[:, event_index]
+        is a new event (not finished and no END symbol sampled);
+        returns the outputs of inpaint
+        """
         # TODO add arguments to preprocess
         print(f'Placeholder duration: {metadata_dict["placeholder_duration"]}')
         self.eval()
         batch_size, num_events, _ = x.size()
 
-        # TODO only works with batch_size=1 at present
-        assert x.size(0) == 1
-
-        decoding_end = None
+        decoding_end = torch.zeros(batch_size, dtype=torch.long, device=x.device)
+        done = torch.zeros(batch_size, dtype=torch.bool, device=x.device)
         decoding_start_event = metadata_dict['decoding_start']
         x[:, decoding_start_event:] = 0
+
+        if num_max_generated_events is not None:
+            num_events = min(decoding_start_event + num_max_generated_events,
+                             num_events)
         with torch.no_grad():
+            metadata_dict['original_sequence'] = x
+            # prefill: event_state for decoding_start_event and
+            # states of the whole context
+            output, states = self.prefill(
+                target=x,
+                metadata_dict=metadata_dict,
+                decoding_start=decoding_start_event)
+
             # event_index corresponds to the position of the token BEING generated
             for event_index in range(decoding_start_event, num_events):
-                metadata_dict['original_sequence'] = x
-
-                # output is used to generate auto-regressively all
-                # channels of an event
-                output, target_embedded, h_pe = self.compute_event_state(
-                    target=x,
-                    metadata_dict=metadata_dict,
-                )
-
-                # extract correct event_step
-                output = output[:, event_index]
-
-                for channel_index in range(self.num_channels_target):
-                    # target_embedded must be recomputed!
-                    # TODO could be optimized
-                    target_embedded = self.data_processor.embed(x)[:,
-                                                                   event_index]
-                    weights = self.event_state_to_weight_step(
-                        output, target_embedded, channel_index)
-                    logits = weights / temperature
-
-                    filtered_logits = []
-                    for logit in logits:
-                        filter_logit = top_k_top_p_filtering(logit,
-                                                             top_k=top_k,
-                                                             top_p=top_p)
-                        filtered_logits.append(filter_logit)
-                    filtered_logits = torch.stack(filtered_logits, dim=0)
-                    # Sample from the filtered distribution
-                    p = to_numpy(torch.softmax(filtered_logits, dim=-1))
-
-                    # update generated sequence
-                    for batch_index in range(batch_size):
-                        if event_index >= decoding_start_event:
-                            new_pitch_index = np.random.choice(
-                                np.arange(self.num_tokens_per_channel_target[
-                                    channel_index]),
-                                p=p[batch_index])
-                            x[batch_index, event_index,
-                              channel_index] = int(new_pitch_index)
-
-                            end_symbol_index = self.dataloader_generator.dataset.value2index[
-                                self.dataloader_generator.
-                                features[channel_index]]['END']
-                            if end_symbol_index == int(new_pitch_index):
-                                decoding_end = event_index
-
-                    if decoding_end is not None:
-                        break
-                if decoding_end is not None:
+                if event_index > decoding_start_event:
+                    output, states = self.recurrent_step(
+                        target=x,
+                        metadata_dict=metadata_dict,
+                        states=states,
+                        event_index=event_index)
+
+                end_sampled = self.sample_event(x, output, event_index, done,
+                                                temperature, top_p, top_k)
+                generated = ~(done | end_sampled)
+                decoding_end, done = self.update_decoding_end(
+                    decoding_end, done, end_sampled, event_index)
+                yield event_index, generated
+                if done.all():
                     break
-            if decoding_end is None:
-                done = False
-                decoding_end = num_events
-            else:
-                done = True
-
-        num_event_generated = decoding_end - decoding_start_event
-        return x.cpu(), decoding_end, num_event_generated, done
-
-    # def inpaint(self, x, metadata_dict, temperature=1., top_p=1., top_k=0):
-    #     # TODO add arguments to preprocess
-    #     print(f'Placeholder duration: {metadata_dict["placeholder_duration"]}')
-    #     self.eval()
-    #     batch_size, num_events, _ = x.size()
-
-    #     # TODO only works with batch_size=1 at present
-    #     assert x.size(0) == 1
-
-    #     decoding_end = None
-    #     decoding_start_event = metadata_dict['decoding_start']
-    #     decoding_start_index = decoding_start_event * self.num_channels_target
-    #     x[:, decoding_start_event:] = 0  # ensure we don't cheat!
-
-    #     # get hidden states
-    #     metadata_dict['original_sequence'] = x
-    #     out = self.model.module.infer_hidden_states(x, metadata_dict,
-    #                                                 decoding_start_index)
-    #     states = dict(Zs=out['Zs'],
-    #                   Ss=out['Ss'],
-    #                   Zs_rot=out['Zs_rot'],
-    #                   Ss_rot=out['Ss_rot'])
-
-    #     # TODO(Leo): MUST ADD original_token to metadata_dict, otherwise, positional encodings are not computed properly
-    #     with torch.no_grad():
-    #         # i corresponds to the position of the token BEING generated
-    #         for event_index in range(decoding_start_event, num_events):
-    #             for channel_index in range(self.num_channels_target):
-
-    #                 metadata_dict['original_sequence'] = x
-
-    #                 decoding_index = event_index * self.num_channels_target + channel_index
-    #                 if decoding_index == decoding_start_index:
-    #                     # no need to recompute this one already inferred with states
-    #                     weights = out['weights']
-    #                 else:
-    #                     forward_pass = self.recurrent_step(
-    #                         target=x,
-    #                         metadata_dict=metadata_dict,
-    #                         states=states,
-    #                         decoding_index=decoding_index)
-    #                     weights = forward_pass['weights']
-
-    #                 logits = weights / temperature
-
-    #                 filtered_logits = []
-    #                 for logit in logits:
-    #                     filter_logit = top_k_top_p_filtering(logit,
-    #                                                          top_k=top_k,
-    #                                                          top_p=top_p)
-    #                     filtered_logits.append(filter_logit)
-    #                 filtered_logits = torch.stack(filtered_logits, dim=0)
-    #                 # Sample from the filtered distribution
-    #                 p = to_numpy(torch.softmax(filtered_logits, dim=-1))
-
-    #                 # update generated sequence
-    #                 for batch_index in range(batch_size):
-    #                     if event_index >= decoding_start_event:
-    #                         new_pitch_index = np.random.choice(
-    #                             np.arange(self.num_tokens_per_channel_target[
-    #                                 channel_index]),
-    #                             p=p[batch_index])
-    #                         x[batch_index, event_index,
-    #                           channel_index] = int(new_pitch_index)
-
-    #                         end_symbol_index = self.dataloader_generator.dataset.value2index[
-    #                             self.dataloader_generator.
-    #                             features[channel_index]]['END']
-    #                         if end_symbol_index == int(new_pitch_index):
-    #                             decoding_end = event_index
-
-    #             if decoding_end is not None:
-    #                 break
-    #     if decoding_end is None:
-    #         done = False
-    #         decoding_end = num_events
-    #     else:
-    #         done = True
-
-    #     num_event_generated = decoding_end - decoding_start_event
-    #     return x.cpu(), decoding_end, num_event_generated, done
+
+        return self.generation_outputs(x, decoding_start_event, decoding_end,
+                                       done, num_events)
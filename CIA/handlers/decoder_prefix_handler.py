@@ -1,11 +1,10 @@
 from CIA.handlers.handler import Handler
 from CIA.dataloaders.dataloader import DataloaderGenerator
-from CIA.utils import all_reduce_scalar, is_main_process, to_numpy, \
-    top_k_top_p_filtering
+from CIA.utils import all_reduce_scalar, get_device, is_main_process, \
+    top_k_top_p_sampling
 import torch
 from tqdm import tqdm
 from itertools import islice
-import numpy as np
 from torch.nn.parallel import DistributedDataParallel
 import torch.distributed as dist
 
@@ -26,7 +25,7 @@ class DecoderPrefixHandler(Handler):
                 self.writer.add_scalar(f'{k}/val', v, epoch_id)
 
     def load(self, early_stopped, recurrent):
-        map_location = {'cuda:0': f'cuda:{dist.get_rank()}'}
+        map_location = {'cuda:0': str(get_device())}
         print(f'Loading models {self.__repr__()}')
         if early_stopped:
             print('Load early stopped model')
@@ -47,10 +46,7 @@ class DecoderPrefixHandler(Handler):
         #                 'transformer.transformer', 'transformer.transformer_with_states')
         #             transformer_with_states_dict[new_key] = v
         #     state_dict.update(transformer_with_states_dict)
-        self.model.load_state_dict(
-            state_dict=state_dict,
-            # strict=False
-        )
+        self.load_state_dict(state_dict)
 
     # ==== Training methods
 
@@ -111,21 +107,68 @@ class DecoderPrefixHandler(Handler):
 
         return means
 
-    def inpaint_non_optimized(self, x, metadata_dict, temperature=1., top_p=1., top_k=0):
+    def sample_token(self, x, weights, event_index, channel_index, done,
+                     end_sampled, temperature, top_p, top_k):
+        """Samples channel channel_index of event event_index from weights
+        and writes it in x
+
+        done (batch_size,): rows already finished are left untouched, as well as
+        the rows with end_sampled (END symbol sampled earlier in this event)
+        temperature, top_p and top_k can be scalars or tensors of shape (batch_size,)
+        returns the updated end_sampled
+        """
+        new_tokens = top_k_top_p_sampling(weights,
+                                          temperature=temperature,
+                                          top_k=top_k,
+                                          top_p=top_p)
+
+        # update generated sequence
+        active = ~(done | end_sampled)
+        x[:, event_index, channel_index] = torch.where(
+            active, new_tokens, x[:, event_index, channel_index])
+        return end_sampled | (active &
+                              (new_tokens == self.end_tokens[channel_index]))
+
+    def generation_outputs(self, x, decoding_start_event, decoding_end, done,
+                           num_events):
+        """Per row outputs of inpaint
+        """
+        decoding_end, done = self.decoding_end_to_list(decoding_end, done,
+                                                       num_events)
+        num_event_generated = [end - decoding_start_event for end in decoding_end]
+        return x.cpu(), decoding_end, num_event_generated, done
+
+    def inpaint_non_optimized(self,
+                              x,
+                              metadata_dict,
+                              temperature=1.,
+                              top_p=1.,
+                              top_k=0,
+                              num_max_generated_events=None):
+        """Generates batch_size proposals in parallel,
+        each row stops at its own END symbol
+
+        decoding_end, num_event_generated and done
+        are lists with one entry per row
+        """
         # TODO add arguments to preprocess
         print(f'Placeholder duration: {metadata_dict["placeholder_duration"]}')
         self.eval()
         batch_size, num_events, _ = x.size()
 
-        # TODO only works with batch_size=1 at present
-        assert x.size(0) == 1
-
-        decoding_end = None
+        decoding_end = torch.zeros(batch_size, dtype=torch.long, device=x.device)
+        done = torch.zeros(batch_size, dtype=torch.bool, device=x.device)
         decoding_start_event = metadata_dict['decoding_start']
         x[:, decoding_start_event:] = 0
+
+        if num_max_generated_events is not None:
+            num_events = min(decoding_start_event + num_max_generated_events,
+                             num_events)
         with torch.no_grad():
             # i corresponds to the position of the token BEING generated
             for event_index in range(decoding_start_event, num_events):
+                # rows ending during this event stop sampling their next channels
+                end_sampled = torch.zeros_like(done)
                 for channel_index in range(self.num_channels_target):
 
                     metadata_dict['original_sequence'] = x
@@ -138,68 +181,55 @@ class DecoderPrefixHandler(Handler):
                         decoding_index=decoding_index)
                     weights = forward_pass['weights']
 
-                    logits = weights / temperature
-
-                    filtered_logits = []
-                    for logit in logits:
-                        filter_logit = top_k_top_p_filtering(logit,
-                                                             top_k=top_k,
-                                                             top_p=top_p)
-                        filtered_logits.append(filter_logit)
-                    filtered_logits = torch.stack(filtered_logits, dim=0)
-                    # Sample from the filtered distribution
-                    p = to_numpy(torch.softmax(filtered_logits, dim=-1))
-
-                    # update generated sequence
-                    for batch_index in range(batch_size):
-                        if event_index >= decoding_start_event:
-                            new_pitch_index = np.random.choice(np.arange(
-                                self.num_tokens_per_channel_target[channel_index]),
-                                p=p[batch_index])
-                            x[batch_index, event_index, channel_index] = int(
-                                new_pitch_index)
-
-                            end_symbol_index = self.dataloader_generator.dataset.value2index[
-                                self.dataloader_generator.features[channel_index]]['END']
-                            if end_symbol_index == int(new_pitch_index):
-                                decoding_end = event_index
-
-                if decoding_end is not None:
-                    break
-        if decoding_end is None:
-            done = False
-            decoding_end = num_events
-        else:
-            done = True
+                    end_sampled = self.sample_token(
+                        x, weights, event_index, channel_index, done,
+                        end_sampled, temperature, top_p, top_k)
 
-        num_event_generated = decoding_end - decoding_start_event
-        return x.cpu(), decoding_end, num_event_generated, done
+                decoding_end, done = self.update_decoding_end(
+                    decoding_end, done, end_sampled, event_index)
+                if done.all():
+                    break
 
-    def inpaint(self, x, metadata_dict, temperature=1., top_p=1., top_k=0):
+        return self.generation_outputs(x, decoding_start_event, decoding_end,
+                                       done, num_events)
+
+    def inpaint(self,
+                x,
+                metadata_dict,
+                temperature=1.,
+                top_p=1.,
+                top_k=0,
+                num_max_generated_events=None):
+        """Same as inpaint_non_optimized, but the transformer pass over the
+        context is done only once (infer_hidden_states) and the attention
+        states are then updated token by token (recurrent_step)
+        """
         # TODO add arguments to preprocess
         print(f'Placeholder duration: {metadata_dict["placeholder_duration"]}')
         self.eval()
         batch_size, num_events, _ = x.size()
 
-        # TODO only works with batch_size=1 at present
-        assert x.size(0) == 1
-
-        decoding_end = None
+        decoding_end = torch.zeros(batch_size, dtype=torch.long, device=x.device)
+        done = torch.zeros(batch_size, dtype=torch.bool, device=x.device)
         decoding_start_event = metadata_dict['decoding_start']
         decoding_start_index = decoding_start_event * self.num_channels_target
         x[:, decoding_start_event:] = 0  # ensure we don't cheat!
 
-        # get hidden states
-        metadata_dict['original_sequence'] = x
-        out = self.model.module.infer_hidden_states(
-            x, metadata_dict, decoding_start_index)
-        states = dict(Zs=out['Zs'], Ss=out['Ss'],
-                      Zs_rot=out['Zs_rot'], Ss_rot=out['Ss_rot'])
+        if num_max_generated_events is not None:
+            num_events = min(decoding_start_event + num_max_generated_events,
+                             num_events)
 
-        # TODO(Leo): MUST ADD original_token to metadata_dict, otherwise, positional encodings are not computed properly
         with torch.no_grad():
+            # get hidden states
+            metadata_dict['original_sequence'] = x
+            out = self.module.infer_hidden_states(
+                x, metadata_dict, decoding_start_index)
+            states = out['states']
+
+            # TODO(Leo): MUST ADD original_token to metadata_dict, otherwise, positional encodings are not computed properly
             # i corresponds to the position of the token BEING generated
             for event_index in range(decoding_start_event, num_events):
+                end_sampled = torch.zeros_like(done)
                 for channel_index in range(self.num_channels_target):
 
                     metadata_dict['original_sequence'] = x
@@ -215,40 +245,16 @@ class DecoderPrefixHandler(Handler):
                             states=states,
                             decoding_index=decoding_index)
                         weights = forward_pass['weights']
+                        states = forward_pass['states']
 
-                    logits = weights / temperature
-
-                    filtered_logits = []
-                    for logit in logits:
-                        filter_logit = top_k_top_p_filtering(logit,
-                                                             top_k=top_k,
-                                                             top_p=top_p)
-                        filtered_logits.append(filter_logit)
-                    filtered_logits = torch.stack(filtered_logits, dim=0)
-                    # Sample from the filtered distribution
-                    p = to_numpy(torch.softmax(filtered_logits, dim=-1))
-
-                    # update generated sequence
-                    for batch_index in range(batch_size):
-                        if event_index >= decoding_start_event:
-                            new_pitch_index = np.random.choice(np.arange(
-                                self.num_tokens_per_channel_target[channel_index]),
-                                p=p[batch_index])
-                            x[batch_index, event_index, channel_index] = int(
-                                new_pitch_index)
-
-                            end_symbol_index = self.dataloader_generator.dataset.value2index[
-                                self.dataloader_generator.features[channel_index]]['END']
-                            if end_symbol_index == int(new_pitch_index):
-                                decoding_end = event_index
-
-                if decoding_end is not None:
+                    end_sampled = self.sample_token(
+                        x, weights, event_index, channel_index, done,
+                        end_sampled, temperature, top_p, top_k)
+
+                decoding_end, done = self.update_decoding_end(
+                    decoding_end, done, end_sampled, event_index)
+                if done.all():
                     break
-        if decoding_end is None:
-            done = False
-            decoding_end = num_events
-        else:
-            done = True
 
-        num_event_generated = decoding_end - decoding_start_event
-        return x.cpu(), decoding_end, num_event_generated, done
+        return self.generation_outputs(x, decoding_start_event, decoding_end,
+                                       done, num_events)
@@ -1,7 +1,8 @@
 from CIA.dataloaders.dataloader import DataloaderGenerator
-from CIA.utils import display_monitored_quantities, is_main_process
+from CIA.utils import display_monitored_quantities, get_device, is_main_process
 import torch
 import os
+from torch import nn
 from torch.nn.parallel import DistributedDataParallel
 from torch.utils.tensorboard import SummaryWriter
 import torch.distributed as dist
@@ -17,6 +18,11 @@ class Handler:
         # optim
         self.optimizer = None
         self.scheduler = None
+        # lazily computed, see end_tokens
+        self._end_tokens = None
+        # set by freeze_for_inference: the state_dict of a frozen model
+        # must not be saved
+        self._frozen = False
 
     def init_optimizers(self, lr=1e-3):
         # self.optimizer = torch.optim.Adam(list(self.parameters()), lr=lr)
@@ -24,16 +30,25 @@ class Handler:
                                            lr=lr,
                                            weight_decay=1e-3)
 
+    @property
+    def module(self):
+        """The model without its DistributedDataParallel wrapper
+        (models used for CPU-only inference are not wrapped)
+        """
+        if isinstance(self.model, DistributedDataParallel):
+            return self.model.module
+        return self.model
+
     # ==== Wrappers
     def forward(self, target, metadata_dict):
         return self.model.forward(target, metadata_dict)
 
     def forward_step(self, target, metadata_dict, decoding_index):
-        return self.model.module.forward_step(
+        return self.module.forward_step(
             target, metadata_dict, decoding_index)
 
     def recurrent_step(self, target, metadata_dict, states, decoding_index):
-        return self.model.module.recurrent_step(target, metadata_dict, states, decoding_index)
+        return self.module.recurrent_step(target, metadata_dict, states, decoding_index)
 
     def train(self):
         self.model.train()
@@ -44,30 +59,76 @@ class Handler:
     def parameters(self):
         return self.model.parameters()
 
+    def quantize(self):
+        """Converts the nn.Linear layers of the model
+        (attention projections, feedforwards, pre_softmaxes...)
+        to dynamically quantized int8 layers, in place
+
+        Inference only, on CPU; must be called after load
+        """
+        assert not isinstance(self.model, DistributedDataParallel), \
+            'quantized inference is only implemented on CPU'
+        torch.quantization.quantize_dynamic(self.model, {nn.Linear},
+                                            dtype=torch.qint8,
+                                            inplace=True)
+
     # expose useful attributes for generation
     @property
     def recurrent(self):
-        return self.model.module.recurrent
+        return self.module.recurrent
 
     @property
     def num_tokens_per_channel_target(self):
-        return self.model.module.data_processor.num_tokens_per_channel
+        return self.module.data_processor.num_tokens_per_channel
 
     @property
     def num_channels_target(self):
-        return self.model.module.data_processor.num_channels
+        return self.module.data_processor.num_channels
 
     @property
     def data_processor(self):
-        return self.model.module.data_processor
+        return self.module.data_processor
+
+    # ==== Generation helpers
+    @property
+    def end_tokens(self):
+        """Index of the END symbol of each channel, on the model device
+        """
+        if self._end_tokens is None:
+            self._end_tokens = torch.tensor([
+                self.dataloader_generator.dataset.value2index[feature]['END']
+                for feature in self.dataloader_generator.features
+            ], device=next(self.model.parameters()).device)
+        return self._end_tokens
+
+    @staticmethod
+    def update_decoding_end(decoding_end, done, end_sampled, event_index):
+        """Sets the decoding_end of the rows which have just sampled an END symbol
+
+        decoding_end (batch_size,), done and end_sampled (batch_size,) booleans
+        returns the updated decoding_end and done
+        """
+        decoding_end = decoding_end.masked_fill(end_sampled & ~done,
+                                                event_index)
+        return decoding_end, done | end_sampled
+
+    @staticmethod
+    def decoding_end_to_list(decoding_end, done, num_events):
+        """Rows without END were generated up to num_events
+
+        returns decoding_end and done as lists
+        """
+        return decoding_end.masked_fill(~done, num_events).tolist(), done.tolist()
 
     # ==== Save and Load methods
     def __repr__(self):
-        return self.model.module.__repr__()
+        return self.module.__repr__()
 
     def save(self, early_stopped):
+        assert not self._frozen, \
+            'models frozen for inference must not be saved'
         # Only save on process 0
-        if dist.get_rank() == 0:
+        if is_main_process():
             # This saves also the encoder
             if early_stopped:
                 model_dir = f'{self.model_dir}/early_stopped'
@@ -76,10 +137,11 @@ class Handler:
             if not os.path.exists(model_dir):
                 os.makedirs(model_dir)
             torch.save(self.model.state_dict(), f'{model_dir}/model')
-        dist.barrier()
+        if dist.is_initialized():
+            dist.barrier()
 
     def load(self, early_stopped):
-        map_location = {'cuda:0': f'cuda:{dist.get_rank()}'}
+        map_location = {'cuda:0': str(get_device())}
         print(f'Loading models {self.__repr__()}')
         if early_stopped:
             print('Load early stopped model')
@@ -91,9 +153,18 @@ class Handler:
         state_dict = torch.load(f'{model_dir}/model',
                                 map_location=map_location)
 
-        self.model.load_state_dict(
-            state_dict=state_dict
-        )
+        self.load_state_dict(state_dict)
+
+    def load_state_dict(self, state_dict):
+        """Loads a state_dict saved from a DistributedDataParallel model,
+        also if self.model is not wrapped
+        """
+        if not isinstance(self.model, DistributedDataParallel):
+            state_dict = {
+                (k[len('module.'):] if k.startswith('module.') else k): v
+                for k, v in state_dict.items()
+            }
+        self.model.load_state_dict(state_dict=state_dict)
 
     def plot(self, epoch_id, monitored_quantities_train,
              monitored_quantities_val) -> None:
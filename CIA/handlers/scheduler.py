@@ -0,0 +1,324 @@
+import queue
+import threading
+import traceback
+import torch
+
+
+class InpaintingRequest:
+    """Call to DecoderEventsHandler.inpaint processed by a
+    ContinuousBatchingScheduler
+
+    Each row of x is a slot of the running batch.
+    """
+    def __init__(self, x, metadata_dict, temperature, top_p, top_k,
+                 num_max_generated_events):
+        self.x = x
+        self.metadata_dict = metadata_dict
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.num_max_generated_events = num_max_generated_events
+
+        # generation state, set when the request joins the running batch
+        self.decoding_start = None
+        self.num_events = None
+        self.event_index = None
+        self.decoding_end = None
+        self.done = None
+        # generator of the chunked prefill, None once the prefill is done
+        self.prefill = None
+        self.output = None
+        self.states = None
+
+        self.outputs = None
+        self.error = None
+        self._events = queue.Queue()
+        self._finished = threading.Event()
+
+    @property
+    def batch_size(self):
+        return self.x.size(0)
+
+    def iter_events(self):
+        """Same as the values yielded by DecoderEventsHandler.inpaint_iterator
+        """
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            yield event
+
+    def wait(self):
+        """Blocks until the request is finished
+
+        returns the outputs of DecoderEventsHandler.inpaint
+        """
+        self._finished.wait()
+        if self.error is not None:
+            raise self.error
+        return self.outputs
+
+    def add_event(self, event_index, generated):
+        self._events.put((event_index, generated))
+
+    def finish(self, outputs=None, error=None):
+        self.outputs = outputs
+        self.error = error
+        self._events.put(None)
+        self._finished.set()
+
+
+class ContinuousBatchingScheduler:
+    """Runs the inpainting requests submitted from different threads
+    in a single running batch (iteration-level batching):
+    requests join the batch at the next event boundary and leave it
+    as soon as they are finished, without stalling the other ones.
+
+    Each request keeps its own x, metadata_dict (decoding_start, placeholder_duration),
+    sampling parameters and states; at each iteration, the transformer pass
+    (DecoderEventsHandler.recurrent_step_group) and the sampling
+    are done for all the slots at once.
+
+    The context of a new request is processed by chunks of prefill_chunk_size
+    events (DecoderEventsHandler.prefill_iterator), one chunk per iteration,
+    so that a new request does not stall the running ones for a whole prefill.
+    """
+    def __init__(self, handler, max_batch_size=16, prefill_chunk_size=128):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.prefill_chunk_size = prefill_chunk_size
+        self._waiting = queue.Queue()
+        # request which did not fit in the running batch
+        self._next_request = None
+        # requests being prefilled, first one first
+        self._prefilling = []
+        self._running = []
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def supports(handler):
+        """Whether the handler can be used by a ContinuousBatchingScheduler
+        (chunked prefill and grouped recurrent steps)
+        """
+        return (hasattr(handler, 'prefill_iterator')
+                and hasattr(handler.module, 'recurrent_step_group'))
+
+    def submit(self,
+               x,
+               metadata_dict,
+               temperature=1.,
+               top_p=1.,
+               top_k=0,
+               num_max_generated_events=None):
+        """Same arguments as DecoderEventsHandler.inpaint
+
+        returns the InpaintingRequest
+        """
+        request = InpaintingRequest(
+            x=x,
+            metadata_dict=metadata_dict,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            num_max_generated_events=num_max_generated_events)
+        self._waiting.put(request)
+        return request
+
+    def inpaint(self,
+                x,
+                metadata_dict,
+                temperature=1.,
+                top_p=1.,
+                top_k=0,
+                num_max_generated_events=None):
+        """Same as DecoderEventsHandler.inpaint
+        """
+        return self.submit(
+            x,
+            metadata_dict,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            num_max_generated_events=num_max_generated_events).wait()
+
+    def _loop(self):
+        self.handler.eval()
+        with torch.no_grad():
+            while True:
+                try:
+                    self._admit_requests()
+                    self._prefill_step()
+                    if len(self._running) > 0:
+                        self._step()
+                except Exception as e:
+                    traceback.print_exc()
+                    for request in self._running:
+                        request.finish(error=e)
+                    self._running = []
+
+    def _admit_requests(self):
+        """Requests join the batch if there is room
+        (waits for a request if there are none)
+        """
+        admitted = self._prefilling + self._running
+        num_slots = sum(request.batch_size for request in admitted)
+        while True:
+            if self._next_request is None:
+                try:
+                    self._next_request = self._waiting.get(
+                        block=len(admitted) == 0)
+                except queue.Empty:
+                    return
+            request = self._next_request
+            if (len(admitted) > 0 and
+                    num_slots + request.batch_size > self.max_batch_size):
+                return
+            self._next_request = None
+            try:
+                self._start(request)
+            except Exception as e:
+                traceback.print_exc()
+                request.finish(error=e)
+                continue
+            self._prefilling.append(request)
+            admitted.append(request)
+            num_slots += request.batch_size
+
+    def _start(self, request):
+        """Same initialization as in DecoderEventsHandler.inpaint_iterator
+        """
+        x, metadata_dict = request.x, request.metadata_dict
+        batch_size, num_events, _ = x.size()
+        request.decoding_end = torch.zeros(batch_size,
+                                           dtype=torch.long,
+                                           device=x.device)
+        request.done = torch.zeros(batch_size,
+                                   dtype=torch.bool,
+                                   device=x.device)
+        request.decoding_start = metadata_dict['decoding_start']
+        x[:, request.decoding_start:] = 0
+        if request.num_max_generated_events is not None:
+            num_events = min(
+                request.decoding_start + request.num_max_generated_events,
+                num_events)
+        request.num_events = num_events
+        request.event_index = request.decoding_start
+
+        metadata_dict['original_sequence'] = x
+        request.prefill = self.handler.prefill_iterator(
+            target=x,
+            metadata_dict=metadata_dict,
+            decoding_start=request.decoding_start,
+            chunk_size=self.prefill_chunk_size)
+
+    def _prefill_step(self):
+        """Processes one chunk of the context of the first request
+        being prefilled, which joins the running requests once its prefill is done
+        """
+        if len(self._prefilling) == 0:
+            return
+        request = self._prefilling[0]
+        try:
+            next(request.prefill)
+        except StopIteration as stop:
+            request.output, request.states = stop.value
+            request.prefill = None
+            self._prefilling.pop(0)
+            self._running.append(request)
+        except Exception as e:
+            traceback.print_exc()
+            self._prefilling.pop(0)
+            request.finish(error=e)
+
+    def _step(self):
+        """Generates one event for all the running requests
+
+        If this fails, the requests are stepped one by one
+        so that only the failing requests are dropped
+        """
+        running = self._running
+        try:
+            steps = self._sample_events(running)
+        except Exception:
+            traceback.print_exc()
+            steps = []
+            for request in running:
+                try:
+                    steps.extend(self._sample_events([request]))
+                except Exception as e:
+                    traceback.print_exc()
+                    request.finish(error=e)
+
+        self._running = []
+        for request, output, states, events, end_sampled in steps:
+            request.output, request.states = output, states
+            request.x[:, request.event_index] = events[:, 0]
+            generated = ~(request.done | end_sampled)
+            request.decoding_end, request.done = self.handler.update_decoding_end(
+                request.decoding_end, request.done, end_sampled,
+                request.event_index)
+            request.add_event(request.event_index, generated)
+            request.event_index += 1
+
+            # finished requests leave the running batch
+            if (request.done.all()
+                    or request.event_index == request.num_events):
+                try:
+                    outputs = self.handler.generation_outputs(
+                        request.x, request.decoding_start,
+                        request.decoding_end, request.done,
+                        request.num_events)
+                except Exception as e:
+                    traceback.print_exc()
+                    request.finish(error=e)
+                else:
+                    request.finish(outputs=outputs)
+            else:
+                self._running.append(request)
+
+    def _sample_events(self, requests):
+        """Transformer pass and sampling of the next event of requests,
+        without modifying them
+
+        returns a list of (request, output, states, events, end_sampled)
+        """
+        outputs = [request.output for request in requests]
+        states = [request.states for request in requests]
+        # event_states of the requests which are not at their first event
+        stepped = [
+            k for k, request in enumerate(requests)
+            if request.event_index > request.decoding_start
+        ]
+        if len(stepped) > 0:
+            results = self.handler.recurrent_step_group([
+                (requests[k].x, requests[k].metadata_dict, requests[k].states,
+                 requests[k].event_index) for k in stepped
+            ])
+            for k, (output, request_states) in zip(stepped, results):
+                outputs[k], states[k] = output, request_states
+
+        # sampling of the whole batch, slot parameters as tensors
+        def slot_parameter(name, dtype):
+            return torch.cat([
+                torch.as_tensor(getattr(request, name),
+                                dtype=dtype,
+                                device=request.x.device).expand(
+                                    request.batch_size)
+                for request in requests
+            ])
+
+        output = torch.cat(outputs, dim=0)
+        done = torch.cat([request.done for request in requests], dim=0)
+        temperature = slot_parameter('temperature', output.dtype)
+        top_p = slot_parameter('top_p', output.dtype)
+        top_k = slot_parameter('top_k', torch.long)
+        events = output.new_zeros(output.size(0), 1,
+                                  self.handler.num_channels_target).long()
+        end_sampled = self.handler.sample_event(events, output, 0, done,
+                                                temperature, top_p, top_k)
+
+        sizes = [request.batch_size for request in requests]
+        return list(
+            zip(requests, outputs, states, events.split(sizes),
+                end_sampled.split(sizes)))
@@ -0,0 +1,160 @@
+from collections import OrderedDict
+import threading
+import torch
+
+
+def states_num_bytes(value):
+    """Memory used by the tensors contained in value
+    (nested tuples, lists and dicts of tensors)
+    """
+    if torch.is_tensor(value):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sum(states_num_bytes(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(states_num_bytes(v) for v in value)
+    return 0
+
+
+def expand_states(value, batch_size):
+    """Broadcasts the tensors contained in value (computed for a single row)
+    to batch_size rows, without copy
+    """
+    if torch.is_tensor(value):
+        return value.expand(batch_size, *value.shape[1:])
+    if isinstance(value, dict):
+        return {k: expand_states(v, batch_size) for k, v in value.items()}
+    if isinstance(value, (tuple, list)):
+        return type(value)(expand_states(v, batch_size) for v in value)
+    return value
+
+
+class _Node:
+    """Node of the radix tree: edge is the sequence of tokens leading to this node
+    from its parent, value is None if no states are stored for this prefix
+    """
+    def __init__(self, edge, parent):
+        self.edge = edge
+        self.parent = parent
+        self.children = {}
+        self.value = None
+
+
+class PrefixStateCache:
+    """Radix tree over token prefixes storing the recurrent states
+    obtained after processing these prefixes, with LRU eviction
+    when the stored states exceed max_memory bytes
+
+    Prefixes are sequences of hashable tokens (events as tuples).
+    The context argument of match and insert separates the trees of prefixes
+    whose states also depend on something else than the tokens
+    (decoding_start, placeholder_duration...).
+
+    Only prefixes of length multiple of checkpoint_interval
+    (and the full contexts) are inserted by the handlers,
+    so that a request diverging from a cached context only recomputes
+    the tokens after the last common checkpoint.
+    """
+    def __init__(self, max_memory, checkpoint_interval=128):
+        self.max_memory = max_memory
+        self.checkpoint_interval = checkpoint_interval
+        self.memory = 0
+        self._roots = {}
+        # nodes with a value, least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def match(self, context, tokens):
+        """Longest prefix of tokens whose states are stored
+
+        :return: length of this prefix and its stored value,
+        (0, None) if there are none
+        """
+        with self._lock:
+            node = self._roots.get(context)
+            length, best = 0, None
+            position = 0
+            while node is not None:
+                if node.value is not None:
+                    length, best = position, node
+                if position == len(tokens):
+                    break
+                child = node.children.get(tokens[position])
+                if child is None or tuple(
+                        tokens[position:position + len(child.edge)]) != child.edge:
+                    break
+                position += len(child.edge)
+                node = child
+
+            if best is None:
+                return 0, None
+            self._entries.move_to_end(best)
+            return length, best.value
+
+    def insert(self, context, tokens, value):
+        """Stores value (states obtained after processing tokens)
+        and evicts the least recently used values if needed
+        """
+        tokens = tuple(tokens)
+        with self._lock:
+            if context not in self._roots:
+                self._roots[context] = _Node(edge=(), parent=None)
+            node = self._roots[context]
+            position = 0
+            while position < len(tokens):
+                child = node.children.get(tokens[position])
+                if child is None:
+                    child = _Node(edge=tokens[position:], parent=node)
+                    node.children[tokens[position]] = child
+                    node = child
+                    break
+                # length of the common part of the edge and the remaining tokens
+                common = 0
+                while (common < len(child.edge)
+                       and position + common < len(tokens)
+                       and child.edge[common] == tokens[position + common]):
+                    common += 1
+                if common < len(child.edge):
+                    # split edge
+                    middle = _Node(edge=child.edge[:common], parent=node)
+                    node.children[tokens[position]] = middle
+                    child.edge = child.edge[common:]
+                    child.parent = middle
+                    middle.children[child.edge[0]] = child
+                    child = middle
+                position += common
+                node = child
+
+            if node.value is not None:
+                self.memory -= self._entries.pop(node)
+            size = states_num_bytes(value)
+            node.value = value
+            self._entries[node] = size
+            self.memory += size
+
+            while self.memory > self.max_memory and len(self._entries) > 0:
+                self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._roots = {}
+            self._entries = OrderedDict()
+            self.memory = 0
+
+    def _evict(self):
+        node, size = self._entries.popitem(last=False)
+        self.memory -= size
+        node.value = None
+        # remove branches with no stored states left
+        while (node.parent is not None and node.value is None
+               and len(node.children) == 0):
+            del node.parent.children[node.edge[0]]
+            node = node.parent
+        if node.parent is None and len(node.children) == 0:
+            self._roots = {
+                context: root
+                for context, root in self._roots.items() if root is not node
+            }
@@ -0,0 +1,164 @@
+from collections import OrderedDict
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+
+class Job:
+    """Generation request processed by the workers of a JobQueue
+
+    status is 'queued', 'running', 'done' or 'error';
+    events contains the messages produced so far,
+    result the final message once the job is done
+    """
+    def __init__(self, payload):
+        self.id = uuid.uuid4().hex
+        self.payload = payload
+        self.status = 'queued'
+        self.events = []
+        self.result = None
+        self.error = None
+        self.finished_time = None
+        self._condition = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in ['done', 'error']
+
+    def add_event(self, event):
+        with self._condition:
+            self.events.append(event)
+            self._condition.notify_all()
+
+    def set_status(self, status, result=None, error=None):
+        with self._condition:
+            self.status = status
+            self.result = result
+            self.error = error
+            if self.finished:
+                self.finished_time = time.monotonic()
+            self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        """Blocks until the job is finished
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.finished, timeout=timeout)
+        return self.finished
+
+    def iter_events(self):
+        """Yields the events of the job as soon as they are produced,
+        until the job is finished
+        """
+        num_sent = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: len(self.events) > num_sent or self.finished)
+                events = self.events[num_sent:]
+                finished = self.finished
+            num_sent += len(events)
+            yield from events
+            if finished and num_sent == len(self.events):
+                return
+
+    def to_dict(self):
+        with self._condition:
+            return {
+                'id': self.id,
+                'status': self.status,
+                'events': list(self.events),
+                'result': self.result,
+                'error': self.error
+            }
+
+
+class JobQueue:
+    """Bounded queue of jobs processed by num_workers inference threads
+
+    run(payload) must be a generator yielding ('event', data) messages
+    and finally ('end', result).
+    submit raises queue.Full when max_queue_size jobs are already waiting.
+    Finished jobs are forgotten ttl seconds after they end,
+    once their result has been fetched (see pop),
+    or when more than max_jobs jobs are kept (the oldest finished jobs first).
+    """
+    def __init__(self,
+                 run,
+                 num_workers=1,
+                 max_queue_size=16,
+                 ttl=10 * 60,
+                 max_jobs=256):
+        self.run = run
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._workers = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, payload):
+        job = Job(payload)
+        self._queue.put_nowait(job)
+        with self._lock:
+            self._remove_expired()
+            self._jobs[job.id] = job
+            self._remove_oldest_finished()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._remove_expired()
+            return self._jobs.get(job_id)
+
+    def pop(self, job_id):
+        """Forgets a job, so that its result is no longer kept in memory
+        (to be called once the result has been sent to the client)
+        """
+        with self._lock:
+            return self._jobs.pop(job_id, None)
+
+    def _remove_expired(self):
+        # lock must be held
+        now = time.monotonic()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and now - job.finished_time > self.ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _remove_oldest_finished(self):
+        # lock must be held
+        num_removed = len(self._jobs) - self.max_jobs
+        if num_removed <= 0:
+            return
+        finished = sorted((job for job in self._jobs.values() if job.finished),
+                          key=lambda job: job.finished_time)
+        for job in finished[:num_removed]:
+            del self._jobs[job.id]
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.set_status('running')
+            try:
+                for kind, data in self.run(job.payload):
+                    if kind == 'event':
+                        job.add_event(data)
+                    else:
+                        job.set_status('done', result=data)
+            except Exception as e:
+                traceback.print_exc()
+                job.set_status('error', error=repr(e))
+            finally:
+                if not job.finished:
+                    job.set_status('error', error='no result')
+                self._queue.task_done()
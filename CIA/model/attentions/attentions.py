@@ -114,6 +114,9 @@ class Attention_(nn.Module):
         #                           )
         self.to_out = nn.Linear(inner_dim, output_dim, bias=attn_out_bias)
         self.dropout = nn.Dropout(dropout)
+        # single Linear replacing to_q, to_k, to_v and to_theta_q, see fuse_qkv_
+        self.to_qkv = None
+        self.qkv_split_sizes = None
 
         # positional encodings
         if layer_pe is not None:
@@ -169,13 +172,19 @@ class Attention_(nn.Module):
         context_mask = default(context_mask,
                                mask) if not cross_attend else context_mask
 
-        q = self.to_q(x)
-        k = self.to_k(context)
-        v = self.to_v(context)
-        if self.to_theta_q is not None:
-            theta_q = self.to_theta_q(x)
+        if self.to_qkv is not None:
+            assert not cross_attend, 'fused projections are only used for self attention'
+            q, k, v, *theta_q = self.to_qkv(x).split(self.qkv_split_sizes,
+                                                     dim=-1)
+            theta_q = theta_q[0] if len(theta_q) > 0 else None
         else:
-            theta_q = None
+            q = self.to_q(x)
+            k = self.to_k(context)
+            v = self.to_v(context)
+            if self.to_theta_q is not None:
+                theta_q = self.to_theta_q(x)
+            else:
+                theta_q = None
         q, k, v, theta_q = map(
             lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h)
             if t is not None else None, (q, k, v, theta_q))
@@ -185,6 +194,7 @@ class Attention_(nn.Module):
             if t is not None else (None, None), (q, k, v, theta_q))
 
         attn_outs = []
+        state = None
 
         if not empty(q):
             if exists(context_mask):
@@ -322,11 +332,12 @@ class Attention_(nn.Module):
                 kwargs['inferring_states'])
 
             attn_outs.append(out)
+            if state_local is not None:
+                state = state_local if state is None else dict(**state, **state_local)
 
         out = torch.cat(attn_outs, dim=1)
         out = rearrange(out, 'b h n d -> b n (h d)')
         out = self.to_out(out)
-        # TODO do something with state_local
         return self.dropout(out), state
 
 
@@ -335,6 +346,32 @@ class SelfAttention_(Attention_):
         assert not exists(context), 'self attention should not receive context'
         return super().forward(*args, **kwargs)
 
+    @torch.no_grad()
+    def fuse_qkv_(self):
+        """Replaces to_q, to_k, to_v (and to_theta_q) by a single Linear
+        whose output is split into q, k, v (and theta_q): one matmul instead of three
+
+        Inference only: the keys of the state_dict change
+        """
+        projections = [self.to_q, self.to_k, self.to_v]
+        if self.to_theta_q is not None:
+            projections.append(self.to_theta_q)
+        self.qkv_split_sizes = [
+            projection.out_features for projection in projections
+        ]
+        to_qkv = nn.Linear(self.to_q.in_features,
+                           sum(self.qkv_split_sizes),
+                           bias=self.to_q.bias is not None).to(
+                               self.to_q.weight)
+        to_qkv.weight.copy_(
+            torch.cat([projection.weight for projection in projections]))
+        if to_qkv.bias is not None:
+            to_qkv.bias.copy_(
+                torch.cat([projection.bias for projection in projections]))
+        self.to_qkv = to_qkv
+        del self.to_q, self.to_k, self.to_v
+        self.to_theta_q = None
+
 
 class CrossAttention_(Attention_):
     def forward(self, *args, context=None, **kwargs):
@@ -8,6 +8,11 @@ try:
     APEX_AVAILABLE = True
 except:
     APEX_AVAILABLE = False
+try:
+    from fast_transformers.causal_product import CausalDotProduct
+    CAUSAL_PRODUCT_AVAILABLE = True
+except ImportError:
+    CAUSAL_PRODUCT_AVAILABLE = False
 
 
 class FastAttention_(nn.Module):
@@ -18,21 +23,29 @@ class FastAttention_(nn.Module):
     def forward(self, q, k, q_rot, k_rot, v, states, inferring_states):
         """
         inputs are already feature mapped
+
+        If states is not None, q, k, v are the positions following the ones
+        summarized in states (a single position in recurrent mode, or a chunk)
+        and the states are advanced accordingly.
+        If inferring_states is True, also returns the states obtained
+        after processing the whole sequence.
         """
         if states is not None:
-            assert q.size(
-                2
-            ) == 1, 'recurrent inference can only be applied to sequences of len 1'
-            out, states = recursive_attention_step(q, k, q_rot, k_rot, v,
+            assert self.window_size is None, 'recurrent inference is not implemented with window_size'
+            if q.size(2) == 1:
+                out, states = recursive_attention_step(q, k, q_rot, k_rot, v,
+                                                       states)
+            else:
+                out, states = chunk_attention_step(q, k, q_rot, k_rot, v,
                                                    states)
         else:
+            out = causal_linear_attention(q, k, q_rot, k_rot, v, local=self.window_size)
             if inferring_states:
-                # TODO(leo): horizon not taken into account!!!!
-                # Pb with default parameters!!!
-                raise NotImplementedError
-                out, states = infer_hidden_states(q, k, q_rot, k_rot, v)
+                if self.window_size is not None:
+                    # TODO(leo): horizon not taken into account!!!!
+                    raise NotImplementedError
+                states = get_states(k, k_rot, v)
             else:
-                out = causal_linear_attention(q, k, q_rot, k_rot, v, local=self.window_size)
                 states = None
         return out, states
 
@@ -82,65 +95,28 @@ def causal_linear_attention(q, k, q_rot, k_rot, v, local=None, eps=1e-6):
 
 
 
-# inefficient causal linear attention, without cuda code,
-# (used for parallel inference of hidden states in recurrent mode)
-def infer_hidden_states(q, k, q_rot, k_rot, v, chunk_size=128, eps=1e-6):
-    last_k_cumsum = 0
-    last_context_cumsum = 0
-    last_k_cumsum_rot = 0
-    last_context_cumsum_rot = 0
-    outs = []
-    num_chunks = q.size(2) // chunk_size
-    for q, k, q_rot, k_rot, v in zip(
-            *map(lambda t: t.chunk(num_chunks, dim=-2), (q, k, q_rot, k_rot,
-                                                         v))):
-        k_cumsum = last_k_cumsum + k.cumsum(dim=-2)
-        D = torch.einsum('...nd,...nd->...n', q, k_cumsum.type_as(q))
-        context = torch.einsum('...nd,...ne->...nde', k, v)
-        context_cumsum = last_context_cumsum + context.cumsum(dim=-3)
-        if q_rot is not None:
-            for q_rot, k_rot in zip(
-                    *map(lambda t: t.chunk(num_chunks, dim=-2), (q_rot,
-                                                                 k_rot))):
-                k_cumsum_rot = last_k_cumsum_rot + k_rot.cumsum(dim=-2)
-                D_rot = torch.einsum('...nd,...nd->...n', q_rot,
-                                     k_cumsum_rot.type_as(q_rot))
-                context_rot = torch.einsum('...nd,...ne->...nde', k_rot, v)
-                context_cumsum_rot = last_context_cumsum_rot + \
-                    context_rot.cumsum(dim=-3)
-            D_inv = 1. / (D + D_rot + eps)
-        else:
-            D_inv = 1. / (D + eps)
 
-        out = torch.einsum('...nde,...nd,...n->...ne', context_cumsum, q,
-                           D_inv)
-        if q_rot is not None:
-            out_rot = torch.einsum('...nde,...nd,...n->...ne',
-                                   context_cumsum_rot, q_rot, D_inv)
-            out = out + out_rot
+def get_states(k, k_rot, v):
+    """
+    States after processing the whole sequence:
+    Zs are the sums of the keys, Ss the sums of the outer products k v^T
+    """
+    Z = k.sum(dim=-2)
+    S = torch.einsum('...nd,...ne->...de', k, v)
+    if k_rot is not None:
+        Z_rot = k_rot.sum(dim=-2)
+        S_rot = torch.einsum('...nd,...ne->...de', k_rot, v)
+    else:
+        Z_rot = None
+        S_rot = None
+    return dict(Zs=Z, Ss=S, Zs_rot=Z_rot, Ss_rot=S_rot)
 
-        last_k_cumsum = k_cumsum[:, :, -1:]
-        last_context_cumsum = context_cumsum[:, :, -1:]
-        if q_rot is not None:
-            last_k_cumsum_rot = k_cumsum_rot[:, :, -1:]
-            last_context_cumsum_rot = context_cumsum_rot[:, :, -1:]
-        outs.append(out)
 
-    out = torch.cat(outs, dim=-2)
-    if q_rot is None:
-        last_k_cumsum_rot = None
-        last_context_cumsum_rot = None
-    states = dict(Z=last_k_cumsum.squeeze(2),
-                  S=last_context_cumsum.squeeze(2),
-                  Z_rot=last_k_cumsum_rot.squeeze(2),
-                  S_rot=last_context_cumsum_rot.squeeze(2))
-    return out, states
-
-def recursive_attention_step(q, k, q_rot, k_rot, v, states, eps=1e-12):
+def recursive_attention_step(q, k, q_rot, k_rot, v, states, eps=1e-6):
     k_cumsum = states['Zs'].unsqueeze(2) + k
-    k_cumsum_rot = states['Zs_rot'].unsqueeze(2) + k_rot
     D = torch.einsum('...nd,...nd->...n', q, k_cumsum.type_as(q))
     if q_rot is not None:
+        k_cumsum_rot = states['Zs_rot'].unsqueeze(2) + k_rot
         D_rot = torch.einsum('...nd,...nd->...n', q_rot,
                              k_cumsum_rot.type_as(q_rot))
         D_inv = 1. / (D + D_rot + eps)
@@ -167,10 +143,33 @@ def recursive_attention_step(q, k, q_rot, k_rot, v, states, eps=1e-12):
     else:
         last_k_cumsum_rot = None
         last_context_cumsum_rot = None
-    states = dict(Z=last_k_cumsum,
-                  S=last_context_cumsum,
-                  Z_rot=last_k_cumsum_rot,
-                  S_rot=last_context_cumsum_rot)
+    states = dict(Zs=last_k_cumsum,
+                  Ss=last_context_cumsum,
+                  Zs_rot=last_k_cumsum_rot,
+                  Ss_rot=last_context_cumsum_rot)
+    return out, states
+
+
+def chunk_attention_step(q, k, q_rot, k_rot, v, states, eps=1e-6):
+    """
+    Causal linear attention over a chunk of positions following the ones
+    summarized in states: same as causal_linear_attention on the
+    concatenation, restricted to the chunk
+    """
+    N = get_N(q, k, v) + torch.einsum('...nd,...de->...ne', q, states['Ss'])
+    D = get_D(q, k) + torch.einsum('...nd,...d->...n', q, states['Zs'])
+    if q_rot is not None:
+        N = N + get_N(q_rot, k_rot, v) + torch.einsum(
+            '...nd,...de->...ne', q_rot, states['Ss_rot'])
+        D = D + get_D(q_rot, k_rot) + torch.einsum(
+            '...nd,...d->...n', q_rot, states['Zs_rot'])
+    out = torch.einsum('...nd,...n->...nd', N, 1. / (D + eps))
+
+    chunk_states = get_states(k, k_rot, v)
+    states = {
+        key: (states[key] + value if value is not None else None)
+        for key, value in chunk_states.items()
+    }
     return out, states
 
 
@@ -181,7 +180,13 @@ def get_D(q, k):
 
 
 def get_N(q, k, v):
-    from fast_transformers.causal_product import CausalDotProduct
+    """Causal dot product N_i = sum_{j <= i} (q_i . k_j) v_j
+
+    Uses the CUDA kernel of fast_transformers on GPU when it is installed,
+    and chunked_causal_dot_product otherwise
+    """
+    if not (q.is_cuda and CAUSAL_PRODUCT_AVAILABLE):
+        return chunked_causal_dot_product(q, k, v)
     autocast_enabled = torch.is_autocast_enabled()
     is_half = isinstance(q, torch.cuda.HalfTensor)
     assert not is_half or APEX_AVAILABLE, 'half tensors can only be used if nvidia apex is available'
@@ -194,3 +199,46 @@ def get_N(q, k, v):
             q, k, v = map(lambda t: t.float(), (q, k, v))
         N = causal_dot_product_fn(q, k, v)
     return N
+
+
+def chunked_causal_dot_product(q, k, v, chunk_size=64):
+    """Same as CausalDotProduct, in pure PyTorch:
+    the sequence is split in chunks of chunk_size positions,
+    masked attention is used inside each chunk
+    and the sums of the outer products k v^T of the previous chunks
+    are added to it
+
+    q, k (..., n, d), v (..., n, e)
+    returns N (..., n, e)
+    """
+    *batch_dims, n, _ = q.size()
+    e = v.size(-1)
+    if n == 0:
+        return q.new_zeros(*batch_dims, 0, e)
+    chunk_size = min(chunk_size, n)
+    num_chunks = -(-n // chunk_size)
+    padding = num_chunks * chunk_size - n
+    if padding > 0:
+        q, k, v = [
+            torch.nn.functional.pad(t, [0, 0, 0, padding]) for t in (q, k, v)
+        ]
+    q, k, v = [
+        t.reshape(*batch_dims, num_chunks, chunk_size, t.size(-1))
+        for t in (q, k, v)
+    ]
+
+    # inside each chunk
+    causal_mask = torch.ones(chunk_size,
+                             chunk_size,
+                             dtype=torch.bool,
+                             device=q.device).tril()
+    attention = (q @ k.transpose(-1, -2)).masked_fill(~causal_mask, 0.)
+    N = attention @ v
+
+    # sums of k v^T over the previous chunks
+    context = k.transpose(-1, -2) @ v
+    context_cumsum = torch.cat(
+        [torch.zeros_like(context[..., :1, :, :]), context[..., :-1, :, :]],
+        dim=-3).cumsum(dim=-3)
+    N = N + q @ context_cumsum
+    return N.reshape(*batch_dims, num_chunks * chunk_size, e)[..., :n, :]
@@ -21,7 +21,120 @@ class LocalAttention_(nn.Module):
         self.autopad = autopad
         self.dropout = nn.Dropout(dropout)
 
+    @property
+    def buffer_size(self):
+        # a query attends to its own bucket and to the look_backward previous ones
+        return self.window_size * (self.look_backward + 1)
+
     def forward(self, q, k, q_rot, k_rot, v, states, inferring_states):
+        """
+        If states is not None, q, k, v are the positions following the ones
+        stored in the ring buffers of states (a single position in recurrent
+        mode, or a chunk) and are attended against the ring buffers and themselves.
+        If inferring_states is True, also returns the ring buffers filled with
+        the end of the sequence.
+        """
+        if states is not None:
+            return self.forward_step(q, k, q_rot, k_rot, v, states)
+
+        out = self.forward_sequence(q, k, q_rot, k_rot, v)
+        if inferring_states:
+            states = self.get_states(k, k_rot, v)
+        else:
+            states = None
+        return out, states
+
+    def get_states(self, k, k_rot, v):
+        """
+        Ring buffers holding the last buffer_size keys, rotated keys and values.
+        Position p is stored at index p % buffer_size, positions_local
+        contains the position of each slot (-1 if empty)
+        """
+        batch_size, _, length, _ = k.shape
+        size = self.buffer_size
+        positions = torch.arange(max(0, length - size), length, device=k.device)
+        slots = positions % size
+
+        def to_buffer(t):
+            if t is None:
+                return None
+            buffer = t.new_zeros(*t.shape[:2], size, t.shape[-1])
+            buffer[:, :, slots] = t[:, :, positions]
+            return buffer
+
+        positions_local = torch.full((batch_size, size), -1,
+                                     dtype=torch.long, device=k.device)
+        positions_local[:, slots] = positions
+        return dict(keys_local=to_buffer(k),
+                    keys_rot_local=to_buffer(k_rot),
+                    values_local=to_buffer(v),
+                    positions_local=positions_local)
+
+    def forward_step(self, q, k, q_rot, k_rot, v, states):
+        """
+        Attends to the ring buffers and to the new positions, then writes
+        the new k, k_rot, v in the ring buffers:
+        cost per position does not depend on the sequence length
+        """
+        positions = states['positions_local']
+        size = positions.size(1)
+        length = q.size(2)
+        e = q.shape[-1]
+        # positions of the new tokens (batch_size, length)
+        t = positions.max(dim=1, keepdim=True).values + 1 + torch.arange(
+            length, device=q.device).unsqueeze(0)
+
+        def cat(buffer, x):
+            if buffer is None:
+                return None
+            return torch.cat([buffer, x], dim=2)
+
+        keys = cat(states['keys_local'], k)
+        keys_rot = cat(states['keys_rot_local'], k_rot)
+        values = cat(states['values_local'], v)
+        key_positions = torch.cat([positions, t], dim=1)[:, None, :]
+
+        # same masking as in forward_sequence
+        bucket_start = (torch.div(t, self.window_size, rounding_mode='floor') -
+                        self.look_backward) * self.window_size
+        mask = ((key_positions < 0) | (key_positions > t[:, :, None]) |
+                (key_positions < bucket_start[:, :, None]))
+        if self.exact_windowsize:
+            max_causal_window_size = (self.window_size * self.look_backward)
+            mask = mask | (t[:, :, None] > key_positions + max_causal_window_size)
+        mask = mask[:, None]
+
+        dots = torch.einsum('bhie,bhje->bhij', q, keys) * (e ** -0.5)
+        dots.masked_fill_(mask, max_neg_value(dots))
+        if q_rot is not None:
+            dots_rot = torch.einsum('bhie,bhje->bhij', q_rot, keys_rot) * (e ** -0.5)
+            dots_rot.masked_fill_(mask, max_neg_value(dots_rot))
+            attn = (dots + dots_rot).softmax(dim=-1)
+        else:
+            attn = dots.softmax(dim=-1)
+        attn = self.dropout(attn)
+
+        out = torch.einsum('bhij,bhje->bhie', attn, values)
+
+        # write the last new positions in the ring buffers
+        num_written = min(length, size)
+        t = t[:, -num_written:]
+        slots = t % size
+
+        def write(buffer, x):
+            if buffer is None:
+                return None
+            index = slots[:, None, :, None].expand(x.size(0), x.size(1), -1,
+                                                   x.size(3))
+            return buffer.scatter(2, index, x[:, :, -num_written:])
+
+        states = dict(keys_local=write(states['keys_local'], k),
+                      keys_rot_local=write(states['keys_rot_local'], k_rot),
+                      values_local=write(states['values_local'], v),
+                      positions_local=positions.scatter(1, slots, t))
+        return out, states
+
+    def forward_sequence(self, q, k, q_rot, k_rot, v):
         shape = q.shape
 
         merge_into_batch = lambda t: t.reshape(-1, *t.shape[-2:]) if t is not None else None
@@ -87,4 +200,4 @@ class LocalAttention_(nn.Module):
         if self.autopad:
             out = out[:, :orig_t, :]
 
-        return out.reshape(*shape), None
+        return out.reshape(*shape)
@@ -1,8 +1,9 @@
-from CIA.model.positional_embeddings.get_pe_input import get_pe_input
+from CIA.model.positional_embeddings.get_pe_input import get_pe_input, get_pe_input_step
 from CIA.positional_embeddings.positional_embedding import PositionalEmbedding
 from torch import nn
 from CIA.data_processors import DataProcessor, data_processor
 from CIA.dataloaders.dataloader import DataloaderGenerator
+from CIA.model.split_linear import SplitLinear
 from CIA.utils import flatten, categorical_crossentropy
 import torch
 
@@ -64,8 +65,9 @@ class CausalEventsModel(nn.Module):
         self.pre_softmaxes = nn.ModuleList(
             [
             # MLPs for autoregressive generation
+            # input: event_state and embeddings of the previous channels
             nn.Sequential(
-                nn.Linear(self.d_model + channel_id * self.data_processor.embedding_size, self.d_model * 4),
+                SplitLinear([self.d_model, channel_id * self.data_processor.embedding_size], self.d_model * 4),
                 nn.LeakyReLU(),
                 nn.Linear(self.d_model * 4, num_tokens_of_channel)
             )
@@ -111,16 +113,13 @@ class CausalEventsModel(nn.Module):
         return target_seq, layer_pos_emb_input, h_pe
 
     def event_state_to_weights(self, output, target_embedded):
+        # the previous channels are not concatenated to output (see SplitLinear):
+        # their embeddings are a view of target_embedded
         weights_per_category = [
+            pre_softmax(
+                [output, target_embedded[:, :, :channel_id].flatten(start_dim=2)])
+            for channel_id, pre_softmax in enumerate(self.pre_softmaxes)
         ]
-        for channel_id, pre_softmax in enumerate(self.pre_softmaxes):
-            weight = pre_softmax(output)
-            weights_per_category.append(weight)
-
-            # concatenate channels to output
-            output = torch.cat(
-                [output, target_embedded[:, :, channel_id]], dim=2
-            )
         return weights_per_category
 
     def event_state_to_weight_step(self, output, target_embedded, channel_id):
@@ -131,10 +130,9 @@ class CausalEventsModel(nn.Module):
             target_embedded (batch_size, num_channels, feature_dim): embeddings of the channels of the current event
             channel_id ([type]): channel BEING predicted
         """
-        # concatenate all already-predected channels
-        for i in range(channel_id):
-            output = torch.cat([output, target_embedded[:, i]], dim=1)
-        weight = self.pre_softmaxes[channel_id](output)
+        # all already-predicted channels
+        channels_embedded = target_embedded[:, :channel_id].flatten(start_dim=1)
+        weight = self.pre_softmaxes[channel_id]([output, channels_embedded])
         return weight
 
 
@@ -220,15 +218,28 @@ class CausalEventsModel(nn.Module):
                 }
             }
 
-    def compute_event_state(self, target, metadata_dict, h_pe_init):
+    def compute_event_state(self, target, metadata_dict, h_pe_init,
+                            event_index=None):
+        """
+        :param target: sequence of tokens (batch_size, num_events, num_channels)
+        :param event_index: if not None, only the events up to event_index (included)
+        are processed. Since the model is causal, the event_states up to event_index
+        are the same as with the full sequence
+        """
+        if event_index is not None:
+            target = target[:, :event_index + 1]
+            if 'original_sequence' in metadata_dict:
+                metadata_dict = dict(
+                    metadata_dict,
+                    original_sequence=metadata_dict['original_sequence']
+                    [:, :event_index + 1])
         batch_size, _, _ = target.size()
         target_embedded = self.data_processor.embed(target)
         # target_embedded is (batch_size, num_events, num_channels, dim)
 
         # WE do NOT flatten
         # target_seq = flatten(target_embedded)
-        target_seq = torch.cat(target_embedded.split(1, dim=2),
-                               dim=3).squeeze(2)
+        target_seq = target_embedded.flatten(start_dim=2)
 
         # target_seq is (batch_size, num_vents, dim * num_channels)
 
@@ -246,61 +257,136 @@ class CausalEventsModel(nn.Module):
     def forward_step(self, target, metadata_dict, i):
         raise NotImplementedError
 
-    def infer_hidden_states(self, priming_seq, metadata_dict,
-                            decoding_start_index):
-        target_embedded = self.data_processor.embed(priming_seq)
-        target_seq = flatten(target_embedded)
-        target_seq, layer_pos_emb, h_pe = self.prepare_sequence(target_seq,
-                                                                metadata_dict,
-                                                                h_pe_init=None)
-        out = self.transformer(
-            target_seq[:, :decoding_start_index + 1],
-            pos_emb_input=layer_pos_emb[:, :decoding_start_index + 1],
-            inferring_states=True,
-            states=None)
-        # softmax
-        # prediction for time_index decoding_start_index
-        out_x = out['x'][:, -1]
-        channel_index_output = decoding_start_index % self.num_channels_target
-        weights = self.pre_softmaxes[channel_index_output](out_x)
-        return {
-            'loss': None,
-            'weights': weights,
-            'Zs': out['Zs'],
-            'Ss': out['Ss'],
-            'Zs_rot': out['Zs_rot'],
-            'Ss_rot': out['Ss_rot']
-        }
+    def infer_hidden_states(self, target, metadata_dict, decoding_start,
+                            states=None, start_event=0):
+        """Prefill: transformer pass over positions start_event to decoding_start
+        (included) in recurrent mode
 
-    def recurrent_step(self, target, metadata_dict, states, decoding_index):
-        # aaa = time.time()
-        # CRUCIAL LINE
-        # metadata_dict['original_token'] = target[:, decoding_index]
+        :param target: sequence of tokens (batch_size, num_events, num_channels)
+        :param decoding_start: index of the first event to generate
+        :param states: states returned for event start_event - 1
+        (None if start_event is 0)
+        :return: event_state for event decoding_start (batch_size, d_model)
+        and the states to be passed to recurrent_step
+        """
+        assert (states is None) == (start_event == 0)
+        # later events are not needed (causal model)
+        target = target[:, :decoding_start + 1]
+        if 'original_sequence' in metadata_dict:
+            metadata_dict = dict(
+                metadata_dict,
+                original_sequence=metadata_dict['original_sequence']
+                [:, :decoding_start + 1])
 
         target_embedded = self.data_processor.embed(target)
-        target_seq = flatten(target_embedded)
-        target_seq, layer_pos_emb, h_pe = self.prepare_sequence(target_seq,
-                                                                metadata_dict,
-                                                                h_pe_init=None)
-        # bbb = time.time()
+        target_seq = target_embedded.flatten(start_dim=2)
+        target_seq, layer_pos_emb_input, h_pe = self.prepare_sequence(
+            target_seq, metadata_dict, h_pe_init=None)
+
+        if layer_pos_emb_input is not None:
+            layer_pos_emb_input = layer_pos_emb_input[:, start_event:]
         out = self.transformer(
-            target_seq[:, decoding_index:decoding_index + 1],
-            pos_emb_input=layer_pos_emb[:, decoding_index:decoding_index + 1],
-            inferring_states=False,
-            states=states)
-        # softmax
-        # prediction for time_index decoding_start_index
-        out_x = out['x'][:, 0]
-        channel_index_output = decoding_index % self.num_channels_target
-        weights = self.pre_softmaxes[channel_index_output](out_x)
-        # ccc = time.time()
-        # print(f'Time preprocess: {bbb-aaa}\t{(bbb-aaa)/(ccc-aaa)}\%')
-        # print(f'Time generation: {ccc-bbb}\t{(ccc-bbb)/(ccc-aaa)}\%')
-        return {
-            'loss': None,
-            'weights': weights,
-            'Zs': out['Zs'],
-            'Ss': out['Ss'],
-            'Zs_rot': out['Zs_rot'],
-            'Ss_rot': out['Ss_rot']
+            target_seq[:, start_event:],
+            pos_emb_input=layer_pos_emb_input,
+            inferring_states=True,
+            states=states['transformer'] if states is not None else None)
+        output = out['x'][:, -1]
+        states = dict(transformer=out['states'], h_pe=None, h_layer_pe=None)
+        return output, states
+
+    def recurrent_step_input(self, target, metadata_dict, states, event_index):
+        """Input of the transformer in recurrent_step
+
+        :return: target_seq (batch_size, 1, d_model), layer_pos_emb_input
+        and the new values of states['h_pe'] and states['h_layer_pe']
+        """
+        # target is shifted by one: the input at event_index
+        # is event event_index - 1
+        input_index = event_index - 1
+        target_embedded = self.data_processor.embed(target[:, input_index])
+        # target_seq is (batch_size, dim * num_channels)
+        target_seq = target_embedded.reshape(target_embedded.size(0), -1)
+        target_seq, h_pe = self.positional_embedding.forward_step(
+            target_seq,
+            i=input_index,
+            h=states['h_pe'],
+            metadata_dict=metadata_dict)
+        target_seq = self.linear_target(target_seq).unsqueeze(1)
+
+        if self.pe_input_type is not None:
+            layer_pos_emb_input, h_layer_pe = get_pe_input_step(
+                data_processor=self.data_processor,
+                x_embed=target_seq,
+                h=states['h_layer_pe'],
+                metadata_dict=metadata_dict,
+                pe_input_type=self.pe_input_type,
+                event_index=input_index)
+        else:
+            layer_pos_emb_input, h_layer_pe = None, None
+        return target_seq, layer_pos_emb_input, h_pe, h_layer_pe
+
+    def recurrent_step(self, target, metadata_dict, states, event_index):
+        """Computes the event_state for event event_index in constant time
+        from the states returned for event_index - 1
+        (by infer_hidden_states or recurrent_step)
+
+        :param target: sequence of tokens (batch_size, num_events, num_channels)
+        only event event_index - 1 is read
+        :return: event_state for event event_index (batch_size, d_model)
+        and the new states
+        """
+        target_seq, layer_pos_emb_input, h_pe, h_layer_pe = self.recurrent_step_input(
+            target, metadata_dict, states, event_index)
+
+        out = self.transformer(target_seq,
+                               pos_emb_input=layer_pos_emb_input,
+                               inferring_states=True,
+                               states=states['transformer'])
+        output = out['x'][:, 0]
+        states = dict(transformer=out['states'],
+                      h_pe=h_pe,
+                      h_layer_pe=h_layer_pe)
+        return output, states
+
+    def recurrent_step_group(self, steps):
+        """recurrent_step for several sequences which can be at different
+        event indices (continuous batching):
+        inputs are computed separately, but there is a single transformer pass
+
+        :param steps: list of (target, metadata_dict, states, event_index),
+        arguments of recurrent_step
+        :return: list of (output, states), one for each step
+        """
+        inputs = [self.recurrent_step_input(*step) for step in steps]
+        sizes = [target_seq.size(0) for target_seq, _, _, _ in inputs]
+
+        def cat(tensors):
+            if tensors[0] is None:
+                return None
+            return torch.cat(tensors, dim=0)
+
+        target_seq = cat([step_input[0] for step_input in inputs])
+        layer_pos_emb_input = cat([step_input[1] for step_input in inputs])
+        transformer_states = {
+            k: cat([states['transformer'][k] for _, _, states, _ in steps])
+            for k in steps[0][2]['transformer']
+        }
+        out = self.transformer(target_seq,
+                               pos_emb_input=layer_pos_emb_input,
+                               inferring_states=True,
+                               states=transformer_states)
+
+        outputs = out['x'][:, 0].split(sizes)
+        transformer_states = {
+            k: v.split(sizes) if v is not None else [None] * len(sizes)
+            for k, v in out['states'].items()
         }
+        return [(output,
+                 dict(transformer={
+                     k: v[step_index]
+                     for k, v in transformer_states.items()
+                 },
+                      h_pe=h_pe,
+                      h_layer_pe=h_layer_pe))
+                for step_index, (output, (_, _, h_pe, h_layer_pe)) in
+                enumerate(zip(outputs, inputs))]
@@ -242,10 +242,7 @@ class CausalModel(nn.Module):
         return {
             'loss': None,
             'weights': weights,
-            'Zs': out['Zs'],
-            'Ss': out['Ss'],
-            'Zs_rot': out['Zs_rot'],
-            'Ss_rot': out['Ss_rot']
+            'states': out['states']
         }
 
     def recurrent_step(self, target, metadata_dict, states, decoding_index):
@@ -261,7 +258,7 @@ class CausalModel(nn.Module):
         out = self.transformer(
             target_seq[:, decoding_index:decoding_index+1],
             pos_emb_input=layer_pos_emb[:, decoding_index:decoding_index+1],
-            inferring_states=False, states=states)
+            inferring_states=True, states=states)
         # softmax
         # prediction for time_index decoding_start_index
         out_x = out['x'][:, 0]
@@ -273,8 +270,5 @@ class CausalModel(nn.Module):
         return {
             'loss': None,
             'weights': weights,
-            'Zs': out['Zs'],
-            'Ss': out['Ss'],
-            'Zs_rot': out['Zs_rot'],
-            'Ss_rot': out['Ss_rot']
+            'states': out['states']
         }
@@ -1,20 +1,47 @@
 import torch
 import torch.nn as nn
 from performer_pytorch.reversible import route_args
+from CIA.model.execute_type.layer_states import get_layer_states, stack_layer_states
 
 
 class Gating(nn.Module):
     def __init__(self, d_model) -> None:
         super().__init__()
-        self.Wr = nn.Linear(d_model, d_model, bias=False)
-        self.Ur = nn.Linear(d_model, d_model, bias=False)
-        self.Wz = nn.Linear(d_model, d_model, bias=False)
-        self.Uz = nn.Linear(d_model, d_model, bias=False)
-        self.Wg = nn.Linear(d_model, d_model, bias=False)
+        # Wr, Wz, Wg (applied to y) and Ur, Uz (applied to x)
+        # are concatenated: one matmul for each input
+        self.d_model = d_model
+        self.Wrzg = nn.Linear(d_model, 3 * d_model, bias=False)
+        self.Urz = nn.Linear(d_model, 2 * d_model, bias=False)
         self.Ug = nn.Linear(d_model, d_model, bias=False)
         self.bg = nn.Parameter(torch.randn(
             (d_model, ), requires_grad=True) + 1,
                                requires_grad=True)
+        self._register_load_state_dict_pre_hook(self._pack_weights)
+
+    def _pack_weights(self, state_dict, prefix, *args):
+        """Checkpoints saved before the projections were concatenated
+        contain separate Wr, Wz, Wg, Ur, Uz weights
+        """
+        for packed_name, names in [('Wrzg', ['Wr', 'Wz', 'Wg']),
+                                   ('Urz', ['Ur', 'Uz'])]:
+            keys = [f'{prefix}{name}.weight' for name in names]
+            if all(key in state_dict for key in keys):
+                state_dict[f'{prefix}{packed_name}.weight'] = torch.cat(
+                    [state_dict.pop(key) for key in keys], dim=0)
+
+    def gates(self, x, y, bg=None):
+        """
+        :param bg: bias of the update gate, defaults to self.bg
+        :return: update gate z and candidate h
+        """
+        if bg is None:
+            bg = self.bg
+        wr, wz, wg = self.Wrzg(y).split(self.d_model, dim=-1)
+        ur, uz = self.Urz(x).split(self.d_model, dim=-1)
+        r = torch.sigmoid(wr + ur)
+        z = torch.sigmoid(wz + uz - bg)
+        h = torch.tanh(wg + self.Ug(r * x))
+        return z, h
 
     def forward(self, x, y):
         """
@@ -22,9 +49,7 @@ class Gating(nn.Module):
         :param y: output from the attention or ff layer
         :return:
         """
-        r = torch.sigmoid(self.Wr(y) + self.Ur(x))
-        z = torch.sigmoid(self.Wz(y) + self.Uz(x) - self.bg)
-        h = torch.tanh(self.Wg(y) + self.Ug(r * x))
+        z, h = self.gates(x, y)
         return (1 - z) * x + z * h
 
 
@@ -51,9 +76,7 @@ class GatedSequence_(nn.Module):
         for layer_ind, ((f, g), (f_args, g_args), gating_attn,
                         gating_ff) in enumerate(layers_and_args_and_gatings):
             f_args_layer = {
-                k: (dict(Zs=v['Zs'][:, :, :, layer_ind],
-                         Ss=v['Ss'][:, :, :, :, layer_ind]) if
-                    (k == 'states' and v is not None) else v)
+                k: (get_layer_states(v, layer_ind) if k == 'states' else v)
                 for k, v in f_args.items()
             }
             f_x, state = f(x, **f_args_layer)
@@ -63,16 +86,8 @@ class GatedSequence_(nn.Module):
 
             if state is not None:
                 states.append(state)
-        if len(states) > 0:
-            Zs = torch.stack([st['Z'] for st in states], dim=-1)
-            Ss = torch.stack([st['S'] for st in states], dim=-1)
-        else:
-            Zs = torch.zeros_like(x)
-            Ss = torch.zeros_like(x)
 
         if kwargs['inferring_states']:
-            # TODO Zs_rot and Ss_rot are missing            
-            raise NotImplementedError       
-            return x, Zs, Ss, None, None
+            return x, stack_layer_states(states)
         else:
             return x
@@ -0,0 +1,31 @@
+import torch
+
+
+def get_layer_states(states, layer_ind):
+    """
+    Extracts the recurrent states of layer layer_ind
+
+    :param states: dict of tensors stacked along their last dimension
+    (one entry per layer), or None
+    :return: dict of tensors for layer layer_ind, or None
+    """
+    if states is None:
+        return None
+    return {k: v[..., layer_ind] if v is not None else None
+            for k, v in states.items()}
+
+
+def stack_layer_states(states_list):
+    """
+    Inverse of get_layer_states
+
+    :param states_list: list of dicts of tensors, one per layer
+    :return: dict of tensors stacked along their last dimension, or None
+    """
+    if len(states_list) == 0:
+        return None
+    return {
+        k: (torch.stack([st[k] for st in states_list], dim=-1)
+            if states_list[0][k] is not None else None)
+        for k in states_list[0]
+    }
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from torch.autograd.function import Function
 from performer_pytorch.reversible import Deterministic, route_args
+from CIA.model.execute_type.layer_states import get_layer_states, stack_layer_states
 
 
 class ReversibleBlock_(nn.Module):
@@ -82,26 +83,17 @@ class _ReversibleFunction_(Function):
 
     @staticmethod
     def forward_with_states(x, blocks, args):
-        # ctx.args = args
+        # no backward pass in this mode: only used for generation
         states = []
         for layer_ind, (block, kwarg) in enumerate(zip(blocks, args)):
             # extract the states for the current layer
-            f_args_layer = {k: (dict(Zs=v['Zs'][:, :, :, layer_ind], Ss=v['Ss'][:, :, :, :, layer_ind],
-                                     Zs_rot=v['Zs_rot'][:, :, :, layer_ind],
-                                     Ss_rot=v['Ss_rot'][:, :, :, :, layer_ind]) if
-                                (k == 'states' and v is not None) else v) for k, v in kwarg['f_args'].items()}
+            f_args_layer = {k: (get_layer_states(v, layer_ind) if k == 'states' else v)
+                            for k, v in kwarg['f_args'].items()}
             kwargs_layer = dict(f_args=f_args_layer, g_args=kwarg['g_args'])
             x, state = block(x, **kwargs_layer)
             if state is not None:
                 states.append(state)
-        # ctx.y = x.detach()
-        # ctx.blocks = blocks
-        # can't return a list in torch Function
-        Zs = torch.stack([st['Z'] for st in states], dim=-1)
-        Ss = torch.stack([st['S'] for st in states], dim=-1)
-        Zs_rot = torch.stack([st['Z_rot'] for st in states], dim=-1)
-        Ss_rot = torch.stack([st['S_rot'] for st in states], dim=-1)
-        return x, Zs, Ss, Zs_rot, Ss_rot
+        return x, stack_layer_states(states)
 
 
 class ReversibleSequence_(nn.Module):
@@ -117,9 +109,9 @@ class ReversibleSequence_(nn.Module):
         args = route_args(self.args_route, kwargs, len(blocks))
         args = list(map(lambda x: {'f_args': x[0], 'g_args': x[1]}, args))
         if kwargs['inferring_states']:
-            x, Zs, Ss, Zs_rot, Ss_rot = _ReversibleFunction_.forward_with_states(x, blocks, args)
+            x, states = _ReversibleFunction_.forward_with_states(x, blocks, args)
             x = torch.stack(x.chunk(2, dim=-1)).sum(dim=0)
-            return x, Zs, Ss, Zs_rot, Ss_rot
+            return x, states
         else:
             x = _ReversibleFunction_.apply(x, blocks, args)
             x = torch.stack(x.chunk(2, dim=-1)).sum(dim=0)
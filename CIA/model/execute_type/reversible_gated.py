@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from torch.autograd.function import Function
 from performer_pytorch.reversible import Deterministic, route_args
+from CIA.model.execute_type.gated import Gating
 
 
 class ReversibleGatedBlock_(nn.Module):
@@ -9,25 +10,38 @@ class ReversibleGatedBlock_(nn.Module):
         super().__init__()
         self.f = Deterministic(f)
         self.g = Deterministic(g)
-        # gating for attention
-        self.Wfr = nn.Linear(d_model, d_model, bias=False)
-        self.Ufr = nn.Linear(d_model, d_model, bias=False)
-        self.Wfz = nn.Linear(d_model, d_model, bias=False)
-        self.Ufz = nn.Linear(d_model, d_model, bias=False)
-        self.Wfg = nn.Linear(d_model, d_model, bias=False)
-        self.Ufg = nn.Linear(d_model, d_model, bias=False)
-        self.bfg = nn.Parameter(torch.randn(
-            (d_model,), requires_grad=True) + 1, requires_grad=True)
-
-        # gating for ff
-        self.Wgr = nn.Linear(d_model, d_model, bias=False)
-        self.Ugr = nn.Linear(d_model, d_model, bias=False)
-        self.Wgz = nn.Linear(d_model, d_model, bias=False)
-        self.Ugz = nn.Linear(d_model, d_model, bias=False)
-        self.Wgg = nn.Linear(d_model, d_model, bias=False)
-        self.Ugg = nn.Linear(d_model, d_model, bias=False)
-        self.bgg = nn.Parameter(torch.randn(
-            (d_model,), requires_grad=True) + 1, requires_grad=True)
+        # gating for attention and for ff
+        self.gating_f = Gating(d_model=d_model)
+        self.gating_g = Gating(d_model=d_model)
+        self._register_load_state_dict_pre_hook(self._rename_weights)
+
+    def _rename_weights(self, state_dict, prefix, *args):
+        """Checkpoints saved before the gatings were Gating modules
+        contain Wfr, Ufr... (attention) and Wgr, Ugr... (ff) weights
+        """
+        for layer in ['f', 'g']:
+            renamed = {
+                f'W{layer}{gate}.weight': f'gating_{layer}.W{gate}.weight'
+                for gate in 'rzg'
+            }
+            renamed.update({
+                f'U{layer}{gate}.weight': f'gating_{layer}.U{gate}.weight'
+                for gate in 'rzg'
+            })
+            renamed[f'b{layer}g'] = f'gating_{layer}.bg'
+            for name, new_name in renamed.items():
+                if f'{prefix}{name}' in state_dict:
+                    state_dict[f'{prefix}{new_name}'] = state_dict.pop(
+                        f'{prefix}{name}')
+
+    def attention_gates(self, x1, fx1):
+        """gates of the attention layer, used by forward and backward_pass
+
+        forward has always used the bias of the ff gate (bgg, now gating_g.bg)
+        and trained models depend on it; backward_pass used bfg, so that
+        its gradients were not those of forward. gating_f.bg is unused.
+        """
+        return self.gating_f.gates(x1, fx1, bg=self.gating_g.bg)
 
     def forward(self, x, f_args={}, g_args={}):
         x1, x2 = torch.chunk(x, 2, dim=2)
@@ -37,17 +51,13 @@ class ReversibleGatedBlock_(nn.Module):
             # attention layer
             y1 = x1
             fx1, states = self.f(x1, record_rng=self.training, **f_args)
-            r = torch.sigmoid(self.Wfr(fx1) + self.Ufr(x1))
-            z = torch.sigmoid(self.Wfz(fx1) + self.Ufz(x1) - self.bgg)
-            h = torch.tanh(self.Wfg(fx1) + self.Ufg(r * x1))
+            z, h = self.attention_gates(x1, fx1)
             y2 = (1 - z) * x2 + z * h
 
             # ff layer
             out1 = y1
             gy1 = self.g(y1, record_rng=self.training, **g_args)
-            r = torch.sigmoid(self.Wgr(gy1) + self.Ugr(y1))
-            z = torch.sigmoid(self.Wgz(gy1) + self.Ugz(y1) - self.bgg)
-            h = torch.tanh(self.Wgg(gy1) + self.Ugg(r * y1))
+            z, h = self.gating_g.gates(y1, gy1)
             out2 = (1 - z) * y2 + z * h
             out = torch.cat([out1, out2], dim=2)
         return out, states
@@ -62,53 +72,49 @@ class ReversibleGatedBlock_(nn.Module):
         # FF layer
         with torch.no_grad():
             y1 = out1
-            gy1 = self.g(y1, record_rng=self.training, **g_args)
-            r = torch.sigmoid(self.Wgr(gy1) + self.Ugr(y1))
-            z = torch.sigmoid(self.Wgz(gy1) + self.Ugz(y1) - self.bgg)
-            h = torch.tanh(self.Wgg(gy1) + self.Ugg(r * y1))
-            # z = output of a sigmoid, so never 0, but numerically stable ??????
-            y2 = (out2 - (1 - z) * h) * 1 / z
+            # same dropout masks as forward
+            gy1 = self.g(y1, set_rng=self.training, **g_args)
+            z, h = self.gating_g.gates(y1, gy1)
+            # inverse of out2 = (1 - z) * y2 + z * h
+            # z = output of a sigmoid, so never 1, but numerically stable ??????
+            y2 = (out2 - z * h) * 1 / (1 - z)
             y2.grad = None
 
         with torch.enable_grad():
             y2.requires_grad = True
             y1.requires_grad = True
-            gy1 = self.g(out1, record_rng=self.training, **g_args)
-            r = torch.sigmoid(self.Wgr(gy1) + self.Ugr(out1))
-            z = torch.sigmoid(self.Wgz(gy1) + self.Ugz(out1) - self.bgg)
-            h = torch.tanh(self.Wgg(gy1) + self.Ugg(r * out1))
+            gy1 = self.g(out1, set_rng=self.training, **g_args)
+            z, h = self.gating_g.gates(out1, gy1)
             yout2 = (1 - z) * y2 + z * h
             torch.autograd.backward(yout2, dout2)
 
         with torch.no_grad():
             dy1 = dout1 + y1.grad
             dy2 = y2.grad
-            x = torch.cat([y1, y2.detach()], dim=2)
-            dx = torch.cat([dy1, dy2], dim=2)
+            y1.grad = None
 
         # Attention layer
         with torch.no_grad():
             x1 = y1
-            fx1, _ = self.f(x1, record_rng=self.training, **f_args)
-            r = torch.sigmoid(self.Wfr(fx1) + self.Ufr(x1))
-            z = torch.sigmoid(self.Wfz(fx1) + self.Ufz(x1) - self.bfg)
-            h = torch.tanh(self.Wfg(fx1) + self.Ufg(r * x1))
-            # z = output of a sigmoid, so never 0, but numerically stable ??????
-            x2 = (y2 - (1 - z) * h) * 1 / z
+            fx1, _ = self.f(x1, set_rng=self.training, **f_args)
+            z, h = self.attention_gates(x1, fx1)
+            # inverse of y2 = (1 - z) * x2 + z * h
+            # z = output of a sigmoid, so never 1, but numerically stable ??????
+            x2 = (y2 - z * h) * 1 / (1 - z)
             x2.grad = None
 
         with torch.enable_grad():
+            x2.requires_grad = True
             y1.requires_grad = True
-            fx1, _ = self.f(y1, record_rng=self.training, **f_args)
-            r = torch.sigmoid(self.Wfr(fx1) + self.Ufr(y1))
-            z = torch.sigmoid(self.Wfz(fx1) + self.Ufz(y1) - self.bfg)
-            h = torch.tanh(self.Wfg(fx1) + self.Ufg(r * y1))
+            fx1, _ = self.f(y1, set_rng=self.training, **f_args)
+            z, h = self.attention_gates(y1, fx1)
             yy2 = (1 - z) * x2 + z * h
             torch.autograd.backward(yy2, dy2)
 
         with torch.no_grad():
-            dx1 = dy1 + yy2.grad
-            dx2 = yy2.grad
+            dx1 = dy1 + y1.grad
+            dx2 = x2.grad
+            y1.grad = None
             x = torch.cat([x1, x2.detach()], dim=2)
             dx = torch.cat([dx1, dx2], dim=2)
 
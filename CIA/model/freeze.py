@@ -0,0 +1,39 @@
+from torch import nn
+from performer_pytorch.performer_pytorch import Chunk
+
+from CIA.model.attentions.attentions import SelfAttention_
+from CIA.model.positional_embeddings.pe_modules.rototor import Rototor
+from CIA.model.transformer.performer import _Performer_
+
+
+def freeze_for_inference(model, ff_chunks=1):
+    """Removes the training-time machinery of model, in place:
+    - dropouts are replaced by identities,
+    - the random projections of the performers are no longer redrawn,
+    - to_q, to_k, to_v of the self attentions are fused in a single Linear,
+    - the periods of the rototors are precomputed,
+    - the feedforwards are split in ff_chunks chunks along the sequence
+    (1: no chunking)
+
+    The outputs are the same as those of the original model (up to float rounding),
+    but the state_dict is not: frozen models must not be saved
+
+    :param model: model without its DistributedDataParallel wrapper
+    :return: model, in eval mode
+    """
+    model.eval()
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, nn.Dropout):
+                setattr(module, name, nn.Identity())
+
+        if isinstance(module, _Performer_):
+            module.fix_projection_matrices_()
+            module.auto_check_redraw = False
+        elif isinstance(module, SelfAttention_):
+            module.fuse_qkv_()
+        elif isinstance(module, Rototor):
+            module.freeze_()
+        elif isinstance(module, Chunk):
+            module.chunks = ff_chunks
+    return model
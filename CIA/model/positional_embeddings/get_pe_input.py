@@ -19,3 +19,20 @@ def get_pe_input(data_processor, x_embed, h, metadata_dict, pe_input_type, event
             elapsed_time_channelized = elapsed_time.repeat_interleave(num_channels, dim=1)
         pe_input = elapsed_time_channelized
     return pe_input
+
+
+def get_pe_input_step(data_processor, x_embed, h, metadata_dict, pe_input_type, event_index):
+    """Event-level version of get_pe_input: only computes the input for event_index
+
+    h is the value returned for event_index - 1 (None if unknown)
+    returns pe_input (batch_size, 1) and the new h
+    """
+    batch_size = x_embed.size(0)
+    if pe_input_type == 'index':
+        pe_input = torch.full((batch_size, 1), float(event_index),
+                              device=x_embed.device)
+    elif pe_input_type == 'elapsed':
+        elapsed_time, h = data_processor.compute_elapsed_time_step(
+            metadata_dict, event_index=event_index, h=h)
+        pe_input = elapsed_time.unsqueeze(1)
+    return pe_input, h
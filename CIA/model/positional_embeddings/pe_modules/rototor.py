@@ -16,12 +16,18 @@ class Rototor(nn.Module):
         log_periods_heads = torch.stack(n_heads*[log_periods], dim=0)
         self.log_periods = nn.Parameter(
             log_periods_heads, requires_grad=(not fix))
+        # exp(log_periods), precomputed by freeze_ for inference
+        self.register_buffer('periods', None, persistent=False)
+
+    @torch.no_grad()
+    def freeze_(self):
+        self.periods = torch.exp(self.log_periods)
 
     def forward(self, pe_input, offset):
-        batch_size = pe_input.shape[0]
-        periods = torch.stack(batch_size*[
-            torch.exp(self.log_periods)
-        ])
+        if self.periods is not None:
+            periods = self.periods[None]
+        else:
+            periods = torch.exp(self.log_periods)[None]
         if offset is not None:
             pe_input = pe_input[:, None, :, None] + offset
         else:
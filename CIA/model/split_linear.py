@@ -0,0 +1,48 @@
+from torch import nn
+
+
+class SplitLinear(nn.Module):
+    """Same as nn.Linear(sum(input_sizes), output_size) applied to the
+    concatenation of a list of inputs of sizes input_sizes,
+    but without concatenating them: one Linear per input
+    (the bias is in the first one) whose outputs are summed.
+    Inputs of size 0 are ignored.
+
+    Checkpoints saved with a single nn.Linear (weight and bias) are split when loaded.
+    """
+    def __init__(self, input_sizes, output_size):
+        super().__init__()
+        self.input_sizes = list(input_sizes)
+        assert self.input_sizes[0] > 0
+        self.linears = nn.ModuleList([
+            nn.Linear(input_size, output_size, bias=input_index == 0)
+            for input_index, input_size in enumerate(self.input_sizes)
+            if input_size > 0
+        ])
+        self._register_load_state_dict_pre_hook(self._split_weights)
+        # same initialization as the single nn.Linear
+        linear = nn.Linear(sum(self.input_sizes), output_size)
+        self.load_state_dict(linear.state_dict())
+
+    def _split_weights(self, state_dict, prefix, *args):
+        if f'{prefix}weight' not in state_dict:
+            return
+        weights = [
+            weight for weight in state_dict.pop(f'{prefix}weight').split(
+                self.input_sizes, dim=1) if weight.size(1) > 0
+        ]
+        for linear_index, weight in enumerate(weights):
+            state_dict[f'{prefix}linears.{linear_index}.weight'] = weight
+        state_dict[f'{prefix}linears.0.bias'] = state_dict.pop(f'{prefix}bias')
+
+    def forward(self, inputs):
+        """
+        :param inputs: list of tensors of sizes (..., input_sizes[i])
+        :return: (..., output_size)
+        """
+        assert len(inputs) == len(self.input_sizes)
+        inputs = [x for x in inputs if x.size(-1) > 0]
+        out = self.linears[0](inputs[0])
+        for linear, x in zip(self.linears[1:], inputs[1:]):
+            out = out + linear(x)
+        return out
@@ -191,8 +191,8 @@ class _Performer_(nn.Module):
         if self.auto_check_redraw:
             self.proj_updater.redraw_projections()
         if kwargs['inferring_states']:
-            x, Zs, Ss, Zs_rot, Ss_rot = self.net(x, **kwargs)
-            return dict(x=x, Zs=Zs, Ss=Ss, Zs_rot=Zs_rot, Ss_rot=Ss_rot)
+            x, states = self.net(x, **kwargs)
+            return dict(x=x, states=states)
         else:
             x = self.net(x, **kwargs)
             return dict(x=x)
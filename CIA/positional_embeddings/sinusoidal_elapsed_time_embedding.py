@@ -70,9 +70,10 @@ class SinusoidalElapsedTimeEmbedding(BasePositionalEmbedding):
         x_embed = torch.cat([x_embed, pos_embedding], dim=2)
         return x_embed, None
 
-    def forward_step(self, x, i=0, metadata_dict={}):
+    def forward_step(self, x, i=0, h=None, metadata_dict={}):
         if not self.expand_channels:
-            raise NotImplementedError
+            return self.forward_event_step(x, i=i, h=h,
+                                           metadata_dict=metadata_dict)
 
         # time_shift must be the last feature
         assert self.dataloader_generator.features.index('time_shift') == len(
@@ -124,3 +125,36 @@ class SinusoidalElapsedTimeEmbedding(BasePositionalEmbedding):
                 h = torch.zeros_like(h)
 
         return x_embed, h
+
+    def forward_event_step(self, x, i, h, metadata_dict):
+        """
+        Event-level forward_step (expand_channels is False)
+
+        Args:
+            x (batch_size, embedding_dim): embedding of event i
+            i (int): event index
+            h: value returned for event i - 1, None if unknown
+            (see compute_elapsed_time_step)
+        """
+        if self.mask_positions:
+            raise NotImplementedError
+
+        batch_size = x.size(0)
+        elapsed_time, h = self.data_processor.compute_elapsed_time_step(
+            metadata_dict, event_index=i, h=h)
+        # TODO scale?! only 10?!
+        elapsed_time = elapsed_time.unsqueeze(1) * 100
+
+        pe = torch.zeros(batch_size, self.positional_embedding_size)
+        pe = pe.to(device=x.device)
+        div_term = torch.exp(
+            torch.arange(0, self.positional_embedding_size, 2).float() *
+            (-math.log(10000.0) / self.positional_embedding_size))
+        div_term = div_term.to(device=x.device)
+        div_term = div_term.unsqueeze(0)
+        pe[:, 0::2] = torch.sin(elapsed_time * div_term)
+        pe[:, 1::2] = torch.cos(elapsed_time * div_term)
+
+        pe = self.dropout(pe)
+        x_embed = torch.cat([x, pe], dim=1)
+        return x_embed, h
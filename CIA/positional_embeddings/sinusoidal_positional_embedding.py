@@ -43,9 +43,11 @@ class SinusoidalPositionalEmbedding(BasePositionalEmbedding):
         return self.dropout(x), None
 
     def forward_step(self, x, i=0, h=None, metadata_dict={}):
-        if not self.expand_channels:
-            raise NotImplementedError
-        pe_index = i // self.num_channels
+        if self.expand_channels:
+            pe_index = i // self.num_channels
+        else:
+            # i is an event index
+            pe_index = i
         pos_embedding = self.pe[:, pe_index].repeat(x.size(0), 1)
 
         x = torch.cat(
@@ -1,6 +1,6 @@
 from CIA.positional_embeddings.positional_embedding import BasePositionalEmbedding
 from torch import nn
-from CIA.utils import flatten
+from CIA.utils import flatten, time_shift_sums
 import torch
 import math
 
@@ -107,7 +107,8 @@ class SinusoidalProgressBarEmbedding(BasePositionalEmbedding):
 
     def forward_step(self, x, i=0, h=None, metadata_dict={}):
         if not self.expand_channels:
-            raise NotImplementedError
+            return self.forward_event_step(x, i=i, h=h,
+                                           metadata_dict=metadata_dict)
 
         assert 'decoding_start' in metadata_dict
         # time_shift must be the last feature
@@ -163,4 +164,58 @@ class SinusoidalProgressBarEmbedding(BasePositionalEmbedding):
                 h = h + elapsed_time
                 h[zeros_location] = 100
 
-        return x_embed, h
\ No newline at end of file
+        return x_embed, h
+
+    def forward_event_step(self, x, i, h, metadata_dict):
+        """
+        Event-level forward_step (expand_channels is False)
+
+        Args:
+            x (batch_size, embedding_dim): embedding of event i
+            i (int): event index
+            h (batch_size, 2): sums of the time shifts before event i - 1
+            and before decoding_start (see time_shift_sums), None if unknown
+        """
+        assert 'decoding_start' in metadata_dict
+        assert 'placeholder_duration' in metadata_dict
+        decoding_start = metadata_dict['decoding_start']
+        placeholder_duration = metadata_dict['placeholder_duration']
+        x_original = metadata_dict['original_sequence']
+        batch_size = x.size(0)
+
+        # h now contains the sum of the time shifts before event i
+        if h is None:
+            h = torch.stack([
+                time_shift_sums(self.dataloader_generator,
+                                x_original[:, :num_events])
+                for num_events in [i, decoding_start]
+            ], dim=1)
+        else:
+            time_shift_sum = h[:, 0] + time_shift_sums(
+                self.dataloader_generator, x_original[:, i - 1:i])
+            h = torch.cat([time_shift_sum.unsqueeze(1), h[:, 1:]], dim=1)
+
+        # TODO no progress bar for prefixes?!
+        if i < decoding_start:
+            elapsed_time = torch.zeros_like(placeholder_duration)
+        else:
+            # same float32 operations as forward
+            zeros_location = (placeholder_duration < 0.01)
+            elapsed_time = (h[:, 0].float() - h[:, 1].float()
+                            ) / placeholder_duration * 100
+            elapsed_time[zeros_location] = 100
+        elapsed_time = elapsed_time.unsqueeze(1)
+
+        pe = torch.zeros(batch_size, self.positional_embedding_size)
+        pe = pe.to(device=x.device)
+        div_term = torch.exp(
+            torch.arange(0, self.positional_embedding_size, 2).float() *
+            (-math.log(10000.0) / self.positional_embedding_size))
+        div_term = div_term.to(device=x.device)
+        div_term = div_term.unsqueeze(0)
+        pe[:, 0::2] = torch.sin(elapsed_time * div_term)
+        pe[:, 1::2] = torch.cos(elapsed_time * div_term)
+
+        pe = self.dropout(pe)
+        x_embed = torch.cat([x, pe], dim=1)
+        return x_embed, h
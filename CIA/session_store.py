@@ -0,0 +1,82 @@
+from collections import OrderedDict
+import sys
+import threading
+import time
+
+import torch
+
+
+def session_num_bytes(value):
+    """Memory used by a session: the tensors and the python objects
+    (e.g. the lists of notes) it contains
+    """
+    if torch.is_tensor(value):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            session_num_bytes(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(session_num_bytes(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class SessionStore:
+    """Server-side sessions (dicts of tensors) shared between requests
+
+    A session expires ttl seconds after its last use; the least recently used
+    sessions are evicted when the stored sessions exceed max_memory bytes
+    (see session_num_bytes).
+    get returns None for missing sessions, so that callers can fall back
+    to the full request payload.
+    """
+    def __init__(self, max_memory, ttl):
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self.memory = 0
+        # key -> (last_access, size, session), least recently used first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, key):
+        with self._lock:
+            now = time.monotonic()
+            self._remove_expired(now)
+            if key not in self._sessions:
+                return None
+            _, size, session = self._sessions.pop(key)
+            self._sessions[key] = (now, size, session)
+            return session
+
+    def put(self, key, session):
+        with self._lock:
+            now = time.monotonic()
+            self._pop(key)
+            size = session_num_bytes(session)
+            self._sessions[key] = (now, size, session)
+            self.memory += size
+            self._remove_expired(now)
+            while self.memory > self.max_memory and len(self._sessions) > 0:
+                _, (_, size, _) = self._sessions.popitem(last=False)
+                self.memory -= size
+
+    def pop(self, key):
+        with self._lock:
+            return self._pop(key)
+
+    def _pop(self, key):
+        # lock must be held
+        if key not in self._sessions:
+            return None
+        _, size, session = self._sessions.pop(key)
+        self.memory -= size
+        return session
+
+    def _remove_expired(self, now):
+        while len(self._sessions) > 0:
+            key, (last_access, _, _) = next(iter(self._sessions.items()))
+            if now - last_access <= self.ttl:
+                break
+            self._pop(key)
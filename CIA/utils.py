@@ -7,16 +7,38 @@ from torch import nn
 import torch.distributed as dist
 
 
+# device of the models and data, see set_device
+_device = None
+
+
+def set_device(device):
+    """Sets the device used by cuda_variable
+    ('cpu' for CPU-only inference, without process group)
+    """
+    global _device
+    _device = torch.device(device)
+
+
+def get_device():
+    """Device set by set_device,
+    cuda:<rank> by default if cuda is available
+    """
+    global _device
+    if _device is None:
+        if torch.cuda.is_available():
+            rank = dist.get_rank() if dist.is_initialized() else 0
+            _device = torch.device(f'cuda:{rank}')
+        else:
+            _device = torch.device('cpu')
+    return _device
+
+
 def cuda_variable(tensor, non_blocking=False):
-    if torch.cuda.is_available():
-        # return tensor.to('cuda', non_blocking=non_blocking)
-        return tensor.to(f'cuda:{dist.get_rank()}', non_blocking=non_blocking)
-    else:
-        return tensor
+    return tensor.to(get_device(), non_blocking=non_blocking)
 
 
 def is_main_process():
-    return dist.get_rank() == 0
+    return not dist.is_initialized() or dist.get_rank() == 0
 
 
 def get_free_port():
@@ -26,7 +48,7 @@ def get_free_port():
     
 
 def all_reduce_scalar(scalar, average=True):
-    t = torch.Tensor([scalar]).to(f'cuda:{dist.get_rank()}')
+    t = torch.Tensor([scalar]).to(get_device())
     dist.all_reduce(t)
     scalar = t[0].detach().item()
     if average:
@@ -229,6 +251,24 @@ def unflatten(sequence, num_channels):
     return chorale
 
 
+def time_shift_sums(dataloader_generator, x):
+    """Sums of the time shifts of the events of x
+    (batch_size, num_events, num_channels), in float64
+
+    float64 is the accumulator of cumsum on CPU: rounded to float32, these sums
+    are the elapsed times computed by dataloader_generator.get_elapsed_time(x),
+    so that the recurrent steps can accumulate them without drifting
+    """
+    batch_size, num_events, num_channels = x.size()
+    if num_events == 0:
+        return torch.zeros(batch_size, dtype=torch.float64, device=x.device)
+    # the elapsed time of a single event is its time shift
+    time_shifts = dataloader_generator.get_elapsed_time(
+        x.reshape(batch_size * num_events, 1, num_channels)).view(
+            batch_size, num_events)
+    return time_shifts.double().cumsum(dim=1)[:, -1]
+
+
 def timing_gpu():
     """
     Just to remember how to time gpus operation
@@ -332,6 +372,48 @@ def top_k_top_p_filtering(logits,
     return logits
 
 
+def top_k_top_p_sampling(logits, temperature=1., top_k=0, top_p=0.0):
+    """ Batched version of top_k_top_p_filtering followed by sampling,
+    done on the device of logits
+        Args:
+            logits: logits distribution shape (batch_size, vocabulary size)
+            temperature, top_k, top_p: scalars or tensors of shape (batch_size,),
+                same meaning as in top_k_top_p_filtering
+        Returns:
+            sampled indices of shape (batch_size,)
+    """
+    assert logits.dim() == 2
+    batch_size, num_tokens = logits.size()
+    device = logits.device
+    temperature, top_p = map(
+        lambda t: torch.as_tensor(t, dtype=logits.dtype, device=device).reshape(-1, 1),
+        (temperature, top_p))
+    top_k = torch.as_tensor(top_k, device=device).reshape(-1, 1)
+
+    sorted_logits, sorted_indices = torch.sort(logits / temperature,
+                                               descending=True,
+                                               dim=-1)
+    # top-k on the sorted logits: keep the top_k first ones
+    ranks = torch.arange(num_tokens, device=device).unsqueeze(0)
+    sorted_indices_to_remove = (top_k > 0) & (ranks >= top_k)
+    sorted_logits = sorted_logits.masked_fill(sorted_indices_to_remove,
+                                              -float('Inf'))
+
+    # top-p on what remains
+    cumulative_probs = torch.cumsum(torch.softmax(sorted_logits, dim=-1),
+                                    dim=-1)
+    # Shift to the right to keep also the first token above the threshold
+    cumulative_probs = torch.cat(
+        [torch.zeros_like(cumulative_probs[:, :1]), cumulative_probs[:, :-1]],
+        dim=-1)
+    sorted_indices_to_remove = (top_p > 0.0) & (cumulative_probs > top_p)
+    sorted_logits = sorted_logits.masked_fill(sorted_indices_to_remove,
+                                              -float('Inf'))
+
+    sampled = torch.multinomial(torch.softmax(sorted_logits, dim=-1), 1)
+    return sorted_indices.gather(-1, sampled).squeeze(-1)
+
+
 def concat_elu(x):
     """ like concatenated ReLU (http://arxiv.org/abs/1603.05201), but then with ELU """
     # Pytorch ordering
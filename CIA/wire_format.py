@@ -0,0 +1,89 @@
+import json
+import struct
+import numpy as np
+
+# content type of the binary requests and responses of app.py
+CONTENT_TYPE = 'application/x-cia-notes'
+# little-endian struct-of-arrays layout of a list of notes
+NOTE_FIELDS = (('pitch', '<u1'), ('velocity', '<u1'), ('time', '<f8'),
+               ('duration', '<f8'))
+_NOTES_KEY = '$notes'
+
+
+def is_note_list(value):
+    return (isinstance(value, list) and len(value) > 0 and all(
+        isinstance(note, dict) and all(field in note
+                                       for field, _ in NOTE_FIELDS)
+        for note in value))
+
+
+def dumps(data):
+    """Encodes data (a JSON-serializable object) in the binary wire format
+
+    Layout:
+        uint32 size of the header, header (UTF-8 JSON), arrays
+    The header is {'data': data, 'notes': [num_notes_0, num_notes_1...]}
+    where the i-th list of note dicts of data is replaced by {'$notes': i};
+    for each of these lists, the arrays are its columns
+    (pitch, velocity, time, duration, see NOTE_FIELDS) in this order.
+    Other keys of the note dicts (muted) are not transmitted.
+    """
+    note_lists = []
+
+    def replace_note_lists(value):
+        if is_note_list(value):
+            note_lists.append(value)
+            return {_NOTES_KEY: len(note_lists) - 1}
+        if isinstance(value, dict):
+            return {k: replace_note_lists(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [replace_note_lists(v) for v in value]
+        return value
+
+    header = json.dumps(
+        dict(data=replace_note_lists(data),
+             notes=[len(notes) for notes in note_lists]),
+        separators=(',', ':')).encode('utf-8')
+    chunks = [struct.pack('<I', len(header)), header]
+    for notes in note_lists:
+        for field, dtype in NOTE_FIELDS:
+            chunks.append(
+                np.array([note[field] for note in notes],
+                         dtype=dtype).tobytes())
+    return b''.join(chunks)
+
+
+def loads(body):
+    """Decodes a message encoded with dumps
+
+    The lists of notes are decoded as dicts of numpy arrays
+    (pitch, velocity, time, duration), without going through Python objects
+    """
+    body = memoryview(body)
+    header_size, = struct.unpack_from('<I', body, 0)
+    header = json.loads(bytes(body[4:4 + header_size]).decode('utf-8'))
+
+    columns = []
+    offset = 4 + header_size
+    for num_notes in header['notes']:
+        notes = {}
+        for field, dtype in NOTE_FIELDS:
+            notes[field] = np.frombuffer(body,
+                                         dtype=dtype,
+                                         count=num_notes,
+                                         offset=offset)
+            offset += num_notes * np.dtype(dtype).itemsize
+        columns.append(notes)
+    if offset != len(body):
+        raise ValueError('wrong message size')
+
+    def replace_placeholders(value):
+        if isinstance(value, dict):
+            if len(value) == 1 and _NOTES_KEY in value:
+                return columns[value[_NOTES_KEY]]
+            return {k: replace_placeholders(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [replace_placeholders(v) for v in value]
+        return value
+
+    return replace_placeholders(header['data'])
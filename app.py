@@ -1,13 +1,19 @@
 from CIA.data_processors.data_processor import DataProcessor
 import json
 from flask import Flask
-from flask import request
+from flask import request, Response
 from flask.helpers import make_response
-from flask.json import JSONDecoder, jsonify
+from flask.json import JSONDecoder, jsonify, dumps
 from torch.utils import data
-from CIA.utils import cuda_variable, get_free_port
+from CIA.utils import cuda_variable, get_free_port, set_device
 from flask_cors import CORS
-from CIA.handlers import DecoderPrefixHandler
+from CIA.handlers import DecoderPrefixHandler, DecoderEventsHandler
+from CIA.handlers.state_cache import PrefixStateCache
+from CIA.session_store import SessionStore
+from CIA.jobs import JobQueue
+from CIA.handlers.scheduler import ContinuousBatchingScheduler
+from CIA import wire_format
+import queue
 
 app = Flask(__name__)
 CORS(app)
@@ -21,6 +27,8 @@ import shutil
 from datetime import datetime
 
 import click
+import numbers
+import numpy as np
 import torch
 
 import torch.multiprocessing as mp
@@ -29,6 +37,28 @@ from torch.nn.parallel import DistributedDataParallel
 from CIA.getters import get_data_processor, get_dataloader_generator, get_decoder, get_handler, get_sos_embedding, get_positional_embedding
 
 DEBUG = False
+# memory (in bytes) used to keep the states of recent contexts
+# so that regenerations do not recompute them
+STATE_CACHE_MAX_MEMORY = 2 * 1024**3
+# sessions of the 'continue' case, keyed by (clip_id, detail_clip_id)
+SESSION_MAX_MEMORY = 512 * 1024**2
+SESSION_TTL = 60 * 60
+sessions = SessionStore(max_memory=SESSION_MAX_MEMORY, ttl=SESSION_TTL)
+# with the scheduler, requests are processed by NUM_INFERENCE_WORKERS threads
+# (which only wait for the scheduler); otherwise by a single thread,
+# which owns the model. At most MAX_QUEUED_JOBS requests can wait
+NUM_INFERENCE_WORKERS = 8
+MAX_QUEUED_JOBS = 16
+jobs = None
+# generation of the requests of all workers in a single running batch
+# of at most MAX_BATCH_SIZE sequences
+MAX_BATCH_SIZE = 16
+# contexts of new requests are processed by chunks of PREFILL_CHUNK_SIZE events
+# interleaved with the generation steps of the running requests
+PREFILL_CHUNK_SIZE = 128
+scheduler = None
+# see get_index2value_tables
+index2value_tables = None
 
 
 @click.command()
@@ -36,7 +66,13 @@ DEBUG = False
 @click.option('-o', '--overfitted', is_flag=True)
 @click.option('-c', '--config', type=click.Path(exists=True))
 @click.option('-n', '--num_workers', type=int, default=0)
-def launcher(cmd, overfitted, config, num_workers):
+@click.option('--cpu', is_flag=True)
+@click.option('--num_threads', type=int, default=None)
+@click.option('--num_interop_threads', type=int, default=None)
+@click.option('--quantize', is_flag=True)
+@click.option('--freeze', is_flag=True)
+def launcher(cmd, overfitted, config, num_workers, cpu, num_threads,
+             num_interop_threads, quantize, freeze):
     # === Init process group
     os.environ['MASTER_ADDR'] = 'localhost'
     os.environ['MASTER_PORT'] = str(get_free_port())
@@ -61,17 +97,50 @@ def launcher(cmd, overfitted, config, num_workers):
     # Create or retreive model_dir
     model_dir = os.path.dirname(config_path)
 
+    assert cpu or not quantize, 'quantized inference is only implemented on CPU'
+    if freeze and config['handler_type'] != 'event':
+        raise click.UsageError(
+            '--freeze is only implemented for the event handler '
+            f'(handler_type is {config["handler_type"]})')
+    if cpu:
+        # no process group: serve from this process
+        print('Using CPU')
+        main(0, overfitted, config, num_workers, world_size, model_dir, cpu,
+             num_threads, num_interop_threads, quantize, freeze)
+        return
+
     print(f'Using {world_size} GPUs')
     mp.spawn(main,
-             args=(overfitted, config, num_workers, world_size, model_dir),
+             args=(overfitted, config, num_workers, world_size, model_dir,
+                   cpu, num_threads, num_interop_threads, quantize, freeze),
              nprocs=world_size,
              join=True)
 
 
-def main(rank, overfitted, config, num_workers, world_size, model_dir):
-    dist.init_process_group(backend='nccl', world_size=world_size, rank=rank)
-    torch.cuda.set_device(rank)
-    device = f'cuda:{rank}'
+def main(rank,
+         overfitted,
+         config,
+         num_workers,
+         world_size,
+         model_dir,
+         cpu=False,
+         num_threads=None,
+         num_interop_threads=None,
+         quantize=False,
+         freeze=False):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        torch.set_num_interop_threads(num_interop_threads)
+    if cpu:
+        device = 'cpu'
+    else:
+        dist.init_process_group(backend='nccl',
+                                world_size=world_size,
+                                rank=rank)
+        torch.cuda.set_device(rank)
+        device = f'cuda:{rank}'
+    set_device(device)
 
     # === Decoder ====
     # dataloader generator
@@ -106,9 +175,11 @@ def main(rank, overfitted, config, num_workers, world_size, model_dir):
                           handler_type=config['handler_type'])
 
     decoder.to(device)
-    decoder = DistributedDataParallel(module=decoder,
-                                      device_ids=[rank],
-                                      output_device=rank)
+    # the CPU-only model is not wrapped (see Handler.module)
+    if not cpu:
+        decoder = DistributedDataParallel(module=decoder,
+                                          device_ids=[rank],
+                                          output_device=rank)
 
     global handler
     handler = get_handler(handler_type=config['handler_type'],
@@ -122,6 +193,32 @@ def main(rank, overfitted, config, num_workers, world_size, model_dir):
     else:
         handler.load(early_stopped=True)
 
+    if freeze:
+        # before quantize: the fused projections are quantized as a whole
+        x, metadata_dict = example_inpainting_input()
+        error = handler.freeze_for_inference(x, metadata_dict)
+        print(f'Model frozen for inference (max abs error {error})')
+
+    if quantize:
+        handler.quantize()
+
+    if isinstance(handler, DecoderEventsHandler):
+        handler.state_cache = PrefixStateCache(
+            max_memory=STATE_CACHE_MAX_MEMORY)
+
+    global scheduler
+    if ContinuousBatchingScheduler.supports(handler):
+        scheduler = ContinuousBatchingScheduler(
+            handler,
+            max_batch_size=MAX_BATCH_SIZE,
+            prefill_chunk_size=PREFILL_CHUNK_SIZE)
+
+    global jobs
+    jobs = JobQueue(run=run_invocation,
+                    num_workers=(NUM_INFERENCE_WORKERS
+                                 if scheduler is not None else 1),
+                    max_queue_size=MAX_QUEUED_JOBS)
+
     local_only = False
     if local_only:
         # accessible only locally:
@@ -144,17 +241,208 @@ def ping():
 
 @app.route('/invocations', methods=['POST'])
 def invocations():
+    """The request and the response are JSON,
+    or use the binary wire format (see CIA.wire_format)
+    if the Content-Type, resp. Accept, header is wire_format.CONTENT_TYPE
+    """
+    d = request_data()
+    job, error_response = submit_job(d)
+    if job is None:
+        return error_response
+    job.wait()
+    jobs.pop(job.id)
+    if job.status == 'error':
+        return make_response(jsonify({'error': job.error}), 500)
+    return notes_response(job.result)
+
+
+@app.route('/invocations_stream', methods=['POST'])
+def invocations_stream():
+    """Same as /invocations, as server-sent events:
+    an 'event' message is sent for each note as soon as it is generated
+    (not rescaled to the selected region),
+    then an 'end' message contains the response of /invocations
+    (done, track_duration, notes_after_region...)
+    """
+    d = request_data()
+    job, error_response = submit_job(d)
+    if job is None:
+        return error_response
+
+    def messages():
+        for event in job.iter_events():
+            yield server_sent_event('event', event)
+        jobs.pop(job.id)
+        if job.status == 'error':
+            yield server_sent_event('error', {'error': job.error})
+        else:
+            yield server_sent_event('end', job.result)
+
+    return Response(messages(), mimetype='text/event-stream')
+
+
+@app.route('/jobs', methods=['POST'])
+def post_job():
+    """Asynchronous version of /invocations:
+    returns the id of the job to be polled with GET /jobs/<job_id>
+    """
+    d = request_data()
+    job, error_response = submit_job(d)
+    if job is None:
+        return error_response
+    return make_response(jsonify({'id': job.id, 'status': job.status}), 202)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """status of the job, notes generated so far (events)
+    and response of /invocations (result) once done
+
+    Finished jobs are forgotten once they have been fetched
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return make_response(jsonify({'error': 'unknown job'}), 404)
+    job_dict = job.to_dict()
+    if job_dict['status'] in ['done', 'error']:
+        jobs.pop(job_id)
+    return notes_response(job_dict)
+
+
+def request_data():
+    """Body of the request, decoded according to its Content-Type
+    (JSON or binary wire format, whose notes are decoded as columns)
+    """
+    if request.mimetype == wire_format.CONTENT_TYPE:
+        return wire_format.loads(request.get_data())
+    return json.loads(request.data)
+
+
+def notes_response(data):
+    """JSON response, or binary wire format response if the client
+    prefers it (Accept header)
+    """
+    if request.accept_mimetypes.best_match(
+        ['application/json', wire_format.CONTENT_TYPE]) == wire_format.CONTENT_TYPE:
+        return Response(wire_format.dumps(data),
+                        mimetype=wire_format.CONTENT_TYPE)
+    return jsonify(data)
+
+
+def submit_job(d):
+    """Adds a request to /invocations to the job queue
+
+    Returns:
+        (job, None), or (None, error response) if the queue is full
+    """
+    try:
+        return jobs.submit(d), None
+    except queue.Full:
+        return None, make_response(jsonify({'error': 'too many requests'}),
+                                   503)
+
+
+def run_invocation(d):
+    """Processes a request to /invocations in an inference worker
+    (see JobQueue)
+
+    yields an ('event', data) message for each generated note
+    and finally ('end', response of /invocations)
+    """
+    inputs = parse_invocation(d)
+
+    global handler
+    time_shift_table = get_index2value_tables()['time_shift']
+    time_shift_index = handler.dataloader_generator.get_feature_index(
+        'time_shift')
+    x = inputs['x']
+    beats_per_second = inputs['beats_per_second']
+    events = inpainting_events(
+        x=x,
+        metadata_dict=inputs['metadata_dict'],
+        top_p=inputs['top_p'],
+        num_max_generated_events=inputs['num_max_generated_events'])
+
+    # start time of the next note of each proposal
+    start_times = [inputs['selected_region']['start']] * x.size(0)
+    while True:
+        try:
+            event_index, generated = next(events)
+        except StopIteration as stop:
+            x_inpainted, generated_region, decoding_end, num_event_generated, done = stop.value
+            break
+
+        event = x[:, event_index].cpu()
+        for k, is_generated in enumerate(generated.tolist()):
+            if not is_generated:
+                continue
+            notes, _ = tensor_to_ableton(event[k:k + 1],
+                                         start_time=start_times[k],
+                                         beats_per_second=beats_per_second)
+            start_times[k] += time_shift_table[event[
+                k, time_shift_index].item()] * beats_per_second
+            yield 'event', {
+                'id': d['id'],
+                'proposal': k,
+                'event_index': event_index,
+                'note': notes[0]
+            }
+
+    yield 'end', invocation_response(d, inputs, generated_region, done)
+
+
+def inpainting_events(x, metadata_dict, top_p, num_max_generated_events):
+    """Same as DecoderEventsHandler.inpaint_iterator:
+    generated along with the other running requests by the scheduler if any,
+    otherwise by the handler alone
+    (without intermediate events if it has no inpaint_iterator)
+    """
+    global handler
+    if scheduler is not None:
+        inpainting_request = scheduler.submit(
+            x=x,
+            metadata_dict=metadata_dict,
+            temperature=1.,
+            top_p=top_p,
+            top_k=0,
+            num_max_generated_events=num_max_generated_events)
+        yield from inpainting_request.iter_events()
+        return inpainting_request.wait()
+    if hasattr(handler, 'inpaint_iterator'):
+        return (yield from handler.inpaint_iterator(
+            x=x,
+            metadata_dict=metadata_dict,
+            temperature=1.,
+            top_p=top_p,
+            top_k=0,
+            num_max_generated_events=num_max_generated_events))
+    return handler.inpaint_non_optimized(
+        x=x,
+        metadata_dict=metadata_dict,
+        temperature=1.,
+        top_p=top_p,
+        top_k=0,
+        num_max_generated_events=num_max_generated_events)
+
 
-    # === Parse request ===
-    # common components
-    d = json.loads(request.data)
+def server_sent_event(event, data):
+    return f'event: {event}\ndata: {dumps(data)}\n\n'
+
+
+def parse_invocation(d):
+    """Parses a request to /invocations
+
+    Returns:
+        dict containing the inputs of handler.inpaint (one row per proposal)
+        and the quantities needed to build the response
+    """
     case = d['case']
     assert case in ['start', 'continue']
     if DEBUG:
         print(d)
 
-    notes = d['notes']
     top_p = float(d['top_p'])
+    num_proposals = int(d.get('num_proposals', 1))
     selected_region = d['selected_region']
     if 'clip_start' not in d:
         clip_start = selected_region['start']
@@ -164,10 +452,16 @@ def invocations():
     tempo = d['tempo']
     beats_per_second = tempo / 60
     seconds_per_beat = 1 / beats_per_second
+    session_key = (d['clip_id'], d['detail_clip_id'])
+    # only return the notes of the generated regions (see invocation_response)
+    delta = bool(d.get('delta', False))
+    # notes of the context, if they are already known (see context_notes)
+    context_notes = None
 
     # two different parsing methods
     if case == 'start':
         num_max_generated_events = 15
+        notes = d['notes']
         (x, metadata_dict, unused_before, before, after, unused_after,
          clip_start, selected_region,
          region_after_start_time) = ableton_to_tensor(notes, clip_start,
@@ -175,128 +469,399 @@ def invocations():
                                                       selected_region)
     elif case == 'continue':
         num_max_generated_events = 20
-        notes_before = d['notes_before_next_region']
-        notes_after = d['notes_after_region']
+        # the notes of the payload are always used when they are sent,
+        # since the clip may have been edited since the previous request:
+        # the session is only used by clients which omit them
+        use_session = ('notes_before_next_region' not in d
+                       and 'notes_after_region' not in d)
+        session = sessions.get(session_key) if use_session else None
+        proposal_index = int(d.get('proposal', 0))
+        if (session is not None and session['tempo'] == tempo
+                and proposal_index < len(session['proposals'])
+                and session['proposals'][proposal_index] is not None):
+            x, metadata_dict, unused_before, before, after, unused_after, selected_region, region_after_start_time = session_to_tensor(
+                session, proposal_index, seconds_per_beat, selected_region)
+            context_notes = (
+                session['proposals'][proposal_index]['history_notes'],
+                session['after_notes'])
+        elif use_session:
+            raise ValueError(
+                'no session for this clip and proposal (expired, evicted '
+                'or different tempo): notes_before_next_region and '
+                'notes_after_region must be sent')
+        else:
+            notes_before = d['notes_before_next_region']
+            notes_after = d['notes_after_region']
 
-        # selected_region does NOT contain the right start!
-        x, metadata_dict, unused_before, before, after, unused_after, selected_region, region_after_start_time = json_to_tensor(
-            notes_before, notes_after, seconds_per_beat, selected_region)
+            # selected_region does NOT contain the right start!
+            x, metadata_dict, unused_before, before, after, unused_after, selected_region, region_after_start_time = json_to_tensor(
+                notes_before, notes_after, seconds_per_beat, selected_region)
     else:
         raise NotImplementedError
 
+    # all proposals are generated in parallel
+    x, metadata_dict = repeat_proposals(x, metadata_dict, num_proposals)
+
+    return dict(x=x,
+                metadata_dict=metadata_dict,
+                unused_before=unused_before,
+                before=before,
+                after=after,
+                unused_after=unused_after,
+                clip_start=clip_start,
+                selected_region=selected_region,
+                region_after_start_time=region_after_start_time,
+                num_max_generated_events=num_max_generated_events,
+                num_proposals=num_proposals,
+                top_p=top_p,
+                tempo=tempo,
+                beats_per_second=beats_per_second,
+                seconds_per_beat=seconds_per_beat,
+                session_key=session_key,
+                delta=delta,
+                context_notes=context_notes)
+
+
+def invocation_response(d, inputs, generated_region, done):
+    """Converts the generated regions to the response of /invocations
+    and stores the session used by the next 'continue' requests
+
+    If the request contains 'delta': true, the notes of the whole clip
+    (notes, notes_before_next_region and notes_after_region),
+    which the client already has, are not returned:
+    notes_region replaces the notes of the clip in selected_region.
+    """
+    beats_per_second = inputs['beats_per_second']
+    # notes of the context, relative to the start of their segment
+    if inputs['context_notes'] is None:
+        before_notes, after_notes = context_notes(inputs['unused_before'],
+                                                  inputs['before'],
+                                                  inputs['after'],
+                                                  inputs['unused_after'],
+                                                  beats_per_second)
+    else:
+        before_notes, after_notes = inputs['context_notes']
+
+    ableton_notes_after_region = shift_notes(
+        after_notes, float(inputs['region_after_start_time']))  # TODO Check!,
+
+    proposals, history_notes = zip(*[
+        proposal_to_ableton(generated_region=generated_region[k],
+                            done=done[k],
+                            unused_before=inputs['unused_before'],
+                            before=inputs['before'],
+                            clip_start=inputs['clip_start'],
+                            selected_region=inputs['selected_region'],
+                            before_notes=before_notes,
+                            after_notes=after_notes,
+                            ableton_notes_after_region=ableton_notes_after_region,
+                            beats_per_second=beats_per_second,
+                            seconds_per_beat=inputs['seconds_per_beat'],
+                            delta=inputs['delta'])
+        for k in range(inputs['num_proposals'])
+    ])
+    proposals = list(proposals)
+
+    sessions.put(
+        inputs['session_key'],
+        make_session(x=inputs['x'],
+                     unused_before=inputs['unused_before'],
+                     before=inputs['before'],
+                     after=inputs['after'],
+                     unused_after=inputs['unused_after'],
+                     generated_region=generated_region,
+                     history_notes=history_notes,
+                     after_notes=after_notes,
+                     clip_start=inputs['clip_start'],
+                     tempo=inputs['tempo']))
+
+    # first proposal is also returned at the top level
+    response = {
+        'id': d['id'],
+        **proposals[0],
+        'top_p': inputs['top_p'],
+        'selected_region': inputs['selected_region'],
+        'notes_after_region': ableton_notes_after_region,
+        'clip_start': inputs['clip_start'],
+        'clip_id': d['clip_id'],
+        'clip_end': d['clip_end'],
+        'detail_clip_id': d['detail_clip_id'],
+        'tempo': d['tempo'],
+        'proposals': proposals
+    }
+    if inputs['delta']:
+        del response['notes_after_region']
+    return response
+
+
+def context_notes(unused_before, before, after, unused_after,
+                  beats_per_second):
+    """Notes of unused_before + before and of after + unused_after,
+    with times relative to the start of each segment
+
+    These are kept in the sessions, so that the context is not detokenized
+    again by the next requests.
+    """
+    before_notes, _ = tensor_to_ableton(torch.cat(
+        [unused_before[0], before[0]], dim=0),
+                                        start_time=0,
+                                        beats_per_second=beats_per_second)
+    after_notes, _ = tensor_to_ableton(torch.cat(
+        [after[0], unused_after[0]], dim=0),
+                                       start_time=0,
+                                       beats_per_second=beats_per_second)
+    return before_notes, after_notes
+
+
+def shift_notes(notes, start_time):
+    return [dict(note, time=note['time'] + start_time) for note in notes]
+
+
+def segment_duration(tensor, beats_per_second):
+    """Time (in beats) between the first event of tensor (num_events, num_channels)
+    and the event following it
+    """
+    if tensor.size(0) == 0:
+        return 0.
+    time_shifts = get_index2value_tables()['time_shift'][
+        tensor[:, 3].detach().cpu().numpy()].astype(np.float32)
+    return np.cumsum(time_shifts)[-1].item() * beats_per_second
+
+
+def repeat_proposals(x, metadata_dict, num_proposals):
+    """Repeats x and the per-row entries of metadata_dict
+    num_proposals times along the batch dimension
+    """
+    x = x.repeat(num_proposals, 1, 1)
+    metadata_dict = dict(
+        metadata_dict,
+        original_sequence=x,
+        placeholder_duration=metadata_dict['placeholder_duration'].repeat(
+            num_proposals))
+    return x, metadata_dict
+
+
+def make_session(x, unused_before, before, after, unused_after,
+                 generated_region, history_notes, after_notes, clip_start,
+                 tempo):
+    """Tokenized sequences kept between requests on the same clip,
+    so that a 'continue' request does not need to parse and tokenize
+    notes_before_next_region and notes_after_region again
+
+    The notes of these sequences (history_notes and after_notes,
+    see context_notes) are kept as well, so that they are not detokenized again.
+    All tensors are copied, so that they do not keep x alive.
+    """
+    global data_processor
+    num_events_before = data_processor.num_events_before
+    num_events_after = data_processor.num_events_after
+    session_proposals = []
+    for region, proposal_history_notes in zip(generated_region, history_notes):
+        if len(proposal_history_notes) == 0:
+            session_proposals.append(None)
+            continue
+        region = region.unsqueeze(0)
+        session_proposals.append(
+            dict(
+                # notes before the next region (without padding)
+                history=torch.cat([unused_before, before, region], dim=1),
+                history_notes=proposal_history_notes,
+                # same, as it appears in x
+                padded_before=torch.cat([x[:1, :num_events_before], region],
+                                        dim=1)[:, -num_events_before:],
+                # in beats
+                start_time=clip_start + proposal_history_notes[-1]['time']))
+    return dict(tempo=tempo,
+                after=after.clone(),
+                unused_after=unused_after.clone(),
+                after_notes=after_notes,
+                padded_after=x[:1, num_events_before + 1:num_events_before +
+                               1 + num_events_after].clone(),
+                proposals=session_proposals)
+
+
+def session_to_tensor(session, proposal_index, seconds_per_beat,
+                      selected_region):
+    """Same as json_to_tensor, but starts from the tokenized sequences
+    of the proposal proposal_index kept in session (see make_session)
+    """
+    global data_processor
     global handler
+    proposal = session['proposals'][proposal_index]
+    time_shift_index = handler.dataloader_generator.get_feature_index(
+        'time_shift')
+
+    # the new region starts at the onset of the last note of before:
+    # set the last time shift of before to zero
+    zero_time_shift = data_processor.quantize_time_shift(0.)
+    history = proposal['history'].clone()
+    history[:, -1, time_shift_index] = zero_time_shift
+    padded_before = proposal['padded_before'].clone()
+    padded_before[:, -1, time_shift_index] = zero_time_shift
+
+    start_time = proposal['start_time']
+    end_time = selected_region['end']
+    region_after_start_time = end_time
+    # update_selected_region
+    selected_region['start'] = start_time
 
-    x_inpainted, generated_region, decoding_end, num_event_generated, done = handler.inpaint_non_optimized(
-        x=x,
-        metadata_dict=metadata_dict,
-        temperature=1.,
-        top_p=top_p,
-        top_k=0,
-        num_max_generated_events=num_max_generated_events)
+    placeholder_duration = (end_time - start_time) * seconds_per_beat
+    placeholder_duration = cuda_variable(torch.Tensor([placeholder_duration]))
+    placeholder, placeholder_duration_token = data_processor.compute_placeholder(
+        placeholder_duration=placeholder_duration, batch_size=1)
+
+    num_events_before = data_processor.num_events_before
+    unused_before, before = (history[:, :-num_events_before],
+                             history[:, -num_events_before:])
+
+    middle_length = (data_processor.dataloader_generator.sequences_size -
+                     data_processor.num_events_before -
+                     data_processor.num_events_after - 2)
 
-    new_x = torch.cat([
-        unused_before[0], before[0], generated_region[0], after[0],
-        unused_after[0]
+    # create x:
+    x = torch.cat([
+        padded_before, placeholder, session['padded_after'],
+        data_processor.sod_symbols.unsqueeze(0).unsqueeze(0),
+        cuda_variable(
+            torch.zeros(1, middle_length, data_processor.num_channels))
     ],
-                      dim=0).detach().cpu()
+                  dim=1).long()
 
-    ableton_notes, track_duration = tensor_to_ableton(
-        new_x,
-        start_time=clip_start,
-        beats_per_second=beats_per_second,
-        rescale=False)
+    metadata_dict = dict(original_sequence=x,
+                         placeholder_duration=placeholder_duration,
+                         decoding_start=data_processor.num_events_before +
+                         data_processor.num_events_after + 2)
 
+    return x, metadata_dict, unused_before, before, session['after'], session[
+        'unused_after'], selected_region, region_after_start_time
+
+
+def proposal_to_ableton(generated_region, done, unused_before, before,
+                        clip_start, selected_region, before_notes, after_notes,
+                        ableton_notes_after_region, beats_per_second,
+                        seconds_per_beat, delta=False):
+    """Converts one generated region to the notes returned by /invocations
+
+    Only generated_region is detokenized, the notes of the whole clip are
+    obtained from the notes of the context (before_notes and after_notes,
+    see context_notes).
+
+    Returns:
+        the proposal and the notes of unused_before + before + generated_region
+        relative to their start (history_notes of the session)
+    """
     ableton_notes_region, _ = tensor_to_ableton(
-        generated_region[0].detach().cpu(),
+        generated_region.detach().cpu(),
         start_time=selected_region['start'],
         expected_duration=(selected_region['end'] - selected_region['start']) *
         seconds_per_beat,
         beats_per_second=beats_per_second,
         rescale=done)
 
-    after_region = torch.cat([after[0], unused_after[0]],
-                             dim=0).detach().cpu()
-
-    ableton_notes_after_region, _ = tensor_to_ableton(
-        after_region,
-        start_time=region_after_start_time,  # TODO Check!,
-        beats_per_second=beats_per_second)
+    # generated region as it appears in notes (not rescaled)
+    region_notes, _ = tensor_to_ableton(generated_region.detach().cpu(),
+                                        start_time=0,
+                                        beats_per_second=beats_per_second)
+    region_start_time = segment_duration(
+        torch.cat([unused_before[0], before[0]], dim=0), beats_per_second)
+    after_start_time = region_start_time + segment_duration(
+        generated_region, beats_per_second)
 
     # Contains unused_before, before, generated_region
     # to be used by next requests
-    new_before = torch.cat([unused_before[0], before[0], generated_region[0]],
-                           dim=0).detach().cpu()
-    ableton_notes_new_before, _ = tensor_to_ableton(
-        new_before,
-        start_time=clip_start,
-        beats_per_second=beats_per_second,
-        rescale=False)
-    
+    history_notes = before_notes + shift_notes(region_notes,
+                                               region_start_time)
+
+    # end of the last note of the clip
+    last_notes = (shift_notes(after_notes[-1:], after_start_time)
+                  or history_notes[-1:])
+    if len(last_notes) > 0:
+        track_duration = (clip_start + last_notes[0]['time'] +
+                          last_notes[0]['duration'] * beats_per_second)
+    else:
+        track_duration = 0
+
     ableton_notes_region = shorten_durations(ableton_notes_region,
                                              ableton_notes_after_region)
 
-    print(f'albeton notes: {ableton_notes}')
     print(f'region start: {ableton_notes_region}')
-    d = {
-        'id': d['id'],
-        'notes': ableton_notes,
-        'track_duration': track_duration,
-        'done': done,
-        'top_p': top_p,
-        'selected_region': selected_region,
-        'notes_before_next_region': ableton_notes_new_before,
-        'notes_region': ableton_notes_region,
-        'notes_after_region': ableton_notes_after_region,
-        'clip_start': clip_start,
-        'clip_id': d['clip_id'],
-        'clip_end': d['clip_end'],
-        'detail_clip_id': d['detail_clip_id'],
-        'tempo': d['tempo']
-    }
-    return jsonify(d)
+    if delta:
+        proposal = {
+            'track_duration': track_duration,
+            'done': done,
+            'notes_region': ableton_notes_region,
+        }
+    else:
+        ableton_notes_new_before = shift_notes(history_notes, clip_start)
+        ableton_notes = ableton_notes_new_before + shift_notes(
+            after_notes, clip_start + after_start_time)
+        print(f'albeton notes: {ableton_notes}')
+        proposal = {
+            'notes': ableton_notes,
+            'track_duration': track_duration,
+            'done': done,
+            'notes_before_next_region': ableton_notes_new_before,
+            'notes_region': ableton_notes_region,
+        }
+    return proposal, history_notes
+
 
 def shorten_durations(generated_notes, notes_after):
-    # shorten durations if necessary
-    # (case when two notes overlap are not well-handled by Ableton)
-    # (causes serious issues when generated notes overlap with the region after)
-    d = {}
-    max_end_time = 0
-    for k, note in enumerate(generated_notes):
-        pitch = note['pitch']
-        
-        if pitch in d:            
-            previous_note = generated_notes[d[note['pitch']]]
-            
-            current_time = note['time']
-            previous_note_sounding_end = previous_note['time'] + previous_note['duration']
-            max_end_time = max(max_end_time,
-                               note['time'] + note['duration'])
-            if previous_note_sounding_end > current_time:
-                previous_note['duration'] = current_time - previous_note['time'] - 1e-2
-        
-        d[note['pitch']] = k
-    
-    for k, note in enumerate(notes_after):
-        time = note['time']
-        if time > max_end_time:
-            break
-        
-        if len(d) == 0:
-            break
-        
-        pitch = note['pitch']
-        
-        if pitch in d:            
-            previous_note = generated_notes[d[note['pitch']]]
-            
-            current_time = note['time']
-            previous_note_sounding_end = previous_note['time'] + previous_note['duration']
-            if previous_note_sounding_end > current_time:
-                previous_note['duration'] = current_time - previous_note['time'] - 1e-2
-            del d[pitch]
-        
-    return generated_notes    
-        
+    """Shortens the durations of generated_notes (in place) so that
+    they end before the onset of the next note with the same pitch,
+    either in generated_notes or in notes_after
+
+    (case when two notes overlap are not well-handled by Ableton)
+    (causes serious issues when generated notes overlap with the region after)
+    """
+    if len(generated_notes) == 0:
+        return generated_notes
+    pitch = np.array([note['pitch'] for note in generated_notes])
+    time = np.array([note['time'] for note in generated_notes],
+                    dtype=np.float64)
+    duration = np.array([note['duration'] for note in generated_notes],
+                        dtype=np.float64)
+    new_duration = duration.copy()
+
+    # notes grouped by pitch, in order of appearance within each pitch
+    order = np.argsort(pitch, kind='stable')
+    is_followed = pitch[order][1:] == pitch[order][:-1]
+    previous_notes = order[:-1][is_followed]
+    next_notes = order[1:][is_followed]
+    # last note of each pitch, by increasing pitch
+    last_notes = order[np.append(~is_followed, True)]
+
+    # overlaps within the generated notes
+    overlap = (time[previous_notes] + duration[previous_notes] >
+               time[next_notes])
+    new_duration[previous_notes[overlap]] = (
+        time[next_notes[overlap]] - time[previous_notes[overlap]] - 1e-2)
+
+    # overlaps with the first note of each pitch in notes_after
+    # (only the notes_after starting before the end of the
+    # generated notes which follow a note with the same pitch are considered)
+    max_end_time = (time[next_notes] + duration[next_notes]).max(initial=0.)
+    after_time = np.array([note['time'] for note in notes_after],
+                          dtype=np.float64)
+    after_pitch = np.array([note['pitch'] for note in notes_after])
+    num_notes_after = np.argmax(
+        np.append(after_time > max_end_time, True))
+    after_pitch, first_after_notes = np.unique(
+        after_pitch[:num_notes_after], return_index=True)
+    _, last_indices, after_indices = np.intersect1d(pitch[last_notes],
+                                                    after_pitch,
+                                                    assume_unique=True,
+                                                    return_indices=True)
+    last_notes = last_notes[last_indices]
+    next_time = after_time[first_after_notes[after_indices]]
+    overlap = time[last_notes] + duration[last_notes] > next_time
+    new_duration[last_notes[overlap]] = (next_time[overlap] -
+                                         time[last_notes[overlap]] - 1e-2)
+
+    for k in np.flatnonzero(new_duration != duration).tolist():
+        generated_notes[k]['duration'] = new_duration[k].item()
+    return generated_notes
+
 
 def preprocess_input(x, event_start, event_end):
     """
@@ -411,6 +976,73 @@ def preprocess_input(x, event_start, event_end):
 #     return x, num_events_before_padding
 
 
+def parse_ableton_notes(ableton_note_list):
+    """Parses the flat message list sent by Ableton
+    ('notes', num_notes, 'note', pitch, time, duration, velocity, muted, 'note', ..., 'done')
+
+    Returns:
+        pitch, time, duration, velocity numpy arrays (unsorted)
+    """
+    messages = np.array(ableton_note_list, dtype=object)
+    done_positions = np.flatnonzero(messages == 'done')
+    if len(done_positions) > 0:
+        messages = messages[:done_positions[0]]
+    note_positions = np.flatnonzero(messages == 'note')
+    # each 'note' is followed by its pitch, time, duration, velocity
+    note_positions = note_positions[note_positions + 4 < len(messages)]
+    values = messages[note_positions[:, None] +
+                      np.arange(1, 5)[None, :]].astype(np.float64)
+    values = values.reshape(-1, 4)
+    return values[:, 0], values[:, 1], values[:, 2], values[:, 3]
+
+
+def parse_json_notes(notes_json):
+    """Same as parse_ableton_notes for a list of note dicts
+    """
+    values = np.array([[n['pitch'], n['time'], n['duration'], n['velocity']]
+                       for n in notes_json],
+                      dtype=np.float64).reshape(-1, 4)
+    return values[:, 0], values[:, 1], values[:, 2], values[:, 3]
+
+
+def parse_note_columns(notes):
+    """Same as parse_ableton_notes for notes received as columns
+    (binary wire format, see CIA.wire_format)
+    """
+    return tuple(
+        np.asarray(notes[field], dtype=np.float64)
+        for field in ['pitch', 'time', 'duration', 'velocity'])
+
+
+def sort_notes(pitch, time, duration, velocity):
+    """Sorts the notes by time, then by decreasing pitch
+
+    Returns:
+        dict of tensors (pitch, time, duration, velocity),
+        durations are at least 0.05
+    """
+    order = np.lexsort((-pitch, time))
+    return dict(
+        pitch=torch.from_numpy(pitch[order].astype(np.int64)),
+        time=torch.from_numpy(time[order].astype(np.float32)),
+        duration=torch.from_numpy(
+            np.maximum(duration[order], 0.05).astype(np.float32)),
+        velocity=torch.from_numpy(velocity[order].astype(np.int64)))
+
+
+def region_boundaries(time, start_time, end_time, epsilon):
+    """Indices of the first notes starting after start_time and end_time
+    (up to epsilon)
+
+    Args:
+        time: sorted note times (tensor)
+    """
+    time = time.numpy().astype(np.float64)
+    event_start, event_end = np.searchsorted(
+        time, [start_time - epsilon, end_time - epsilon]).tolist()
+    return event_start, event_end
+
+
 def ableton_to_tensor(ableton_note_list,
                       clip_start,
                       seconds_per_beat,
@@ -424,44 +1056,14 @@ def ableton_to_tensor(ableton_note_list,
     Returns:
         x [type]: x is at least of size (1024, 4), it is padded if necessary
     """
-    d = {
-        'pitch': [],
-        'time': [],
-        'duration': [],
-        'velocity': [],
-        'muted': [],
-    }
-    mod = -1
-
-    # pitch time duration velocity muted
-    ableton_features = ['pitch', 'time', 'duration', 'velocity', 'muted']
-
     if selected_region is not None:
         start_time = selected_region['start']
         end_time = selected_region['end']
 
-    for msg in ableton_note_list:
-        if msg == 'notes':
-            pass
-        elif msg == 'note':
-            mod = 0
-        elif msg == 'done':
-            break
-        else:
-            if mod >= 0:
-                d[ableton_features[mod]].append(msg)
-                mod = (mod + 1) % 5
-
-    # we now have to sort
-    l = [[p, t, d, v] for p, t, d, v in zip(d['pitch'], d['time'],
-                                            d['duration'], d['velocity'])]
-
-    l = sorted(l, key=lambda x: (x[1], -x[0]))
-
-    d = dict(pitch=torch.LongTensor([x[0] for x in l]),
-             time=torch.FloatTensor([x[1] for x in l]),
-             duration=torch.FloatTensor([max(float(x[2]), 0.05) for x in l]),
-             velocity=torch.LongTensor([x[3] for x in l]))
+    if isinstance(ableton_note_list, dict):
+        d = sort_notes(*parse_note_columns(ableton_note_list))
+    else:
+        d = sort_notes(*parse_ableton_notes(ableton_note_list))
 
     # compute event_start, event_end
     # num_notes is the number of notes in the original sequence
@@ -470,32 +1072,8 @@ def ableton_to_tensor(ableton_note_list,
 
     event_start, event_end = None, None
     if selected_region is not None:
-        i = 0
-        flag = True
-        while flag:
-            if i == num_notes:
-                event_start = num_notes
-                break
-            if d['time'][i].item() >= start_time - epsilon:
-                flag = False
-                event_start = i
-            else:
-                i = i + 1
-
-        i = 0
-        flag = True
-        while flag:
-            if i == num_notes:
-                event_end = num_notes
-                break
-            if i > d['time'].size(0):
-                flag = False
-                event_end = i
-            elif d['time'][i].item() >= end_time - epsilon:
-                flag = False
-                event_end = i
-            else:
-                i = i + 1
+        event_start, event_end = region_boundaries(d['time'], start_time,
+                                                   end_time, epsilon)
 
     
     # if no region after
@@ -636,6 +1214,56 @@ def ableton_to_tensor(ableton_note_list,
     return x, metadata_dict, unused_before, before, after, unused_after, clip_start, selected_region, region_after_start_time
 
 
+def example_inpainting_input():
+    """Inpainting of the third and fourth bars of a synthetic
+    eight-bar clip (arpeggios), used to check the frozen model
+
+    Returns:
+        x, metadata_dict as returned by ableton_to_tensor
+    """
+    num_notes = 64
+    notes = dict(pitch=48 + (np.arange(num_notes) * 7) % 24,
+                 velocity=np.full(num_notes, 80),
+                 time=np.arange(num_notes) * 0.5,
+                 duration=np.full(num_notes, 0.45))
+    x, metadata_dict, *_ = ableton_to_tensor(notes,
+                                             clip_start=0.,
+                                             seconds_per_beat=0.5,
+                                             selected_region=dict(start=8.,
+                                                                  end=16.))
+    return x, metadata_dict
+
+
+def get_index2value_tables():
+    """index2value of each channel compiled into numpy arrays indexed by token
+    (float arrays for duration and time_shift, with nan for the special symbols)
+    """
+    global index2value_tables
+    if index2value_tables is None:
+        global handler
+        index2value_tables = index2value_to_tables(
+            handler.dataloader_generator.dataset.index2value)
+    return index2value_tables
+
+
+def index2value_to_tables(index2value):
+    """see get_index2value_tables
+    """
+    tables = {}
+    for feature, feature_index2value in index2value.items():
+        table = np.empty(max(feature_index2value) + 1, dtype=object)
+        for index, value in feature_index2value.items():
+            table[index] = value
+        if feature in ['duration', 'time_shift']:
+            table = np.array([
+                value if isinstance(value, numbers.Number) else np.nan
+                for value in table
+            ],
+                             dtype=np.float64)
+        tables[feature] = table
+    return tables
+
+
 def tensor_to_ableton(tensor,
                       start_time,
                       beats_per_second,
@@ -652,14 +1280,11 @@ def tensor_to_ableton(tensor,
     if num_events == 0:
         return [], 0
     # channels are ['pitch', 'velocity', 'duration', 'time_shift']
-    notes = []
-
-    tensor = tensor.detach().cpu()
-    global handler
-    index2value = handler.dataloader_generator.dataset.index2value
+    tensor = tensor.detach().cpu().numpy()
+    tables = get_index2value_tables()
 
-    timeshifts = torch.FloatTensor(
-        [index2value['time_shift'][ts.item()] for ts in tensor[:, 3]])
+    timeshifts = torch.from_numpy(tables['time_shift'][tensor[:, 3]].astype(
+        np.float32))
     time = torch.cumsum(timeshifts, dim=0)
 
     actual_duration = time[-1].item()
@@ -671,17 +1296,20 @@ def tensor_to_ableton(tensor,
     time = (torch.cat([torch.zeros(
         (1, )), time[:-1]], dim=0) * rescaling_factor * beats_per_second +
             start_time)
-    for i in range(num_events):
-        note = dict(pitch=index2value['pitch'][tensor[i, 0].item()],
-                    time=time[i].item(),
-                    duration=index2value['duration'][tensor[i, 2].item()] *
-                    beats_per_second * rescaling_factor,
-                    velocity=index2value['velocity'][tensor[i, 1].item()],
-                    muted=0)
-        notes.append(note)
-
-    track_duration = time[-1].item() + (notes[-1]['duration'].item() *
-                                        rescaling_factor * beats_per_second)
+    durations = (tables['duration'][tensor[:, 2]] * beats_per_second *
+                 rescaling_factor)
+    notes = [
+        dict(pitch=pitch,
+             time=note_time,
+             duration=duration,
+             velocity=velocity,
+             muted=0) for pitch, note_time, duration, velocity in zip(
+                 tables['pitch'][tensor[:, 0]].tolist(), time.tolist(),
+                 durations.tolist(), tables['velocity'][tensor[:, 1]].tolist())
+    ]
+
+    track_duration = time[-1].item() + (durations[-1] * rescaling_factor *
+                                        beats_per_second)
     
     return notes, track_duration
 
@@ -699,57 +1327,11 @@ def json_to_tensor(notes_before_json,
     Returns:
         x [type]: x is at least of size (1024, 4), it is padded if necessary
     """
-    # Parse before:
-    d_before = {
-        'pitch': [],
-        'time': [],
-        'duration': [],
-        'velocity': [],
-        'muted': [],
-    }
-
-    for n in notes_before_json:
-        for k, v in n.items():
-            d_before[k].append(v)
-
-    # we now have to sort
-    l = [[p, t, d, v]
-         for p, t, d, v in zip(d_before['pitch'], d_before['time'],
-                               d_before['duration'], d_before['velocity'])]
-
-    l = sorted(l, key=lambda x: (x[1], -x[0]))
-
-    d_before = dict(pitch=torch.LongTensor([x[0] for x in l]),
-                    time=torch.FloatTensor([x[1] for x in l]),
-                    duration=torch.FloatTensor(
-                        [max(float(x[2]), 0.05) for x in l]),
-                    velocity=torch.LongTensor([x[3] for x in l]))
-
-    # Parse after
-    d_after = {
-        'pitch': [],
-        'time': [],
-        'duration': [],
-        'velocity': [],
-        'muted': [],
-    }
-
-    for n in notes_after_json:
-        for k, v in n.items():
-            d_after[k].append(v)
-
-    # we now have to sort
-    l = [[p, t, d, v]
-         for p, t, d, v in zip(d_after['pitch'], d_after['time'],
-                               d_after['duration'], d_after['velocity'])]
-
-    l = sorted(l, key=lambda x: (x[1], -x[0]))
-
-    d_after = dict(pitch=torch.LongTensor([x[0] for x in l]),
-                   time=torch.FloatTensor([x[1] for x in l]),
-                   duration=torch.FloatTensor(
-                       [max(float(x[2]), 0.05) for x in l]),
-                   velocity=torch.LongTensor([x[3] for x in l]))
+    d_before, d_after = [
+        sort_notes(*(parse_note_columns(notes) if isinstance(notes, dict) else
+                     parse_json_notes(notes)))
+        for notes in [notes_before_json, notes_after_json]
+    ]
 
     # time in beats
     region_after_start_time = selected_region['end']
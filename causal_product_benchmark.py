@@ -0,0 +1,102 @@
+"""
+Compares the CausalDotProduct of fast_transformers
+and chunked_causal_dot_product (pure PyTorch, see get_N):
+maximum difference of the outputs and of the gradients,
+time of the forward and forward + backward passes
+"""
+import time
+
+import click
+import torch
+
+from CIA.model.attentions.fast_attention import CAUSAL_PRODUCT_AVAILABLE, chunked_causal_dot_product
+
+
+@click.command()
+@click.option('--device', type=click.Choice(['cpu', 'cuda']), default='cpu')
+@click.option('--batch_size', type=int, default=2)
+@click.option('--num_heads', type=int, default=8)
+@click.option('--num_features', type=int, default=64)
+@click.option('--dim_head', type=int, default=64)
+@click.option('--num_repeats', type=int, default=10)
+@click.option('--num_threads', type=int, default=None)
+def main(device, batch_size, num_heads, num_features, dim_head, num_repeats,
+         num_threads):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    implementations = {
+        f'chunks {chunk_size}':
+        lambda q, k, v, chunk_size=chunk_size: chunked_causal_dot_product(
+            q, k, v, chunk_size=chunk_size)
+        for chunk_size in [32, 64, 128]
+    }
+    if CAUSAL_PRODUCT_AVAILABLE:
+        from fast_transformers.causal_product import CausalDotProduct
+        implementations = dict(extension=CausalDotProduct.apply,
+                               **implementations)
+    else:
+        print('fast_transformers is not installed, '
+              'comparing with the naive causal dot product')
+        implementations = dict(naive=naive_causal_dot_product,
+                               **implementations)
+    reference = next(iter(implementations))
+
+    print(f'{"length":>8}{"":16}{"max diff":>12}{"fwd (ms)":>12}'
+          f'{"fwd+bwd (ms)":>14}')
+    for length in [256, 1024, 4096]:
+        torch.manual_seed(0)
+        # feature mapped queries and keys are positive
+        q, k = [
+            torch.rand(batch_size, num_heads, length, num_features,
+                       device=device) for _ in range(2)
+        ]
+        v = torch.randn(batch_size, num_heads, length, dim_head,
+                        device=device)
+        outputs = {}
+        for name, causal_dot_product in implementations.items():
+            outputs[name], forward_time, backward_time = run(
+                causal_dot_product, q, k, v, num_repeats)
+            diff = max((x - y).abs().max().item() / y.abs().max().item()
+                       for x, y in zip(outputs[name], outputs[reference]))
+            print(f'{length:8}{name:>16}{diff:12.2e}'
+                  f'{forward_time * 1000:12.2f}{backward_time * 1000:14.2f}')
+
+
+def naive_causal_dot_product(q, k, v):
+    return (q @ k.transpose(-1, -2)).tril() @ v
+
+
+def run(causal_dot_product, q, k, v, num_repeats):
+    """Returns the output and the gradients of q, k, v (relative to the sum
+    of the output) and the mean times of the forward and
+    forward + backward passes
+    """
+    q, k, v = [t.clone().requires_grad_() for t in (q, k, v)]
+
+    def forward_backward():
+        N = causal_dot_product(q, k, v)
+        grads = torch.autograd.grad(N.sum(), (q, k, v))
+        return (N.detach(), ) + grads
+
+    # warm-up
+    outputs = forward_backward()
+    forward_time = timeit(lambda: causal_dot_product(q.detach(), k.detach(),
+                                                     v.detach()),
+                          num_repeats)
+    backward_time = timeit(forward_backward, num_repeats)
+    return outputs, forward_time, backward_time
+
+
+def timeit(f, num_repeats):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(num_repeats):
+        f()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / num_repeats
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 """
 @author: Gaetan Hadjeres
 """
-from CIA.utils import get_free_port
+from CIA.utils import get_free_port, set_device
 from CIA.positional_embeddings.positional_embedding import PositionalEmbedding
 import importlib
 import os
@@ -25,7 +25,12 @@ from CIA.getters import get_dataloader_generator, get_data_processor, get_decode
 @click.option('-o', '--overfitted', is_flag=True)
 @click.option('-c', '--config', type=click.Path(exists=True))
 @click.option('-n', '--num_workers', type=int, default=0)
-def launcher(train, load, overfitted, config, num_workers):
+@click.option('--cpu', is_flag=True)
+@click.option('--num_threads', type=int, default=None)
+@click.option('--num_interop_threads', type=int, default=None)
+@click.option('--quantize', is_flag=True)
+def launcher(train, load, overfitted, config, num_workers, cpu, num_threads,
+             num_interop_threads, quantize):
     # === Init process group
     os.environ['MASTER_ADDR'] = 'localhost'
     os.environ['MASTER_PORT'] = str(get_free_port())
@@ -33,6 +38,7 @@ def launcher(train, load, overfitted, config, num_workers):
     # === Set shared parameters
 
     # always use the maximum number of available GPUs for training
+    assert not (train and cpu), 'training is only implemented on GPUs'
     if train:
         world_size = torch.cuda.device_count()
         assert world_size > 0
@@ -64,19 +70,47 @@ def launcher(train, load, overfitted, config, num_workers):
             os.makedirs(model_dir)
         shutil.copy(config_path, f'{model_dir}/config.py')
 
+    assert cpu or not quantize, 'quantized inference is only implemented on CPU'
+    if cpu:
+        # no process group: generate from this process
+        print('Using CPU')
+        main(0, train, load, overfitted, config, num_workers, world_size,
+             model_dir, cpu, num_threads, num_interop_threads, quantize)
+        return
+
     print(f'Using {world_size} GPUs')
     mp.spawn(main,
              args=(train, load, overfitted, config, num_workers, world_size,
-                   model_dir),
+                   model_dir, cpu, num_threads, num_interop_threads),
              nprocs=world_size,
              join=True)
 
 
-def main(rank, train, load, overfitted, config, num_workers, world_size,
-         model_dir):
-    dist.init_process_group(backend='nccl', world_size=world_size, rank=rank)
-    torch.cuda.set_device(rank)
-    device = f'cuda:{rank}'
+def main(rank,
+         train,
+         load,
+         overfitted,
+         config,
+         num_workers,
+         world_size,
+         model_dir,
+         cpu=False,
+         num_threads=None,
+         num_interop_threads=None,
+         quantize=False):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        torch.set_num_interop_threads(num_interop_threads)
+    if cpu:
+        device = 'cpu'
+    else:
+        dist.init_process_group(backend='nccl',
+                                world_size=world_size,
+                                rank=rank)
+        torch.cuda.set_device(rank)
+        device = f'cuda:{rank}'
+    set_device(device)
 
     # === Decoder ====
     # dataloader generator
@@ -110,9 +144,11 @@ def main(rank, train, load, overfitted, config, num_workers, world_size,
                           handler_type=config['handler_type'])
 
     decoder.to(device)
-    decoder = DistributedDataParallel(module=decoder,
-                                      device_ids=[rank],
-                                      output_device=rank)
+    # the CPU-only model is not wrapped (see Handler.module)
+    if not cpu:
+        decoder = DistributedDataParallel(module=decoder,
+                                          device_ids=[rank],
+                                          output_device=rank)
 
     decoder_handler = get_handler(handler_type=config['handler_type'],
                                   decoder=decoder,
@@ -125,6 +161,9 @@ def main(rank, train, load, overfitted, config, num_workers, world_size,
         else:
             decoder_handler.load(early_stopped=True)
 
+    if quantize:
+        decoder_handler.quantize()
+
     if train:
         decoder_handler.train_model(
             batch_size=config['batch_size'],
@@ -137,9 +176,9 @@ def main(rank, train, load, overfitted, config, num_workers, world_size,
         exit()
 
     # fix projection matrices before generating
-    if hasattr(decoder_handler.model.module.transformer,
+    if hasattr(decoder_handler.module.transformer,
                'fix_projection_matrices_'):
-        decoder_handler.model.module.transformer.fix_projection_matrices_()
+        decoder_handler.module.transformer.fix_projection_matrices_()
 
     # exemple = dict(path='/home/leo/Data/databases/Piano/ecomp_piano_dataset/Abdelmola01.MID', num_events_inpainted=500,
     #                start=0)
@@ -192,14 +231,17 @@ def main(rank, train, load, overfitted, config, num_workers, world_size,
         top_k=0)
     end_time = time.time()
     ############################################################
-    x_inpainted = data_processor.postprocess(x_gen, decoding_end,
-                                             metadata_dict)
+    # one entry per row: each row has its own decoding_end
+    x_inpainted = [
+        data_processor.postprocess(x_gen[k:k + 1], end, metadata_dict)[0]
+        for k, end in enumerate(decoding_end)
+    ]
 
     # Timing infos
     print(f'Num events_generated: {num_event_generated}')
     print(f'Time generation: {end_time - start_time}')
     print(
-        f'Average time per generated event: {(end_time - start_time) / num_event_generated}'
+        f'Average time per generated event: {(end_time - start_time) / max(num_event_generated)}'
     )
 
     # Saving
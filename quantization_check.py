@@ -0,0 +1,148 @@
+"""
+Compares the fp32 model and its dynamically quantized int8 version
+(see Handler.quantize) on CPU:
+per-channel negative log-likelihoods on validation batches,
+size of the weights and time per generated event
+"""
+import importlib
+import os
+import time
+
+import click
+import torch
+import torch.nn.functional as F
+
+from CIA.getters import get_dataloader_generator, get_data_processor, get_decoder, get_handler, get_positional_embedding, \
+    get_sos_embedding
+from CIA.handlers.state_cache import states_num_bytes
+from CIA.utils import set_device
+
+
+@click.command()
+@click.option('-o', '--overfitted', is_flag=True)
+@click.option('-c', '--config', type=click.Path(exists=True))
+@click.option('-n', '--num_workers', type=int, default=0)
+@click.option('--batch_size', type=int, default=4)
+@click.option('--num_batches', type=int, default=4)
+@click.option('--num_generated_events', type=int, default=32)
+@click.option('--num_threads', type=int, default=None)
+def main(overfitted, config, num_workers, batch_size, num_batches,
+         num_generated_events, num_threads):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    set_device('cpu')
+
+    # Load config as dict
+    config_path = config
+    config_module_name = os.path.splitext(config)[0].replace('/', '.')
+    config = importlib.import_module(config_module_name).config
+    model_dir = os.path.dirname(config_path)
+
+    dataloader_generator = get_dataloader_generator(
+        dataset=config['dataset'],
+        dataloader_generator_kwargs=config['dataloader_generator_kwargs'])
+    data_processor = get_data_processor(
+        dataloader_generator=dataloader_generator,
+        data_processor_type=config['data_processor_type'],
+        data_processor_kwargs=config['data_processor_kwargs'])
+    positional_embedding = get_positional_embedding(
+        dataloader_generator=dataloader_generator,
+        data_processor=data_processor,
+        positional_embedding_dict=config['positional_embedding_dict'])
+    sos_embedding = get_sos_embedding(
+        dataloader_generator=dataloader_generator,
+        sos_embedding_dict=config['sos_embedding_dict'])
+    decoder = get_decoder(data_processor=data_processor,
+                          dataloader_generator=dataloader_generator,
+                          positional_embedding=positional_embedding,
+                          sos_embedding=sos_embedding,
+                          decoder_kwargs=config['decoder_kwargs'],
+                          training_phase=False,
+                          handler_type=config['handler_type'])
+    handler = get_handler(handler_type=config['handler_type'],
+                          decoder=decoder,
+                          model_dir=model_dir,
+                          dataloader_generator=dataloader_generator)
+    handler.load(early_stopped=not overfitted)
+    handler.eval()
+
+    # same validation batches for both models
+    torch.manual_seed(0)
+    (_, generator_val, _) = dataloader_generator.dataloaders(
+        batch_size=batch_size, num_workers=num_workers, shuffle_val=True)
+    # the placeholder and the SOD symbol are between before and after
+    decoding_start = (data_processor.num_events_before +
+                      data_processor.num_events_after + 2)
+    batches = []
+    with torch.no_grad():
+        for _, tensor_dict in zip(range(num_batches), generator_val):
+            x, metadata_dict = data_processor.preprocess(
+                tensor_dict['x'], num_events_inpainted=None)
+            metadata_dict['decoding_start'] = decoding_start
+            batches.append((x, metadata_dict))
+
+    results = {}
+    for name in ['fp32', 'int8']:
+        if name == 'int8':
+            handler.quantize()
+        results[name] = dict(
+            nll=per_channel_nll(handler, batches),
+            weights_size=states_num_bytes(handler.module.state_dict()),
+            time_per_event=time_per_event(handler, batches[0],
+                                          num_generated_events))
+
+    print(f'{"":12}{"fp32":>12}{"int8":>12}{"diff":>12}')
+    for feature, nll_fp32, nll_int8 in zip(dataloader_generator.features,
+                                           results['fp32']['nll'],
+                                           results['int8']['nll']):
+        print(f'{"NLL " + feature:12}{nll_fp32:12.4f}{nll_int8:12.4f}'
+              f'{nll_int8 - nll_fp32:12.4f}')
+    print(f'{"weights (MB)":12}'
+          f'{results["fp32"]["weights_size"] / 1024**2:12.1f}'
+          f'{results["int8"]["weights_size"] / 1024**2:12.1f}')
+    print(f'{"ms / event":12}'
+          f'{results["fp32"]["time_per_event"] * 1000:12.1f}'
+          f'{results["int8"]["time_per_event"] * 1000:12.1f}')
+
+
+def per_channel_nll(handler, batches):
+    """Negative log-likelihood of each channel,
+    averaged over the positions where the loss is computed
+    """
+    num_channels = handler.num_channels_target
+    nll = torch.zeros(num_channels, dtype=torch.float64)
+    num_tokens = torch.zeros(num_channels, dtype=torch.float64)
+    with torch.no_grad():
+        for x, metadata_dict in batches:
+            weights_per_category = handler.forward(
+                target=x, metadata_dict=metadata_dict)['weights_per_category']
+            if 'loss_mask' in metadata_dict:
+                loss_mask = (1 - metadata_dict['loss_mask'].long()).bool()
+            else:
+                loss_mask = torch.ones_like(x).bool()
+            for channel_index, weight in enumerate(weights_per_category):
+                mask = loss_mask[:, :, channel_index]
+                nll[channel_index] += F.cross_entropy(
+                    weight[mask], x[:, :, channel_index][mask],
+                    reduction='sum').item()
+                num_tokens[channel_index] += mask.sum().item()
+    return (nll / num_tokens).tolist()
+
+
+def time_per_event(handler, batch, num_generated_events):
+    x, metadata_dict = batch
+    torch.manual_seed(0)
+    start_time = time.time()
+    with torch.no_grad():
+        _, _, _, num_event_generated, _ = handler.inpaint(
+            x=x.clone(),
+            metadata_dict=dict(metadata_dict),
+            temperature=1.,
+            top_p=0.95,
+            top_k=0,
+            num_max_generated_events=num_generated_events)
+    return (time.time() - start_time) / max(num_event_generated)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+import app
+
+TIME_TABLE = [0.] + list(np.round(np.geomspace(0.02, 20, 100), 4))
+SPECIAL_SYMBOLS = ['START', 'END', 'PAD']
+
+
+@pytest.fixture
+def index2value(monkeypatch):
+    """index2value of a piano dataset,
+    also used by the detokenization of app.py (see get_index2value_tables)
+    """
+    values = dict(pitch=list(range(21, 109)),
+                  velocity=list(range(128)),
+                  duration=[np.float64(v) for v in TIME_TABLE[1:]],
+                  time_shift=[np.float64(v) for v in TIME_TABLE])
+    index2value = {
+        feature: dict(enumerate(feature_values + SPECIAL_SYMBOLS))
+        for feature, feature_values in values.items()
+    }
+    monkeypatch.setattr(app, 'index2value_tables',
+                        app.index2value_to_tables(index2value))
+    return index2value
@@ -0,0 +1,114 @@
+import torch
+
+from CIA.getters import get_data_processor, get_dataloader_generator, get_decoder, get_handler, \
+    get_positional_embedding, get_sos_embedding
+from CIA.utils import set_device
+
+
+def build_handler(autoregressive_decoding='fullcat',
+                  execute_type='reversible',
+                  local_attn_heads=2,
+                  seed=0):
+    """Small randomly initialized events model on CPU,
+    built as in main.py
+    """
+    set_device('cpu')
+    torch.manual_seed(seed)
+    d_model = 32
+    positional_embedding_kwargs = dict(positional_embedding_size=8,
+                                       num_channels=4,
+                                       dropout=0.,
+                                       expand_channels=False)
+    dataloader_generator = get_dataloader_generator(
+        dataset='piano',
+        dataloader_generator_kwargs=dict(sequences_size=320,
+                                         transformations={},
+                                         pad_before=True,
+                                         pad_after=True))
+    data_processor = get_data_processor(
+        dataloader_generator=dataloader_generator,
+        data_processor_type='piano_prefix',
+        # num_events_before must be 256 (see compute_elapsed_time)
+        data_processor_kwargs=dict(embedding_size=8,
+                                   num_events_before=256,
+                                   num_events_after=16))
+    positional_embedding = get_positional_embedding(
+        dataloader_generator=dataloader_generator,
+        data_processor=data_processor,
+        positional_embedding_dict=dict(
+            sinusoidal_embedding=positional_embedding_kwargs,
+            sinusoidal_elapsed_time_embedding=dict(
+                positional_embedding_kwargs, mask_positions=False),
+            sinusoidal_progress_bar_embedding=positional_embedding_kwargs))
+    sos_embedding = get_sos_embedding(
+        dataloader_generator=dataloader_generator,
+        sos_embedding_dict=dict(learnt_sos_embedding=dict(
+            embedding_size=d_model)))
+    decoder = get_decoder(
+        data_processor=data_processor,
+        dataloader_generator=dataloader_generator,
+        positional_embedding=positional_embedding,
+        sos_embedding=sos_embedding,
+        decoder_kwargs=dict(autoregressive_decoding=autoregressive_decoding,
+                            type='performer',
+                            d_model=d_model,
+                            n_head=4,
+                            local_attn_heads=local_attn_heads,
+                            fast_local_attn=False,
+                            local_window_size=8,
+                            num_decoder_layers=2,
+                            dropout=0.,
+                            label_smoothing=False,
+                            features={
+                                'type': 'elu',
+                                'args': dict()
+                            },
+                            execute_type=execute_type,
+                            layer_pe=dict(type='rototor',
+                                          input='elapsed',
+                                          args=dict(gated_layerSPE=False,
+                                                    post_phi_layerPE=True,
+                                                    theta_q=False))),
+        training_phase=False,
+        handler_type='event')
+    handler = get_handler(handler_type='event',
+                          decoder=decoder,
+                          model_dir=None,
+                          dataloader_generator=dataloader_generator)
+    handler.eval()
+    return handler
+
+
+def random_inpainting_input(handler, batch_size=2, seed=0):
+    """Random context with a placeholder, as built by ableton_to_tensor
+
+    Returns:
+        x, metadata_dict
+    """
+    data_processor = handler.data_processor
+    generator = torch.Generator().manual_seed(seed)
+    num_events = handler.dataloader_generator.sequences_size
+    decoding_start = (data_processor.num_events_before +
+                      data_processor.num_events_after + 2)
+    x = torch.stack([
+        torch.randint(num_tokens - 3, (batch_size, num_events),
+                      generator=generator)
+        for num_tokens in data_processor.num_tokens_per_channel
+    ], dim=-1)
+    x[:, data_processor.num_events_before] = data_processor.placeholder_symbols
+    x[:, decoding_start - 1] = data_processor.sod_symbols
+    metadata_dict = dict(original_sequence=x,
+                         placeholder_duration=torch.full((batch_size, ), 2.),
+                         decoding_start=decoding_start)
+    return x, metadata_dict
+
+
+def weights_per_category(handler, x, metadata_dict):
+    """weights_per_category of forward, without the loss
+    (which is not defined on the placeholder)
+    """
+    with torch.no_grad():
+        output, target_embedded, _ = handler.compute_event_state(
+            x, metadata_dict)
+        return handler.module.event_state_to_weights(
+            output=output, target_embedded=target_embedded)
@@ -0,0 +1,90 @@
+import random
+
+import torch
+
+from app import parse_ableton_notes, region_boundaries, sort_notes
+
+
+def sorted_notes_reference(ableton_note_list):
+    """Previous parsing of the Ableton message list
+    (state machine and sort of Python lists)
+    """
+    d = {
+        'pitch': [],
+        'time': [],
+        'duration': [],
+        'velocity': [],
+        'muted': [],
+    }
+    mod = -1
+    ableton_features = ['pitch', 'time', 'duration', 'velocity', 'muted']
+    for msg in ableton_note_list:
+        if msg == 'notes':
+            pass
+        elif msg == 'note':
+            mod = 0
+        elif msg == 'done':
+            break
+        else:
+            if mod >= 0:
+                d[ableton_features[mod]].append(msg)
+                mod = (mod + 1) % 5
+
+    l = [[p, t, d, v] for p, t, d, v in zip(d['pitch'], d['time'],
+                                            d['duration'], d['velocity'])]
+    l = sorted(l, key=lambda x: (x[1], -x[0]))
+    return dict(pitch=torch.LongTensor([x[0] for x in l]),
+                time=torch.FloatTensor([x[1] for x in l]),
+                duration=torch.FloatTensor([max(float(x[2]), 0.05) for x in l]),
+                velocity=torch.LongTensor([x[3] for x in l]))
+
+
+def region_boundaries_reference(time, start_time, end_time, epsilon):
+    num_notes = time.size(0)
+    event_start = next(
+        (i for i in range(num_notes) if time[i].item() >= start_time - epsilon),
+        num_notes)
+    event_end = next(
+        (i for i in range(num_notes) if time[i].item() >= end_time - epsilon),
+        num_notes)
+    return event_start, event_end
+
+
+def random_ableton_note_list(num_notes):
+    notes = ['notes', num_notes]
+    for k in range(num_notes):
+        # simultaneous notes on a grid, or random times
+        time = random.choice([k // 3 * 0.25, round(random.random() * 32, 2)])
+        notes += [
+            'note',
+            random.randint(21, 108), time,
+            random.choice([random.random() * 4, 0.01]),
+            random.randint(1, 127), 0
+        ]
+    return notes + ['done']
+
+
+def test_sorted_notes_match_reference():
+    random.seed(0)
+    for num_notes in [0, 1, 2, 10, 100, 500]:
+        ableton_note_list = random_ableton_note_list(num_notes)
+        expected = sorted_notes_reference(ableton_note_list)
+        d = sort_notes(*parse_ableton_notes(ableton_note_list))
+        for k, tensor in expected.items():
+            assert d[k].dtype == tensor.dtype
+            assert torch.equal(d[k], tensor), k
+
+
+def test_region_boundaries_match_reference():
+    random.seed(0)
+    epsilon = 1e-4
+    for num_notes in [0, 1, 10, 100]:
+        time = sort_notes(*parse_ableton_notes(
+            random_ableton_note_list(num_notes)))['time']
+        candidates = time.tolist() + [-1., 0., 5., 40.]
+        for _ in range(20):
+            start_time, end_time = sorted(random.sample(candidates, 2))
+            # also on the epsilon margins
+            start_time += random.choice([-epsilon / 2, 0., epsilon / 2])
+            assert region_boundaries(time, start_time, end_time, epsilon) == \
+                region_boundaries_reference(time, start_time, end_time, epsilon)
@@ -0,0 +1,34 @@
+import torch
+
+from CIA.utils import get_device, is_main_process
+from model_helpers import (build_handler, random_inpainting_input,
+                           weights_per_category)
+
+
+def test_cpu_handler_without_process_group():
+    handler = build_handler()
+    assert get_device() == torch.device('cpu')
+    assert is_main_process()
+    # the model is not wrapped in DistributedDataParallel
+    assert handler.module is handler.model
+    assert all(p.device == get_device() for p in handler.parameters())
+
+
+def test_load_checkpoint_of_distributed_model(tmp_path):
+    handler = build_handler(seed=0)
+    handler.model_dir = str(tmp_path)
+    handler.save(early_stopped=False)
+    # checkpoints saved during the distributed training
+    # have the module. prefix of DistributedDataParallel
+    model_path = tmp_path / 'overfitted' / 'model'
+    state_dict = torch.load(model_path)
+    torch.save({f'module.{k}': v for k, v in state_dict.items()}, model_path)
+
+    other_handler = build_handler(seed=1)
+    other_handler.model_dir = str(tmp_path)
+    x, metadata_dict = random_inpainting_input(handler)
+    other_handler.load(early_stopped=False)
+    for weight, expected_weight in zip(
+            weights_per_category(other_handler, x, metadata_dict),
+            weights_per_category(handler, x, metadata_dict)):
+        assert torch.equal(weight, expected_weight)
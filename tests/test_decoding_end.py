@@ -0,0 +1,122 @@
+import pytest
+import torch
+
+import CIA.handlers.decoder_events_handler as decoder_events_handler
+from CIA.handlers.decoder_prefix_handler import DecoderPrefixHandler
+from model_helpers import build_handler, random_inpainting_input
+
+NUM_MAX_GENERATED_EVENTS = 5
+# (event, channel) of the END symbol of each row, relative to decoding_start
+# the last row never samples END
+END_POSITIONS = [(1, 2), (3, 0), None]
+TOKEN = 1
+
+
+def scripted_tokens(handler, event, channel):
+    """each row samples TOKEN, then END from END_POSITIONS on
+    (also for the rows already finished)
+    """
+    return torch.tensor([
+        handler.end_tokens[channel].item() if end_position is not None and
+        (event, channel) >= end_position else TOKEN
+        for end_position in END_POSITIONS
+    ])
+
+
+def check_generated(handler, generated):
+    """generated (batch_size, num_events, num_channels) from decoding_start
+    """
+    end_tokens = handler.end_tokens
+    for row, end_position in enumerate(END_POSITIONS):
+        if end_position is None:
+            assert (generated[row, :NUM_MAX_GENERATED_EVENTS] == TOKEN).all()
+            assert (generated[row, NUM_MAX_GENERATED_EVENTS:] == 0).all()
+            continue
+        end_event, end_channel = end_position
+        assert (generated[row, :end_event] == TOKEN).all()
+        assert (generated[row, end_event, :end_channel] == TOKEN).all()
+        assert generated[row, end_event, end_channel] == end_tokens[end_channel]
+        # finished rows are left untouched
+        assert (generated[row, end_event, end_channel + 1:] == 0).all()
+        assert (generated[row, end_event + 1:] == 0).all()
+
+
+@pytest.mark.parametrize('inpaint', ['inpaint', 'inpaint_non_optimized'])
+def test_rows_stop_at_their_own_end(monkeypatch, inpaint):
+    handler = build_handler()
+    x, metadata_dict = random_inpainting_input(handler,
+                                               batch_size=len(END_POSITIONS))
+    decoding_start = metadata_dict['decoding_start']
+    num_calls = 0
+
+    def top_k_top_p_sampling(logits, temperature, top_k, top_p):
+        nonlocal num_calls
+        event, channel = divmod(num_calls, handler.num_channels_target)
+        num_calls += 1
+        return scripted_tokens(handler, event, channel)
+
+    monkeypatch.setattr(decoder_events_handler, 'top_k_top_p_sampling',
+                        top_k_top_p_sampling)
+    context = x[:, :decoding_start].clone()
+
+    x, generated_region, decoding_end, num_event_generated, done = getattr(
+        handler, inpaint)(x,
+                          metadata_dict,
+                          num_max_generated_events=NUM_MAX_GENERATED_EVENTS)
+
+    assert decoding_end == [
+        decoding_start + 1, decoding_start + 3,
+        decoding_start + NUM_MAX_GENERATED_EVENTS
+    ]
+    assert num_event_generated == [1, 3, NUM_MAX_GENERATED_EVENTS]
+    assert done == [True, True, False]
+    assert [len(region) for region in generated_region] == num_event_generated
+    assert torch.equal(x[:, :decoding_start], context)
+    check_generated(handler, x[:, decoding_start:])
+
+
+def test_prefix_handler_rows_stop_at_their_own_end():
+    events_handler = build_handler()
+    handler = DecoderPrefixHandler(
+        model=events_handler.model,
+        model_dir=None,
+        dataloader_generator=events_handler.dataloader_generator)
+    batch_size = len(END_POSITIONS)
+    num_channels = handler.num_channels_target
+    num_tokens = max(handler.num_tokens_per_channel_target)
+    decoding_start = 10
+    num_events = decoding_start + NUM_MAX_GENERATED_EVENTS
+    x = torch.zeros(batch_size, num_events + 2, num_channels, dtype=torch.long)
+    decoding_end = torch.zeros(batch_size, dtype=torch.long)
+    done = torch.zeros(batch_size, dtype=torch.bool)
+
+    # same loop as inpaint, with weights sampling the scripted tokens
+    for event_index in range(decoding_start, num_events):
+        end_sampled = torch.zeros_like(done)
+        for channel_index in range(num_channels):
+            tokens = scripted_tokens(handler, event_index - decoding_start,
+                                     channel_index)
+            weights = torch.full((batch_size, num_tokens), -float('Inf'))
+            weights[torch.arange(batch_size), tokens] = 0.
+            end_sampled = handler.sample_token(x,
+                                               weights,
+                                               event_index,
+                                               channel_index,
+                                               done,
+                                               end_sampled,
+                                               temperature=1.,
+                                               top_p=1.,
+                                               top_k=0)
+        decoding_end, done = handler.update_decoding_end(
+            decoding_end, done, end_sampled, event_index)
+
+    x, decoding_end, num_event_generated, done = handler.generation_outputs(
+        x, decoding_start, decoding_end, done, num_events)
+    assert decoding_end == [
+        decoding_start + 1, decoding_start + 3,
+        decoding_start + NUM_MAX_GENERATED_EVENTS
+    ]
+    assert num_event_generated == [1, 3, NUM_MAX_GENERATED_EVENTS]
+    assert done == [True, True, False]
+    assert (x[:, :decoding_start] == 0).all()
+    check_generated(handler, x[:, decoding_start:])
@@ -0,0 +1,69 @@
+import pytest
+import torch
+
+from model_helpers import build_handler, random_inpainting_input
+
+
+def to_old_state_dict(data_processor, prefix=''):
+    """state_dict with one embedding table per channel,
+    as saved before the embeddings were packed
+    """
+    state_dict = dict(data_processor.state_dict(prefix=prefix))
+    weight = state_dict.pop(f'{prefix}embedding.weight')
+    num_embeddings_per_channel = (
+        data_processor.embedding_offsets[1:] -
+        data_processor.embedding_offsets[:-1]).tolist()
+    num_embeddings_per_channel.append(weight.size(0) -
+                                      sum(num_embeddings_per_channel))
+    for channel_index, channel_weight in enumerate(
+            weight.split(num_embeddings_per_channel, dim=0)):
+        state_dict[f'{prefix}embeddings.{channel_index}.weight'] = \
+            channel_weight
+    return state_dict, num_embeddings_per_channel
+
+
+@pytest.mark.parametrize('autoregressive_decoding', ['fullcat', 'mlp'])
+def test_packed_embeddings_match_per_channel_tables(autoregressive_decoding):
+    handler = build_handler(autoregressive_decoding)
+    data_processor = handler.data_processor
+    old_state_dict, num_embeddings_per_channel = to_old_state_dict(
+        data_processor)
+    assert all(
+        num_embeddings >= num_tokens
+        for num_embeddings, num_tokens in zip(
+            num_embeddings_per_channel, data_processor.num_tokens_per_channel))
+
+    # old checkpoints of the whole model are packed when loaded
+    model = handler.module
+    old_model_state_dict = {
+        key: value
+        for key, value in model.state_dict().items()
+        if not key.startswith('data_processor.')
+    }
+    old_model_state_dict.update(
+        to_old_state_dict(data_processor, prefix='data_processor.')[0])
+    loaded_model = build_handler(autoregressive_decoding, seed=1).module
+    loaded_model.load_state_dict(old_model_state_dict)
+    for key, value in model.state_dict().items():
+        assert torch.equal(loaded_model.state_dict()[key], value)
+
+    x, _ = random_inpainting_input(handler)
+    tables = [
+        old_state_dict[f'embeddings.{channel_index}.weight']
+        for channel_index in range(data_processor.num_channels)
+    ]
+    with torch.no_grad():
+        embedded = data_processor.embed(x)
+        expected = torch.cat([
+            table[t] for t, table in zip(x.split(1, dim=-1), tables)
+        ], dim=-2)
+        assert torch.equal(embedded, expected)
+        # flatten replaces the former split/cat/squeeze
+        assert torch.equal(
+            embedded.flatten(start_dim=2),
+            torch.cat(expected.split(1, dim=2), dim=3).squeeze(2))
+        for channel_index, table in enumerate(tables):
+            assert torch.equal(
+                data_processor.embed_step(x[:, 0, channel_index],
+                                          channel_index),
+                table[x[:, 0, channel_index]])
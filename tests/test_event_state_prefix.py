@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+from model_helpers import build_handler, random_inpainting_input
+
+
+@pytest.mark.parametrize('autoregressive_decoding', ['fullcat', 'mlp'])
+@pytest.mark.parametrize('local_attn_heads', [0, 2])
+def test_truncated_event_state_matches_full_pass(autoregressive_decoding,
+                                                 local_attn_heads):
+    handler = build_handler(autoregressive_decoding,
+                            local_attn_heads=local_attn_heads)
+    x, metadata_dict = random_inpainting_input(handler)
+    decoding_start = metadata_dict['decoding_start']
+    with torch.no_grad():
+        expected, expected_embedded, _ = handler.compute_event_state(
+            x, metadata_dict)
+        # event lengths which are not multiples of the local window (8)
+        for event_index in [decoding_start, decoding_start + 5, x.size(1) - 2]:
+            output, target_embedded, _ = handler.compute_event_state(
+                x, metadata_dict, event_index=event_index)
+            assert output.size(1) == event_index + 1
+            assert torch.allclose(output, expected[:, :event_index + 1],
+                                  atol=1e-5)
+            assert torch.equal(target_embedded,
+                               expected_embedded[:, :event_index + 1])
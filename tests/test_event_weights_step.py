@@ -0,0 +1,29 @@
+import pytest
+import torch
+
+from model_helpers import build_handler, random_inpainting_input
+
+
+@pytest.mark.parametrize('autoregressive_decoding', ['fullcat', 'mlp'])
+def test_weight_steps_match_event_state_to_weights(autoregressive_decoding):
+    handler = build_handler(autoregressive_decoding)
+    x, metadata_dict = random_inpainting_input(handler)
+    data_processor = handler.data_processor
+    with torch.no_grad():
+        output, target_embedded, _ = handler.compute_event_state(
+            x, metadata_dict)
+        expected = handler.module.event_state_to_weights(
+            output, target_embedded)
+        for event_index in [0, metadata_dict['decoding_start'], x.size(1) - 1]:
+            # embeddings of the channels of the event, filled as in sample_event
+            event_embedded = torch.zeros_like(target_embedded[:, event_index])
+            for channel_index in range(handler.num_channels_target):
+                weights = handler.event_state_to_weight_step(
+                    output[:, event_index], event_embedded, channel_index)
+                assert torch.allclose(weights,
+                                      expected[channel_index][:, event_index],
+                                      atol=1e-5)
+                event_embedded[:, channel_index] = data_processor.embed_step(
+                    x[:, event_index, channel_index], channel_index)
+            assert torch.allclose(event_embedded,
+                                  target_embedded[:, event_index])
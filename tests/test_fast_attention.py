@@ -0,0 +1,43 @@
+import pytest
+import torch
+
+from CIA.model.attentions.fast_attention import (causal_linear_attention,
+                                                 chunked_causal_dot_product)
+
+chunk_size = 8
+
+
+def naive_causal_dot_product(q, k, v):
+    return (q @ k.transpose(-1, -2)).tril() @ v
+
+
+@pytest.mark.parametrize('n', [0, 1, chunk_size - 1, chunk_size,
+                               chunk_size + 1, 3 * chunk_size + 2])
+def test_chunked_causal_dot_product(n):
+    torch.manual_seed(0)
+    q, k = [torch.rand(2, 3, n, 5, requires_grad=True) for _ in range(2)]
+    v = torch.randn(2, 3, n, 4, requires_grad=True)
+
+    N = chunked_causal_dot_product(q, k, v, chunk_size=chunk_size)
+    expected = naive_causal_dot_product(q, k, v)
+    assert N.size() == expected.size()
+    assert torch.allclose(N, expected, atol=1e-5)
+
+    if n == 0:
+        return
+    grads = torch.autograd.grad(N.sum(), (q, k, v))
+    expected_grads = torch.autograd.grad(expected.sum(), (q, k, v))
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad, atol=1e-5)
+
+
+@pytest.mark.parametrize('n', [4, 8])
+def test_causal_linear_attention_window_longer_than_sequence(n):
+    """the shifted products are over empty sequences
+    """
+    torch.manual_seed(0)
+    q, k = torch.rand(2, 2, 3, n, 5)
+    v = torch.randn(2, 3, n, 4)
+    out = causal_linear_attention(q, k, None, None, v, local=8)
+    expected = causal_linear_attention(q, k, None, None, v)
+    assert torch.allclose(out, expected, atol=1e-6)
@@ -0,0 +1,27 @@
+import pytest
+import torch
+
+from model_helpers import (build_handler, random_inpainting_input,
+                           weights_per_category)
+
+
+@pytest.mark.parametrize('autoregressive_decoding', ['fullcat', 'mlp'])
+def test_frozen_model_predicts_the_same_weights(autoregressive_decoding):
+    handler = build_handler(autoregressive_decoding)
+    x, metadata_dict = random_inpainting_input(handler)
+    expected = weights_per_category(handler, x, metadata_dict)
+    handler.freeze_for_inference(x, metadata_dict)
+    weights = weights_per_category(handler, x, metadata_dict)
+    assert len(weights) == len(expected)
+    for weight, expected_weight in zip(weights, expected):
+        assert torch.allclose(weight, expected_weight, atol=1e-5)
+
+
+def test_frozen_model_cannot_be_saved(tmp_path):
+    handler = build_handler()
+    handler.model_dir = str(tmp_path)
+    x, metadata_dict = random_inpainting_input(handler)
+    handler.freeze_for_inference(x, metadata_dict)
+    with pytest.raises(AssertionError):
+        handler.save(early_stopped=False)
+    assert list(tmp_path.iterdir()) == []
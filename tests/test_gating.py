@@ -0,0 +1,144 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from CIA.model.execute_type.gated import Gating
+from CIA.model.execute_type.reversible_gated import ReversibleGatedBlock_
+
+d_model = 16
+
+
+def old_gating(weights, x, y, bg):
+    """the gating before the projections were concatenated
+    """
+    def linear(name, t):
+        return t @ weights[name].t()
+
+    r = torch.sigmoid(linear('Wr', y) + linear('Ur', x))
+    z = torch.sigmoid(linear('Wz', y) + linear('Uz', x) - bg)
+    h = torch.tanh(linear('Wg', y) + linear('Ug', r * x))
+    return z, h
+
+
+def random_weights(names):
+    return {name: torch.randn(d_model, d_model) / d_model**0.5
+            for name in names}
+
+
+class Layer(nn.Module):
+    def __init__(self, returns_states, dropout=0.):
+        super().__init__()
+        self.linear = nn.Linear(d_model, d_model)
+        self.dropout = nn.Dropout(dropout)
+        self.returns_states = returns_states
+
+    def forward(self, x):
+        x = self.dropout(self.linear(x))
+        if self.returns_states:
+            return x, None
+        return x
+
+
+def test_gating_loads_old_weights():
+    torch.manual_seed(0)
+    weights = random_weights(['Wr', 'Wz', 'Wg', 'Ur', 'Uz', 'Ug'])
+    bg = torch.randn(d_model) + 1
+    gating = Gating(d_model=d_model)
+    gating.load_state_dict({
+        **{f'{name}.weight': weight
+           for name, weight in weights.items()}, 'bg': bg
+    })
+    x, y = torch.randn(2, 2, 5, d_model)
+    z, h = old_gating(weights, x, y, bg)
+    with torch.no_grad():
+        assert torch.allclose(gating(x, y), (1 - z) * x + z * h, atol=1e-6)
+
+
+@pytest.mark.parametrize('batch_size', [1, 3])
+def test_reversible_block_loads_old_weights(batch_size):
+    torch.manual_seed(0)
+    f = Layer(returns_states=True)
+    g = Layer(returns_states=False)
+    block = ReversibleGatedBlock_(f, g, d_model)
+    old_state_dict = {
+        f'{name}.weight': weight
+        for name, weight in random_weights([
+            f'{W}{layer}{gate}' for W in 'WU' for layer in 'fg'
+            for gate in 'rzg'
+        ]).items()
+    }
+    old_state_dict.update({
+        'bfg': torch.randn(d_model) + 1,
+        'bgg': torch.randn(d_model) + 1,
+        **{f'f.net.{k}': v
+           for k, v in f.state_dict().items()},
+        **{f'g.net.{k}': v
+           for k, v in g.state_dict().items()},
+    })
+    block.load_state_dict(old_state_dict)
+    block.eval()
+
+    def weights(layer):
+        return {
+            f'{W}{gate}': old_state_dict[f'{W}{layer}{gate}.weight']
+            for W in 'WU' for gate in 'rzg'
+        }
+
+    x = torch.randn(batch_size, 7, 2 * d_model)
+    x1, x2 = torch.chunk(x, 2, dim=2)
+    with torch.no_grad():
+        fx1, _ = f(x1)
+        # the attention gate used bgg in the forward pass
+        z, h = old_gating(weights('f'), x1, fx1, old_state_dict['bgg'])
+        y2 = (1 - z) * x2 + z * h
+        gx1 = g(x1)
+        z, h = old_gating(weights('g'), x1, gx1, old_state_dict['bgg'])
+        expected = torch.cat([x1, (1 - z) * y2 + z * h], dim=2)
+
+        out, _ = block(x)
+    assert torch.allclose(out, expected, atol=1e-6)
+
+
+@pytest.mark.parametrize('training', [False, True])
+def test_reversible_block_backward_pass_matches_autograd(training):
+    torch.manual_seed(0)
+    block = ReversibleGatedBlock_(Layer(returns_states=True, dropout=0.1),
+                                  Layer(returns_states=False, dropout=0.1),
+                                  d_model)
+    block.train(training)
+    x = torch.randn(3, 7, 2 * d_model)
+    dout = torch.randn(3, 7, 2 * d_model)
+
+    # plain (non-reversible) forward, same bias as forward
+    torch.manual_seed(1)
+    x_ = x.clone().requires_grad_()
+    x1, x2 = torch.chunk(x_, 2, dim=2)
+    fx1, _ = block.f.net(x1)
+    z, h = block.gating_f.gates(x1, fx1, bg=block.gating_g.bg)
+    y2 = (1 - z) * x2 + z * h
+    gy1 = block.g.net(x1)
+    z, h = block.gating_g.gates(x1, gy1)
+    out = torch.cat([x1, (1 - z) * y2 + z * h], dim=2)
+    out.backward(dout)
+    expected_grads = {
+        name: parameter.grad.clone()
+        for name, parameter in block.named_parameters()
+        if parameter.grad is not None
+    }
+    block.zero_grad()
+
+    torch.manual_seed(1)
+    with torch.no_grad():
+        reversible_out, _ = block(x)
+    assert torch.allclose(reversible_out, out, atol=1e-6)
+    reconstructed_x, dx = block.backward_pass(reversible_out, dout)
+    assert torch.allclose(reconstructed_x, x, atol=1e-4)
+    assert torch.allclose(dx, x_.grad, atol=1e-4)
+    grads = {
+        name: parameter.grad
+        for name, parameter in block.named_parameters()
+        if parameter.grad is not None
+    }
+    assert set(grads) == set(expected_grads)
+    for name, grad in grads.items():
+        assert torch.allclose(grad, expected_grads[name], atol=1e-4), name
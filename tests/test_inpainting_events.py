@@ -0,0 +1,30 @@
+import pytest
+
+import app
+
+
+class NonOptimizedHandler:
+    """handler without inpaint_iterator nor scheduler support
+    """
+    def __init__(self):
+        self.calls = []
+
+    def inpaint_non_optimized(self, **kwargs):
+        self.calls.append(kwargs)
+        return 'outputs'
+
+
+def test_fallback_passes_the_number_of_events(monkeypatch):
+    handler = NonOptimizedHandler()
+    monkeypatch.setattr(app, 'handler', handler, raising=False)
+    monkeypatch.setattr(app, 'scheduler', None)
+    events = app.inpainting_events(x='x',
+                                   metadata_dict={},
+                                   top_p=0.9,
+                                   num_max_generated_events=7)
+    with pytest.raises(StopIteration) as stop:
+        next(events)
+    assert stop.value.value == 'outputs'
+    assert len(handler.calls) == 1
+    assert handler.calls[0]['num_max_generated_events'] == 7
+    assert handler.calls[0]['top_p'] == 0.9
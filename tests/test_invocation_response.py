@@ -0,0 +1,101 @@
+import pytest
+import torch
+
+from app import context_notes, proposal_to_ableton, shift_notes, shorten_durations, \
+    tensor_to_ableton
+
+FEATURES = ['pitch', 'velocity', 'duration', 'time_shift']
+
+
+def proposal_to_ableton_reference(generated_region, done, unused_before,
+                                  before, after, unused_after, clip_start,
+                                  selected_region, ableton_notes_after_region,
+                                  beats_per_second, seconds_per_beat):
+    """Previous version, detokenizing the whole clip for each proposal
+    """
+    new_x = torch.cat([
+        unused_before[0], before[0], generated_region, after[0],
+        unused_after[0]
+    ], dim=0)
+    ableton_notes, track_duration = tensor_to_ableton(
+        new_x, start_time=clip_start, beats_per_second=beats_per_second)
+    ableton_notes_region, _ = tensor_to_ableton(
+        generated_region,
+        start_time=selected_region['start'],
+        expected_duration=(selected_region['end'] - selected_region['start']) *
+        seconds_per_beat,
+        beats_per_second=beats_per_second,
+        rescale=done)
+    new_before = torch.cat([unused_before[0], before[0], generated_region],
+                           dim=0)
+    ableton_notes_new_before, _ = tensor_to_ableton(
+        new_before, start_time=clip_start, beats_per_second=beats_per_second)
+    ableton_notes_region = shorten_durations(ableton_notes_region,
+                                             ableton_notes_after_region)
+    return {
+        'notes': ableton_notes,
+        'track_duration': track_duration,
+        'done': done,
+        'notes_before_next_region': ableton_notes_new_before,
+        'notes_region': ableton_notes_region,
+    }
+
+
+def random_events(index2value, num_events, generator):
+    return torch.stack([
+        torch.randint(len(index2value[feature]) - 3, (num_events, ),
+                      generator=generator) for feature in FEATURES
+    ], dim=-1)
+
+
+def assert_notes_close(notes, expected_notes):
+    assert len(notes) == len(expected_notes)
+    for note, expected_note in zip(notes, expected_notes):
+        assert note == pytest.approx(expected_note, rel=1e-5, abs=1e-4)
+
+
+@pytest.mark.parametrize('num_events', [(0, 4, 5, 3, 0), (6, 4, 5, 3, 7),
+                                        (0, 0, 5, 0, 0), (6, 4, 0, 3, 7)])
+@pytest.mark.parametrize('done', [False, True])
+def test_proposal_matches_full_detokenization(index2value, num_events, done):
+    generator = torch.Generator().manual_seed(sum(num_events))
+    (unused_before, before, generated_region, after,
+     unused_after) = [random_events(index2value, n, generator)
+                      for n in num_events]
+    unused_before, before, after, unused_after = [
+        t.unsqueeze(0) for t in (unused_before, before, after, unused_after)
+    ]
+    beats_per_second, seconds_per_beat = 2., 0.5
+    clip_start, region_after_start_time = 1., 12.
+    selected_region = dict(start=4., end=12.)
+
+    expected_notes_after_region, _ = tensor_to_ableton(
+        torch.cat([after[0], unused_after[0]], dim=0),
+        start_time=region_after_start_time,
+        beats_per_second=beats_per_second)
+    expected = proposal_to_ableton_reference(
+        generated_region, done, unused_before, before, after, unused_after,
+        clip_start, selected_region, expected_notes_after_region,
+        beats_per_second, seconds_per_beat)
+
+    before_notes, after_notes = context_notes(unused_before, before, after,
+                                              unused_after, beats_per_second)
+    notes_after_region = shift_notes(after_notes, region_after_start_time)
+    assert_notes_close(notes_after_region, expected_notes_after_region)
+
+    for delta in [False, True]:
+        proposal, history_notes = proposal_to_ableton(
+            generated_region, done, unused_before, before, clip_start,
+            dict(selected_region), before_notes, after_notes,
+            notes_after_region, beats_per_second, seconds_per_beat, delta)
+        assert proposal['done'] == done
+        assert proposal['track_duration'] == pytest.approx(
+            expected['track_duration'], rel=1e-5, abs=1e-4)
+        if not delta:
+            assert_notes_close(proposal['notes'], expected['notes'])
+            assert_notes_close(proposal['notes_before_next_region'],
+                               expected['notes_before_next_region'])
+        assert_notes_close(history_notes,
+                           shift_notes(expected['notes_before_next_region'],
+                                       -clip_start))
+        assert_notes_close(proposal['notes_region'], expected['notes_region'])
@@ -0,0 +1,27 @@
+from CIA.jobs import JobQueue
+
+
+def run(payload):
+    yield 'event', payload
+    yield 'end', {'payload': payload}
+
+
+def test_oldest_finished_jobs_are_evicted():
+    jobs = JobQueue(run=run, num_workers=1, max_jobs=4)
+    submitted = []
+    for k in range(10):
+        job = jobs.submit(k)
+        job.wait()
+        submitted.append(job)
+    assert all(job.status == 'done' for job in submitted)
+    assert [jobs.get(job.id) for job in submitted[:6]] == [None] * 6
+    assert [jobs.get(job.id) for job in submitted[6:]] == submitted[6:]
+
+
+def test_fetched_jobs_are_forgotten():
+    jobs = JobQueue(run=run, num_workers=1)
+    job = jobs.submit(0)
+    job.wait()
+    assert job.result == {'payload': 0}
+    assert jobs.pop(job.id) is job
+    assert jobs.get(job.id) is None
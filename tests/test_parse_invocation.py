@@ -0,0 +1,79 @@
+import pytest
+import torch
+
+import app
+from CIA.session_store import SessionStore
+
+TEMPO = 120
+SELECTED_REGION = dict(start=4., end=8.)
+
+
+@pytest.fixture
+def parse_paths(monkeypatch):
+    """records which of json_to_tensor (payload) and session_to_tensor
+    are used by parse_invocation
+    """
+    paths = []
+
+    def to_tensor(path):
+        def f(*args):
+            paths.append(path)
+            x = torch.zeros(1, 6, 4, dtype=torch.long)
+            metadata_dict = dict(original_sequence=x,
+                                 placeholder_duration=torch.ones(1),
+                                 decoding_start=3)
+            return (x, metadata_dict) + (x[:, :0], ) * 4 + (
+                dict(SELECTED_REGION), 8.)
+
+        return f
+
+    monkeypatch.setattr(app, 'json_to_tensor', to_tensor('payload'))
+    monkeypatch.setattr(app, 'session_to_tensor', to_tensor('session'))
+    monkeypatch.setattr(app, 'sessions', SessionStore(max_memory=2**20,
+                                                      ttl=60))
+    return paths
+
+
+def continue_request(**kwargs):
+    return dict(id='1',
+                case='continue',
+                top_p=0.9,
+                num_proposals=2,
+                selected_region=dict(SELECTED_REGION),
+                clip_start=0.,
+                tempo=TEMPO,
+                clip_id=1,
+                detail_clip_id=2,
+                **kwargs)
+
+
+def put_session():
+    app.sessions.put((1, 2),
+                     dict(tempo=TEMPO,
+                          after_notes=[],
+                          proposals=[dict(history_notes=[])]))
+
+
+def test_payload_notes_take_precedence_over_the_session(parse_paths):
+    put_session()
+    inputs = app.parse_invocation(
+        continue_request(notes_before_next_region=[], notes_after_region=[]))
+    assert parse_paths == ['payload']
+    assert inputs['context_notes'] is None
+    assert inputs['x'].size(0) == 2
+
+
+def test_session_is_used_when_the_notes_are_omitted(parse_paths):
+    put_session()
+    inputs = app.parse_invocation(continue_request())
+    assert parse_paths == ['session']
+    assert inputs['context_notes'] == ([], [])
+
+
+@pytest.mark.parametrize('tempo', [TEMPO, 90])
+def test_missing_session_without_notes_is_an_error(parse_paths, tempo):
+    if tempo != TEMPO:
+        put_session()
+    with pytest.raises(ValueError):
+        app.parse_invocation(dict(continue_request(), tempo=tempo))
+    assert parse_paths == []
@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from model_helpers import build_handler, random_inpainting_input
+
+# local attention heads (window of 8 events) keep their keys in ring buffers
+pytestmark = [
+    pytest.mark.parametrize('autoregressive_decoding', ['fullcat', 'mlp']),
+    pytest.mark.parametrize('local_attn_heads', [0, 2])
+]
+
+
+def prefill(handler, x, metadata_dict, chunk_size=None):
+    chunks = handler.prefill_iterator(x, metadata_dict,
+                                      metadata_dict['decoding_start'],
+                                      chunk_size=chunk_size)
+    num_chunks = 1
+    while True:
+        try:
+            next(chunks)
+            num_chunks += 1
+        except StopIteration as stop:
+            return stop.value, num_chunks
+
+
+@pytest.mark.parametrize('chunk_size', [None, 7, 64, 1000])
+def test_prefill_and_steps_match_full_forward(autoregressive_decoding,
+                                              local_attn_heads, chunk_size):
+    handler = build_handler(autoregressive_decoding,
+                            local_attn_heads=local_attn_heads)
+    x, metadata_dict = random_inpainting_input(handler)
+    decoding_start = metadata_dict['decoding_start']
+    with torch.no_grad():
+        expected, _, _ = handler.compute_event_state(x, metadata_dict)
+        (output, states), num_chunks = prefill(handler, x, metadata_dict,
+                                               chunk_size=chunk_size)
+        assert torch.allclose(output, expected[:, decoding_start], atol=1e-4)
+        if chunk_size is not None:
+            assert num_chunks == -(-decoding_start // min(
+                chunk_size, decoding_start))
+
+        # more steps than the window of the local attention heads
+        for event_index in range(decoding_start + 1, decoding_start + 20):
+            output, states = handler.recurrent_step(x, metadata_dict, states,
+                                                    event_index)
+            assert torch.allclose(output, expected[:, event_index], atol=1e-4)
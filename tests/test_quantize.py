@@ -0,0 +1,27 @@
+import torch
+from torch import nn
+
+from model_helpers import (build_handler, random_inpainting_input,
+                           weights_per_category)
+
+
+def test_quantized_model_predicts_close_weights():
+    handler = build_handler()
+    x, metadata_dict = random_inpainting_input(handler)
+    expected = weights_per_category(handler, x, metadata_dict)
+    num_linears = sum(
+        type(module) is nn.Linear for module in handler.model.modules())
+    assert num_linears > 0
+
+    handler.quantize()
+    assert not any(
+        type(module) is nn.Linear for module in handler.model.modules())
+    assert sum(
+        isinstance(module, torch.nn.quantized.dynamic.Linear)
+        for module in handler.model.modules()) == num_linears
+
+    weights = weights_per_category(handler, x, metadata_dict)
+    for weight, expected_weight in zip(weights, expected):
+        probabilities = torch.softmax(weight, dim=-1)
+        expected_probabilities = torch.softmax(expected_weight, dim=-1)
+        assert (probabilities - expected_probabilities).abs().max() < 1e-2
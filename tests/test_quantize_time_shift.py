@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from CIA.data_processors.piano_prefix_data_processor import PianoPrefixDataProcessor
+
+FEATURES = ['pitch', 'velocity', 'duration', 'time_shift']
+
+
+def find_nearest_value(array, value):
+    array = np.asarray(array)
+    return array[np.abs(array - value).argmin()]
+
+
+@pytest.mark.parametrize('time_table', [
+    # exact midpoints between consecutive values
+    [0., 0.25, 0.5, 1., 2., 4.],
+    [0.] + list(np.round(np.geomspace(0.02, 20, 100), 4)),
+])
+def test_quantize_time_shift_matches_find_nearest_value(time_table):
+    value2index = {
+        feature: {
+            value: index
+            for index, value in enumerate(time_table +
+                                          ['START', 'END', 'PAD'])
+        }
+        for feature in FEATURES
+    }
+    dataloader_generator = SimpleNamespace(
+        dataset=SimpleNamespace(value2index=value2index,
+                                time_table_time_shift=time_table),
+        features=FEATURES)
+    num_tokens = len(time_table) + 3
+    data_processor = PianoPrefixDataProcessor(
+        dataloader_generator=dataloader_generator,
+        embedding_size=8,
+        num_events=16,
+        num_tokens_per_channel=[num_tokens] * len(FEATURES),
+        num_events_before=4,
+        num_events_after=4)
+
+    table = np.array(time_table)
+    midpoints = (table[1:] + table[:-1]) / 2
+    values = np.concatenate([
+        table, midpoints,
+        np.random.RandomState(0).uniform(-1., table[-1] + 1., 1000)
+    ])
+    tokens = data_processor.quantize_time_shift(torch.from_numpy(values))
+    expected = [
+        value2index['time_shift'][find_nearest_value(time_table, value)]
+        for value in values.tolist()
+    ]
+    assert tokens.tolist() == expected
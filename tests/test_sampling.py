@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from CIA.utils import top_k_top_p_filtering, top_k_top_p_sampling
+
+BATCH_SIZE = 3
+NUM_TOKENS = 10
+NUM_SAMPLES = 2000
+
+
+def expected_support(logits, temperature, top_k, top_p):
+    """tokens kept by top_k_top_p_filtering for each row
+    """
+    support = []
+    for row, t, k, p in zip(logits, temperature, top_k, top_p):
+        filtered = top_k_top_p_filtering(row / t, top_k=k, top_p=p)
+        support.append(set(torch.nonzero(filtered > -float('Inf'))[:, 0].tolist()))
+    return support
+
+
+@pytest.mark.parametrize('temperature, top_k, top_p', [
+    (1., 0, 0.0),
+    (0.5, 3, 0.0),
+    (2., 0, 0.8),
+    (1., 4, 0.5),
+    ([1., 0.5, 2.], [0, 3, 6], [0.9, 0.0, 0.6]),
+])
+def test_sampling_keeps_the_support_of_filtering(temperature, top_k, top_p):
+    torch.manual_seed(0)
+    # flat enough for every kept token to be sampled
+    logits = torch.randn(BATCH_SIZE, NUM_TOKENS) * 0.5
+    per_row = [
+        value if isinstance(value, list) else [value] * BATCH_SIZE
+        for value in [temperature, top_k, top_p]
+    ]
+    support = expected_support(logits, *per_row)
+    # NUM_SAMPLES copies of each row, sampled in a single batch
+    parameters = [
+        torch.tensor(value).repeat_interleave(NUM_SAMPLES)
+        if isinstance(value, list) else value
+        for value in [temperature, top_k, top_p]
+    ]
+    sampled = top_k_top_p_sampling(logits.repeat_interleave(NUM_SAMPLES, 0),
+                                   *parameters)
+    sampled = sampled.view(BATCH_SIZE, NUM_SAMPLES)
+    for row_samples, row_support in zip(sampled, support):
+        assert set(row_samples.tolist()) == row_support
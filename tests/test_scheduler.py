@@ -0,0 +1,59 @@
+import torch
+
+from CIA.handlers.handler import Handler
+from CIA.handlers.scheduler import ContinuousBatchingScheduler
+
+
+class CountingHandler:
+    """Handler whose event_states are the event indices
+    and which samples them as the first channel;
+    recurrent_step_group fails for the requests with metadata_dict['fail']
+    """
+    num_channels_target = 2
+    update_decoding_end = staticmethod(Handler.update_decoding_end)
+
+    @property
+    def module(self):
+        return self
+
+    def eval(self):
+        pass
+
+    def prefill_iterator(self, target, metadata_dict, decoding_start,
+                         chunk_size=None):
+        yield decoding_start
+        return torch.full((target.size(0), 1), float(decoding_start)), None
+
+    def recurrent_step_group(self, steps):
+        if any(metadata_dict.get('fail', False)
+               for _, metadata_dict, _, _ in steps):
+            raise RuntimeError('failing request')
+        return [(torch.full((target.size(0), 1), float(event_index)), None)
+                for target, _, _, event_index in steps]
+
+    def sample_event(self, x, output, event_index, done, temperature, top_p,
+                     top_k):
+        x[:, event_index, 0] = output[:, 0].long()
+        return torch.zeros_like(done)
+
+    def generation_outputs(self, x, decoding_start, decoding_end, done,
+                           num_events):
+        return x
+
+
+def submit(scheduler, fail=False):
+    return scheduler.submit(x=torch.zeros(2, 8, 2).long(),
+                            metadata_dict=dict(decoding_start=2, fail=fail),
+                            num_max_generated_events=4)
+
+
+def test_failing_request_does_not_stop_the_others():
+    scheduler = ContinuousBatchingScheduler(CountingHandler(),
+                                            max_batch_size=8)
+    requests = [submit(scheduler), submit(scheduler, fail=True),
+                submit(scheduler)]
+    for request in [requests[0], requests[2]]:
+        x = request.wait()
+        assert x[:, 2:6, 0].tolist() == [[2, 3, 4, 5]] * 2
+    requests[1]._finished.wait()
+    assert isinstance(requests[1].error, RuntimeError)
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import app
+from CIA.jobs import JobQueue
+
+NOTES = [
+    dict(pitch=60, velocity=100, time=4., duration=0.5, muted=0),
+    dict(pitch=64, velocity=90, time=4.5, duration=1., muted=0),
+]
+
+
+def run(d):
+    for k, note in enumerate(NOTES):
+        yield 'event', {
+            'id': d['id'],
+            'proposal': 0,
+            'event_index': k,
+            'note': note
+        }
+    if d.get('fail'):
+        raise ValueError('line 1\nline 2')
+    yield 'end', {'id': d['id'], 'notes_region': NOTES, 'done': [True]}
+
+
+def parse_stream(body):
+    """(event, data) of each message of a text/event-stream body
+    """
+    assert body.endswith('\n\n')
+    messages = []
+    for message in body[:-2].split('\n\n'):
+        event_line, data_line = message.split('\n')
+        assert event_line.startswith('event: ')
+        assert data_line.startswith('data: ')
+        messages.append((event_line[len('event: '):],
+                         json.loads(data_line[len('data: '):])))
+    return messages
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, 'jobs', JobQueue(run=run, num_workers=1))
+    return app.app.test_client()
+
+
+def test_server_sent_event():
+    # newlines in the data must be escaped: they end the message
+    data = {'note': 'a\nb', 'value': 1}
+    message = app.server_sent_event('end', data)
+    assert message.startswith('event: end\ndata: ')
+    assert message.count('\n') == 3
+    assert parse_stream(message) == [('end', data)]
+
+
+def test_stream_sends_the_events_then_the_response(client):
+    response = client.post('/invocations_stream', json={'id': '1'})
+    assert response.mimetype == 'text/event-stream'
+    messages = parse_stream(response.get_data(as_text=True))
+    assert messages == [('event', {
+        'id': '1',
+        'proposal': 0,
+        'event_index': k,
+        'note': note
+    }) for k, note in enumerate(NOTES)] + [('end', {
+        'id': '1',
+        'notes_region': NOTES,
+        'done': [True]
+    })]
+    assert app.jobs._jobs == {}
+
+
+def test_stream_ends_with_the_error(client):
+    response = client.post('/invocations_stream',
+                           json={'id': '1', 'fail': True})
+    messages = parse_stream(response.get_data(as_text=True))
+    assert [event for event, _ in messages] == ['event', 'event', 'error']
+    assert 'line 1\\nline 2' in messages[-1][1]['error']
@@ -0,0 +1,29 @@
+import torch
+
+from CIA.session_store import SessionStore, session_num_bytes
+
+
+def notes(num_notes):
+    return [
+        dict(pitch=60, time=float(i), duration=0.5, velocity=80, muted=0)
+        for i in range(num_notes)
+    ]
+
+
+def test_size_counts_tensors_and_notes():
+    tensor = torch.zeros(10, 4, dtype=torch.long)
+    assert session_num_bytes(tensor) == 10 * 4 * 8
+    size = session_num_bytes(dict(x=tensor, notes=[]))
+    assert session_num_bytes(dict(x=tensor, notes=notes(100))) > size + 100 * 5 * 8
+
+
+def test_notes_are_evicted():
+    session = dict(x=torch.zeros(4), history_notes=notes(100))
+    size = session_num_bytes(session)
+    store = SessionStore(max_memory=2 * size, ttl=60)
+    for clip_id in range(3):
+        store.put(clip_id, dict(session, history_notes=notes(100)))
+    assert len(store) == 2 and store.memory == 2 * size
+    assert store.get(0) is None
+    store.put(1, dict(session, history_notes=notes(0)))
+    assert store.memory < 2 * size
@@ -0,0 +1,113 @@
+import copy
+import random
+
+from app import shorten_durations
+
+
+def shorten_durations_reference(generated_notes, notes_after):
+    """Previous implementation (dict of the last note of each pitch)
+    """
+    d = {}
+    max_end_time = 0
+    for k, note in enumerate(generated_notes):
+        pitch = note['pitch']
+        if pitch in d:
+            previous_note = generated_notes[d[note['pitch']]]
+            current_time = note['time']
+            previous_note_sounding_end = previous_note['time'] + previous_note['duration']
+            max_end_time = max(max_end_time,
+                               note['time'] + note['duration'])
+            if previous_note_sounding_end > current_time:
+                previous_note['duration'] = current_time - previous_note['time'] - 1e-2
+        d[note['pitch']] = k
+
+    for k, note in enumerate(notes_after):
+        time = note['time']
+        if time > max_end_time:
+            break
+        if len(d) == 0:
+            break
+        pitch = note['pitch']
+        if pitch in d:
+            previous_note = generated_notes[d[note['pitch']]]
+            current_time = note['time']
+            previous_note_sounding_end = previous_note['time'] + previous_note['duration']
+            if previous_note_sounding_end > current_time:
+                previous_note['duration'] = current_time - previous_note['time'] - 1e-2
+            del d[pitch]
+    return generated_notes
+
+
+def random_notes(num_notes, start_time, num_pitches, sort, grid):
+    notes = []
+    for _ in range(num_notes):
+        # notes on a grid often start at the same time
+        time = (start_time + random.randint(0, 16) * 0.25
+                if grid else start_time + random.random() * 4)
+        notes.append(
+            dict(pitch=random.randint(60, 60 + num_pitches - 1),
+                 time=time,
+                 duration=random.choice([0.1, 0.5, random.random() * 4]),
+                 velocity=80,
+                 muted=0))
+    if sort:
+        notes.sort(key=lambda note: note['time'])
+    return notes
+
+
+def check(generated_notes, notes_after):
+    expected = shorten_durations_reference(copy.deepcopy(generated_notes),
+                                           copy.deepcopy(notes_after))
+    assert shorten_durations(generated_notes, notes_after) == expected
+
+
+def test_empty():
+    check([], [])
+    check([], random_notes(5, 0., 3, sort=True, grid=True))
+    check(random_notes(5, 0., 3, sort=True, grid=True), [])
+
+
+def test_random_clips():
+    random.seed(0)
+    for _ in range(500):
+        # few pitches: many overlapping notes with the same pitch
+        num_pitches = random.choice([1, 3, 12])
+        sort = random.random() < 0.5
+        grid = random.random() < 0.5
+        generated_notes = random_notes(random.randint(1, 30), 0., num_pitches,
+                                       sort, grid)
+        # notes_after start around the end of the generated notes, so that
+        # some of them are after the max end time
+        notes_after = random_notes(random.randint(0, 30),
+                                   random.random() * 4, num_pitches,
+                                   sort=True, grid=grid)
+        check(generated_notes, notes_after)
+
+
+def test_same_onsets():
+    generated_notes = [
+        dict(pitch=60, time=0., duration=1., velocity=80, muted=0),
+        dict(pitch=60, time=0., duration=2., velocity=80, muted=0),
+        dict(pitch=62, time=0., duration=1., velocity=80, muted=0),
+        dict(pitch=60, time=0.5, duration=3., velocity=80, muted=0),
+    ]
+    notes_after = [
+        dict(pitch=60, time=1., duration=1., velocity=80, muted=0),
+        dict(pitch=62, time=1., duration=1., velocity=80, muted=0),
+    ]
+    check(generated_notes, notes_after)
+
+
+def test_max_end_time_cutoff():
+    # the note after is later than the end of all the generated notes
+    # which follow a note with the same pitch: it is ignored
+    generated_notes = [
+        dict(pitch=60, time=0., duration=10., velocity=80, muted=0),
+        dict(pitch=62, time=0., duration=0.5, velocity=80, muted=0),
+        dict(pitch=62, time=1., duration=0.5, velocity=80, muted=0),
+    ]
+    notes_after = [
+        dict(pitch=60, time=2., duration=1., velocity=80, muted=0),
+    ]
+    check(generated_notes, notes_after)
+    assert generated_notes[0]['duration'] == 10.
@@ -0,0 +1,96 @@
+import re
+
+import pytest
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from CIA.model.split_linear import SplitLinear
+from model_helpers import build_handler, random_inpainting_input
+
+
+def merged_linear(split_linear, x):
+    """the former nn.Linear applied to the concatenated inputs
+    """
+    weight = torch.cat([linear.weight for linear in split_linear.linears],
+                       dim=1)
+    return F.linear(x, weight, split_linear.linears[0].bias)
+
+
+def to_old_state_dict(state_dict):
+    """state_dict as saved before SplitLinear
+    """
+    old_state_dict = {}
+    weights = {}
+    for key, value in state_dict.items():
+        match = re.fullmatch(r'(.*)linears\.(\d+)\.(weight|bias)', key)
+        if match is None:
+            old_state_dict[key] = value
+        elif match.group(3) == 'bias':
+            old_state_dict[f'{match.group(1)}bias'] = value
+        else:
+            weights.setdefault(match.group(1), []).append(
+                (int(match.group(2)), value))
+    for prefix, prefix_weights in weights.items():
+        old_state_dict[f'{prefix}weight'] = torch.cat(
+            [weight for _, weight in sorted(prefix_weights)], dim=1)
+    return old_state_dict
+
+
+@pytest.mark.parametrize('input_sizes', [[5], [5, 0], [5, 3], [5, 3, 4]])
+def test_split_linear(input_sizes):
+    torch.manual_seed(0)
+    linear = nn.Linear(sum(input_sizes), 7)
+    split_linear = SplitLinear(input_sizes, 7)
+    split_linear.load_state_dict(linear.state_dict())
+    inputs = [torch.randn(2, 6, input_size) for input_size in input_sizes]
+    assert torch.allclose(split_linear(inputs),
+                          linear(torch.cat(inputs, dim=-1)),
+                          atol=1e-6)
+
+
+def old_event_state_to_weights(model, output, target_embedded):
+    weights_per_category = []
+    for channel_id in range(len(model.pre_softmaxes)):
+        if hasattr(model, 'last_mlps'):
+            mlp = model.last_mlps[channel_id]
+            weight = mlp[1:](merged_linear(mlp[0], output))
+            weight = merged_linear(model.pre_softmaxes[channel_id],
+                                   torch.cat([weight, output], dim=2))
+        else:
+            pre_softmax = model.pre_softmaxes[channel_id]
+            weight = pre_softmax[1:](merged_linear(pre_softmax[0], output))
+        weights_per_category.append(weight)
+        output = torch.cat([output, target_embedded[:, :, channel_id]], dim=2)
+    return weights_per_category
+
+
+@pytest.mark.parametrize('autoregressive_decoding', ['fullcat', 'mlp'])
+def test_heads_match_the_concatenation(autoregressive_decoding):
+    handler = build_handler(autoregressive_decoding)
+    model = handler.module
+    # old checkpoints are split when loaded
+    old_state_dict = to_old_state_dict(model.state_dict())
+    loaded_model = build_handler(autoregressive_decoding, seed=1).module
+    loaded_model.load_state_dict(old_state_dict)
+    for key, value in model.state_dict().items():
+        assert torch.equal(loaded_model.state_dict()[key], value)
+
+    x, metadata_dict = random_inpainting_input(handler)
+    with torch.no_grad():
+        output, target_embedded, _ = handler.compute_event_state(
+            x, metadata_dict)
+        weights = model.event_state_to_weights(output=output,
+                                               target_embedded=target_embedded)
+        expected = old_event_state_to_weights(model, output, target_embedded)
+        for weight, expected_weight in zip(weights, expected):
+            assert torch.allclose(weight, expected_weight, atol=1e-5)
+
+        # decoding step at one position
+        position = metadata_dict['decoding_start']
+        for channel_id, expected_weight in enumerate(expected):
+            weight = model.event_state_to_weight_step(
+                output[:, position], target_embedded[:, position], channel_id)
+            assert torch.allclose(weight,
+                                  expected_weight[:, position],
+                                  atol=1e-5)
@@ -0,0 +1,88 @@
+import pytest
+import torch
+
+from CIA.handlers.state_cache import PrefixStateCache
+from model_helpers import build_handler, random_inpainting_input
+
+
+def test_match_longest_stored_prefix():
+    cache = PrefixStateCache(max_memory=2**20)
+    cache.insert('context', [1, 2], 'a')
+    cache.insert('context', [1, 2, 3, 4], 'b')
+    assert cache.match('context', [1, 2, 3, 5]) == (2, 'a')
+    assert cache.match('context', [1, 2, 3, 4, 5]) == (4, 'b')
+    assert cache.match('context', [2]) == (0, None)
+    assert cache.match('other context', [1, 2]) == (0, None)
+
+
+def test_evicts_least_recently_used():
+    value = torch.zeros(4)
+    size = value.numel() * value.element_size()
+    cache = PrefixStateCache(max_memory=2 * size)
+    cache.insert('context', [1, 2], value)
+    cache.insert('context', [1, 3], value)
+    cache.match('context', [1, 2])
+    cache.insert('context', [4], value)
+    assert len(cache) == 2 and cache.memory == 2 * size
+    assert cache.match('context', [1, 3]) == (0, None)
+    assert cache.match('context', [1, 2])[0] == 2
+
+
+# local attention heads (window of 8 events) keep their keys in ring buffers
+@pytest.mark.parametrize('autoregressive_decoding', ['fullcat', 'mlp'])
+@pytest.mark.parametrize('local_attn_heads', [0, 2])
+def test_cached_prefill_matches_prefill(autoregressive_decoding,
+                                        local_attn_heads):
+    handler = build_handler(autoregressive_decoding,
+                            local_attn_heads=local_attn_heads)
+    x, metadata_dict = random_inpainting_input(handler, batch_size=1)
+    decoding_start = metadata_dict['decoding_start']
+    # proposals of the same request share their context
+    x = x.repeat(3, 1, 1)
+    metadata_dict = dict(metadata_dict,
+                         original_sequence=x,
+                         placeholder_duration=torch.full((3, ), 2.))
+    # same context but for the events after the checkpoint at 64
+    x_diverging = x.clone()
+    x_diverging[:, 100:decoding_start - 1] = x[:1, 101:decoding_start]
+    metadata_dict_diverging = dict(metadata_dict,
+                                   original_sequence=x_diverging)
+
+    with torch.no_grad():
+        expected = [
+            handler.prefill(x, metadata_dict, decoding_start),
+            handler.prefill(x_diverging, metadata_dict_diverging,
+                            decoding_start)
+        ]
+
+        handler.state_cache = PrefixStateCache(max_memory=2**30,
+                                               checkpoint_interval=64)
+        infer_hidden_states = handler.infer_hidden_states
+        start_events = []
+
+        def recording_infer_hidden_states(*args, start_event=0, **kwargs):
+            start_events.append(start_event)
+            return infer_hidden_states(*args, start_event=start_event,
+                                       **kwargs)
+
+        handler.infer_hidden_states = recording_infer_hidden_states
+        # not cached, full context cached,
+        # resumes from the checkpoint at 64 of the first context
+        for inputs, (expected_output, expected_states), first_start_event in [
+            ((x, metadata_dict), expected[0], 0),
+            ((x, metadata_dict), expected[0], None),
+            ((x_diverging, metadata_dict_diverging), expected[1], 65),
+        ]:
+            start_events.clear()
+            output, states = handler.prefill(*inputs,
+                                             decoding_start=decoding_start)
+            assert start_events[:1] == ([] if first_start_event is None else
+                                        [first_start_event])
+            assert output.size() == expected_output.size()
+            assert torch.allclose(output, expected_output, atol=1e-4)
+            for event_index in range(decoding_start + 1, decoding_start + 12):
+                output, states = handler.recurrent_step(
+                    *inputs, states, event_index)
+                expected_output, expected_states = handler.recurrent_step(
+                    *inputs, expected_states, event_index)
+                assert torch.allclose(output, expected_output, atol=1e-4)
@@ -0,0 +1,64 @@
+import pytest
+import torch
+
+import app
+
+SPECIAL_SYMBOLS = ['START', 'END', 'PAD']
+
+
+def tensor_to_ableton_reference(index2value, tensor, start_time,
+                                beats_per_second, expected_duration=None,
+                                rescale=False):
+    """Previous detokenization, with per-note index2value lookups
+    """
+    num_events, num_channels = tensor.size()
+    if num_events == 0:
+        return [], 0
+    notes = []
+    timeshifts = torch.FloatTensor(
+        [index2value['time_shift'][ts.item()] for ts in tensor[:, 3]])
+    time = torch.cumsum(timeshifts, dim=0)
+
+    actual_duration = time[-1].item()
+    if rescale and actual_duration > 0:
+        rescaling_factor = expected_duration / actual_duration
+    else:
+        rescaling_factor = 1
+
+    time = (torch.cat([torch.zeros(
+        (1, )), time[:-1]], dim=0) * rescaling_factor * beats_per_second +
+            start_time)
+    for i in range(num_events):
+        note = dict(pitch=index2value['pitch'][tensor[i, 0].item()],
+                    time=time[i].item(),
+                    duration=index2value['duration'][tensor[i, 2].item()] *
+                    beats_per_second * rescaling_factor,
+                    velocity=index2value['velocity'][tensor[i, 1].item()],
+                    muted=0)
+        notes.append(note)
+
+    track_duration = time[-1].item() + (notes[-1]['duration'].item() *
+                                        rescaling_factor * beats_per_second)
+    return notes, track_duration
+
+
+@pytest.mark.parametrize('num_events', [0, 1, 7, 300])
+@pytest.mark.parametrize('rescale', [False, True])
+def test_tensor_to_ableton_matches_reference(index2value, num_events,
+                                             rescale):
+    generator = torch.Generator().manual_seed(num_events)
+    tensor = torch.stack([
+        torch.randint(len(index2value[feature]) - len(SPECIAL_SYMBOLS),
+                      (num_events, ),
+                      generator=generator)
+        for feature in ['pitch', 'velocity', 'duration', 'time_shift']
+    ], dim=-1)
+    kwargs = dict(start_time=3.5,
+                  beats_per_second=1.7,
+                  expected_duration=4.,
+                  rescale=rescale)
+    notes, track_duration = app.tensor_to_ableton(tensor, **kwargs)
+    expected_notes, expected_track_duration = tensor_to_ableton_reference(
+        index2value, tensor, **kwargs)
+    assert notes == expected_notes
+    assert track_duration == pytest.approx(expected_track_duration)
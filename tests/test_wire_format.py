@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+import app
+from CIA import wire_format
+
+NOTES = [
+    dict(pitch=60, velocity=100, time=0., duration=0.5, muted=0),
+    dict(pitch=64, velocity=1, time=0.25, duration=1 / 3, muted=1),
+    dict(pitch=108, velocity=127, time=1e-3, duration=2., muted=0),
+]
+DATA = dict(id='1',
+            case='continue',
+            top_p=0.9,
+            selected_region=dict(start=4., end=8.),
+            notes_before_next_region=NOTES,
+            notes_after_region=[],
+            proposals=[dict(notes=NOTES[1:], done=True)])
+
+
+def test_round_trip():
+    decoded = wire_format.loads(wire_format.dumps(DATA))
+    assert set(decoded) == set(DATA)
+    for key in ['id', 'case', 'top_p', 'selected_region',
+                'notes_after_region']:
+        assert decoded[key] == DATA[key]
+    assert decoded['proposals'][0]['done'] is True
+    for columns, notes in [
+        (decoded['notes_before_next_region'], NOTES),
+        (decoded['proposals'][0]['notes'], NOTES[1:]),
+    ]:
+        # muted is not transmitted
+        assert set(columns) == {field for field, _ in wire_format.NOTE_FIELDS}
+        for field, dtype in wire_format.NOTE_FIELDS:
+            assert columns[field].dtype == np.dtype(dtype)
+            assert columns[field].tolist() == [note[field] for note in notes]
+
+
+def test_note_columns_are_parsed_as_json_notes():
+    columns = wire_format.loads(
+        wire_format.dumps(DATA))['notes_before_next_region']
+    for column, expected in zip(app.parse_note_columns(columns),
+                                app.parse_json_notes(NOTES)):
+        assert np.array_equal(column, expected)
+
+
+def test_truncated_message():
+    with pytest.raises(ValueError):
+        wire_format.loads(wire_format.dumps(DATA)[:-1])
+
+
+def test_request_and_response_use_the_wire_format():
+    with app.app.test_request_context(
+            '/invocations',
+            method='POST',
+            data=wire_format.dumps(DATA),
+            content_type=wire_format.CONTENT_TYPE,
+            headers={'Accept': wire_format.CONTENT_TYPE}):
+        d = app.request_data()
+        assert d['notes_before_next_region']['pitch'].tolist() == [60, 64, 108]
+        response = app.notes_response(DATA)
+    assert response.mimetype == wire_format.CONTENT_TYPE
+    assert wire_format.loads(response.get_data())['id'] == '1'
+
+    with app.app.test_request_context('/invocations',
+                                      method='POST',
+                                      json=DATA):
+        assert app.request_data() == DATA
+        response = app.notes_response(DATA)
+    assert response.mimetype == 'application/json'
+    assert response.get_json() == DATA